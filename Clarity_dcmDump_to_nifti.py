@@ -1,11 +1,21 @@
 import os
-import numpy as np
-import SimpleITK as sitk
+import json
 import pydicom as dicom
 import sys
 sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
 from copy_dicom_tags import copy_dicom_tags
-from create_rtstruct_mask_SB import create_rtstruct_masks
+from create_rtstruct_mask_SB import iter_rtstruct_masks
+from rtstruct_reader import read_rtstruct, rtstruct_rois
+from dicom_catalog import load_series_table, open_catalog, approved_rtstruct
+from dicom_indexer import series_file_count, series_voxels
+from output_manifest import load_manifest, is_up_to_date, write_output
+from mask_formats import plan_mask_outputs, write_mask_outputs
+from utils_RayStation import fname_from_date
+from volume_reader import SeriesVolumeCache, SERIES_CACHE_BYTES
+from volume_store import output_fname
+from preview_pyramid import preview_options, has_previews, write_previews
+from pipeline import run_pipeline
+from instrumentation import stage, image_bytes
 
 '''Organizes CT and CBCT images contained in DICOMRawData based on Series Instance UID. 
 Saves as nifti files to user-specified directory.
@@ -20,14 +30,43 @@ Inputs:
     2. save_dir: str - full filepath where nifti files should be saved. 
     Example: save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/images'
     3. patient_name: str - string indicating name of patient. Example: 'g01'
-    
+    4. masks_of_interest: list of strings: exact names of masks that should be exported and saved as niftis.
+    Default (None) exports every structure in the approved RTSTRUCT.
+    5. workers: int - number of processes used to read the dicom headers and to rasterize the structures (default: one
+    per CPU). See dicom_indexer.py and create_rtstruct_mask_SB.py
+    6. catalog_path: str - optional path of a dicom_catalog.py SQLite catalog. If given, only files that are new or changed
+    since the last run are read, and the approved RTSTRUCT is taken from the catalog queries (see
+    dicom_catalog.approved_rtstruct).
+    7. mask_format: str - 'nifti' (default, one nifti per structure), 'labelmap' (a single bitfield structures.nii.gz
+    with a structures.json label table) or 'rle' (run-length encoded structures.rle). See mask_formats.py
+    8. queue_depth: int - the CTs are read and written in a pipeline (see pipeline.py), so that reading series N+1 and
+    writing series N overlap. queue_depth (default: 1) volumes at most wait to be written, which caps the memory used.
+    9. tag_filter: dict - optional include, exclude and/or max_sequence_depth (see get_python_tags.get_dicom_tags)
+    selecting the dicom tags stored as metadata of the images and masks (default: every public tag).
+    10. volume_cache: volume_reader.SeriesVolumeCache - optional cache of the series volumes to share with other calls.
+    By default a cache of volume_cache_bytes (1 GB) is made for this call. Each series is decoded at most once: the ref
+    CT written as a nifti is kept for the masks instead of being read again; other series are dropped once written.
+    Volumes are cached per tag_filter, so calls with different filters sharing a cache each get their own tags.
+    11. previews: str or dict - optional 2x and 4x downsampled previews of the CTs, written to images/<patient>/previews
+    with an index.json (see preview_pyramid.py): 'uint8' (soft tissue window), 'int16', or a dict of preview_pyramid
+    options (mode, factors, window). They are computed from each image as it is written.
+    12. output_format: str - 'nifti' (default, .nii.gz) or 'volume_store': the images and the 'nifti'/'labelmap' masks
+    are written as uncompressed, memory-mappable <name>.vol volume stores, whose slices and sub-blocks can be read
+    without loading the whole volume (see volume_store.py).
+
 Output:
     Nifti file for every dcm image dataset contained in DICOMRawData.
+    A manifest.json in each output directory records what every nifti was made from. Outputs whose inputs have not
+    changed since the last run are skipped (see output_manifest.py).
+    Returns the series table, the ref CT sitk image (None if no mask needed it) and the paths of the masks written in
+    this run.
 '''
 
-def DICOMRawData_to_nifti(ct_directory, save_dir, patient_name):
+def DICOMRawData_to_nifti(ct_directory, save_dir, patient_name, masks_of_interest=None, workers=None, catalog_path=None,
+                          mask_format='nifti', queue_depth=1, tag_filter=None, volume_cache=None,
+                          volume_cache_bytes=SERIES_CACHE_BYTES, previews=None,
+                          output_format='nifti'):
     study_uids_blacklist = {}
-    floc_el = 0x19100c #Used to store the file location in read dicoms
 
     #Create 'images' sub-directory.
     im_dir = os.path.join(save_dir, 'images', patient_name)
@@ -41,116 +80,139 @@ def DICOMRawData_to_nifti(ct_directory, save_dir, patient_name):
     if not CHECK_FOLDER:
         os.makedirs(mask_dir)
 
-    # Load in the ct dicoms and RTSTRUCT dicoms as separate lists
-    ct_dicoms = {}
-    rtstruct_dicoms = []
-    for dicom_file in os.listdir(ct_directory):
-        if dicom_file == ".DS_Store":
-            continue
+    # Index the headers of every file in the dump once (slices of each series sorted by ascending slice location)
+    with stage('header_scan', patient=patient_name) as s:
+        series_table = load_series_table(ct_directory, patient_name, catalog_path=catalog_path, workers=workers)
+        s.add(files=series_file_count(series_table))
+
+    #Both CT and CBCT labeled with modality 'CT'
+    ct_dicoms = {uid: series for uid, series in series_table['series'].items()
+                 if series['modality'] == 'CT' and series['study_uid'] not in study_uids_blacklist}
+    rtstruct_dicoms = series_table['rtstruct']
 
+    if catalog_path is not None:
+        # Approved RTSTRUCT (the one the RTPLAN references) from the catalog queries
+        conn = open_catalog(catalog_path)
         try:
-            dicom_path = os.path.join(ct_directory, dicom_file)
-            dcm = dicom.read_file(dicom_path, stop_before_pixels=True)
-            series_uid = dcm.SeriesInstanceUID
-            modality = dcm.Modality
-            if dcm.StudyInstanceUID in study_uids_blacklist.keys():
-                break
-
-            #Both CT and CBCT labeled with modality 'CT'
-            if modality == 'CT':
-                if not series_uid in ct_dicoms:
-                    ct_dicoms[series_uid] = []
-                dcm.add_new(floc_el, "ST", dicom_path)
-                ct_dicoms[series_uid].append(dcm)
-
-            if modality == 'RTSTRUCT':
-                rtstruct_dcm = dicom.read_file(dicom_path, stop_before_pixels=True)
-                rtstruct_dcm.add_new(floc_el, "ST", dicom_path)
-                rtstruct_dicoms.append(rtstruct_dcm)
-
-            #Use RTPLAN to identify approved RTSTRUCT uid
-            if modality == 'RTPLAN':
-                plan_series_uid = series_uid
-                ref_rtstruct_uid = dcm[0x300c, 0x0060][0][0x0008, 0x1155].value
-                ref_rtstruct_uid_str = str(ref_rtstruct_uid)
-        except:
-            raise
-
-    # Now organise files in CT lists by ascending slice location
-    for series_uid in ct_dicoms:
-        slice_locations = [float(dcm.ImagePositionPatient[-1]) for dcm in ct_dicoms[series_uid]]
-        ct_dicoms[series_uid] = np.array(ct_dicoms[series_uid])[np.argsort(slice_locations)].tolist()
-
-    # Read in approved RTSTRUCT dicom corresponding to RTPLAN file.
-    for rtstruct in rtstruct_dicoms:
-        if rtstruct.SOPInstanceUID == ref_rtstruct_uid:
-            ref_rtstruct = rtstruct
-            if ref_rtstruct is None:
-                print("Could not find a rtstruct for plan: %s" % str(plan_series_uid))
-                continue
+            ref_rtstruct_record = approved_rtstruct(conn, patient_name, ct_directory)
+        finally:
+            conn.close()
+        if ref_rtstruct_record is None:
+            print("Could not find an approved RTSTRUCT for patient: %s" % patient_name)
+            return series_table, None, []
+        ref_rtstruct_uid = ref_rtstruct_record['sop_uid']
+    else:
+        #Use RTPLAN to identify approved RTSTRUCT uid
+        plan = series_table['rtplan'][-1]
+        plan_series_uid = plan['series_uid']
+        ref_rtstruct_uid = plan['ref_sop_uid']
+
+        # Read in approved RTSTRUCT dicom corresponding to RTPLAN file.
+        ref_rtstruct_record = None
+        for rtstruct in rtstruct_dicoms:
+            if rtstruct['sop_uid'] == ref_rtstruct_uid:
+                ref_rtstruct_record = rtstruct
+        if ref_rtstruct_record is None:
+            print("Could not find a rtstruct for plan: %s" % str(plan_series_uid))
+            return series_table, None, []
+    ref_rtstruct = read_rtstruct(ref_rtstruct_record['path'])  # contours are only read for the masks written
 
     # Find the CT image corresponding to the RTSTRUCT
-    ref_ct_series_uid = ref_rtstruct[0x3006, 0x10][0][0x3006, 0x12][0][0x3006, 0x14][0][0x20, 0xe].value
-    for series_uid in ct_dicoms:
-        if series_uid == ref_ct_series_uid:
-            ref_ct_study = ct_dicoms[series_uid]
-            ref_ct_image = sitk.ReadImage([dcm[floc_el].value for dcm in ref_ct_study]) #sitk object for ref CT
-            if ref_ct_study is None:
-                print("Could not find a CT series corresponding to RTSTRUCT: %s" % str(ref_rtstruct_uid))
-                continue
+    ref_ct_series_uid = ref_rtstruct_record['ref_series_uid']
+    if ref_ct_series_uid not in ct_dicoms:
+        print("Could not find a CT series corresponding to RTSTRUCT: %s" % str(ref_rtstruct_uid))
+        return series_table, None, []
+    ref_ct_sop_uids = ct_dicoms[ref_ct_series_uid]['sop_uids']
+
+    # Outputs already converted from the same inputs are skipped (see output_manifest.py)
+    im_manifest = load_manifest(im_dir)
+    mask_manifest = load_manifest(mask_dir)
+
+    #Generate masks of each (missing or stale) structure in RTSTRUCT (planned first: the ref CT is then kept for them)
+    structure_names = [roi['name'] for roi in rtstruct_rois(ref_rtstruct)]
+    structure_names = [name for name in structure_names if masks_of_interest is None or name in masks_of_interest]
+    mask_outputs = plan_mask_outputs(structure_names, mask_format,
+                                     {'sources': [ref_rtstruct_uid], 'reference': ref_ct_sop_uids,
+                                      **({} if tag_filter is None else {'tag_filter': tag_filter})}, output_format)
+    stale_outputs = [output for output in mask_outputs
+                     if not is_up_to_date(mask_manifest, mask_dir, output[0], output[2])]
+    stale_masks = [name for name in structure_names if any(name in output[1] for output in stale_outputs)]
 
     #Convert each CT in ct_dicoms list to nifti file. Save to location specified by save_dir
+    preview_opts = preview_options(previews, 'CT')
+    ct_jobs = []
     for series_id in ct_dicoms:
         ref_ct_study = ct_dicoms[series_id]
 
-        #Generate sitk object
-        ct_image = sitk.ReadImage([dcm[floc_el].value for dcm in ref_ct_study])
-        copy_dicom_tags(ct_image, ref_ct_study[0], ignore_private=True)
-
-        #Get date and series description from metadata - to be used in filename of nifti file
-        study_date = ct_image.GetMetaData('0008,0020') #Date
-        month = str(study_date[4:6])
-        day = str(study_date[-2:])
-        series_description = ct_image.GetMetaData('0008,103e')
-
-        month_dict = {
-            "01": "Jan",
-            "02": "Feb",
-            "03": "Mar",
-            "04": "Apr",
-            "05": "May",
-            "06": "Jun",
-            "07": "Jul",
-            "08": "Aug",
-            "09": "Sep",
-            "10": "Oct",
-            "11": "Nov",
-            "12": "Dec"
-        }
-
-        month_name = month_dict[month]
-        date_name = month_name + day + '.nii.gz'
-        if 'CBCT' in series_description:
-            fname = 'CBCT' + '_' + date_name
-        else:
-            fname = 'CT' + '_' + date_name
-
-        #Save CTs to images sub-directory in 'nifti dump' folder
-        save_path = os.path.join(im_dir, fname)
-        sitk.WriteImage(ct_image, save_path, True)
-
-    #Generate masks of each structure in RTSTRUCT.
-    rtstruct_images_sub = create_rtstruct_masks(ref_rtstruct, ref_ct_image) #output: list of sitk objects
-
-    for im in rtstruct_images_sub:
-        structure_name = im.GetMetaData("ContourName") + '.nii.gz'
-        fpath_structure = os.path.join(mask_dir, structure_name)
-        sitk.WriteImage(im, fpath_structure, True)
-
-    return ct_dicoms, ref_ct_image, rtstruct_images_sub
-
-patient_name = 'g01'
-ct_directory = '/Users/sblackledge/Documents/GENIUSII_exports/Clarity/g01/DICOMRawData'
-save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump'
-ct_dicoms, ct_example, rtstruct_sitk = DICOMRawData_to_nifti(ct_directory, save_dir, patient_name)
-
+        #Date and series description of the first file (from the index) - to be used in filename of nifti file
+        fname = output_fname(fname_from_date(ref_ct_study['study_date'], ref_ct_study['series_description']),
+                             output_format)
+        facts = {'sources': ref_ct_study['sop_uids']}
+        if tag_filter is not None:
+            facts['tag_filter'] = tag_filter
+        if not is_up_to_date(im_manifest, im_dir, fname, facts) or \
+                (preview_opts is not None and not has_previews(im_dir, fname, **preview_opts)):
+            ct_jobs.append((ref_ct_study, fname, facts))
+    # Largest series first, so a slow series does not start last and stretch the run; if the masks need the ref CT it
+    # goes last instead, so it is the most recently used volume of the cache when they do
+    ct_jobs.sort(key=lambda job: (bool(stale_masks) and job[0]['series_uid'] == ref_ct_series_uid,
+                                  -series_voxels(job[0])))
+
+    # Every series is decoded at most once (SeriesVolumeCache); the tags of its first file, whose header is only read
+    # when the series is decoded, are copied onto the cached volume, which is therefore cached under the tag_filter it
+    # was prepared with (a shared cache may serve calls with other filters)
+    if volume_cache is None:
+        volume_cache = SeriesVolumeCache(volume_cache_bytes)
+    prepare_key = ('dicom_tags', json.dumps(tag_filter, sort_keys=True))
+
+    def read_series(series):
+        def prepare(image):
+            ct_header = dicom.dcmread(series['files'][0], stop_before_pixels=True)
+            copy_dicom_tags(image, ct_header, ignore_private=True, **(tag_filter or {}))
+        with stage('read_series', patient=patient_name, series_uid=series['series_uid'], modality='CT') as s:
+            misses = volume_cache.misses
+            image = volume_cache.get(series, workers=workers, prepare=prepare, prepare_key=prepare_key)
+            if volume_cache.misses > misses:
+                s.add(files=len(series['files']), bytes=image_bytes(image))
+            else:
+                s.set(cached=True)
+        return image
+
+    #Generate sitk objects (reader stage) and save them to images sub-directory in 'nifti dump' folder (writer stage)
+    def read_ct(job):
+        ref_ct_study, fname, facts = job
+        return read_series(ref_ct_study), fname, facts, ref_ct_study['series_uid']
+
+    def write_ct(read):
+        ct_image, fname, facts, series_uid = read
+        with stage('write_nifti', patient=patient_name, fname=fname) as s:
+            write_output(ct_image, im_dir, fname, im_manifest, facts)
+            s.add(files=1, bytes=image_bytes(ct_image))
+        if preview_opts is not None:
+            with stage('previews', patient=patient_name, fname=fname) as s:
+                write_previews(ct_image, im_dir, fname, **preview_opts)
+                s.add(files=len(preview_opts['factors']), bytes=image_bytes(ct_image))
+        if not (stale_masks and series_uid == ref_ct_series_uid):
+            volume_cache.discard(series_uid, prepare_key)  # not needed again in this run
+        return fname
+
+    run_pipeline(ct_jobs, [read_ct, write_ct], queue_depth=queue_depth)
+
+    # Masks are written as soon as each one is rasterized
+    ref_ct_image = None
+    mask_paths = []
+    if stale_masks:
+        ref_ct_image = read_series(ct_dicoms[ref_ct_series_uid]) #sitk object for ref CT
+        with stage('masks', patient=patient_name, structures=len(stale_masks), mask_format=mask_format) as s:
+            masks = iter_rtstruct_masks(ref_rtstruct, ref_ct_image, stale_masks, workers=workers, tag_filter=tag_filter)
+            mask_paths = write_mask_outputs(masks, stale_outputs, mask_format, mask_dir, mask_manifest,
+                                            info={'masks_of_interest': masks_of_interest})
+            s.add(files=len(mask_paths))
+
+    return series_table, ref_ct_image, mask_paths
+
+if __name__ == '__main__':
+    patient_name = 'g01'
+    ct_directory = '/Users/sblackledge/Documents/GENIUSII_exports/Clarity/g01/DICOMRawData'
+    save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump'
+    series_table, ct_example, mask_paths = DICOMRawData_to_nifti(ct_directory, save_dir, patient_name)
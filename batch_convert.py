@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
+from dicom_catalog import load_series_table
+from dicom_indexer import series_voxels
+from nifti_writer import configure_nifti_writer, flush_nifti_writer
+from instrumentation import configure_run_log, stage
+import raystation_dcmDump_to_nifti
+import Clarity_dcmDump_to_nifti
+
+'''Converts a whole cohort of dicom exports to niftis (images + masks) across a process pool.
+
+Usage:
+    python batch_convert.py cohort.json --save-dir /Users/sblackledge/Documents/GENIUSII_exports/nifti_dump
+        --max-workers 4 --memory-budget-gb 24
+
+The cohort manifest is a json file mapping patient name to its export:
+    {
+        "g02": {"export_dir": "/Users/sblackledge/Documents/GENIUSII_exports/RayStation/g02/RayStation_CTdump",
+                "masks_of_interest": ["Bladder", "PTV45_1", "Rectum"]},
+        "g01": {"export_dir": "/Users/sblackledge/Documents/GENIUSII_exports/Clarity/g01/DICOMRawData",
+                "masks_of_interest": ["Bladder"], "converter": "clarity"}
+    }
+"converter" is 'raystation' (default) or 'clarity'. An optional "mask_format" ('nifti', 'labelmap' or 'rle', see
+mask_formats.py) selects how the masks are written, and an optional "previews" ('uint8' or 'int16', see
+preview_pyramid.py; --previews sets it for every patient) adds 2x and 4x downsampled previews of the images. An
+optional "output_format" ('nifti' or 'volume_store', see volume_store.py; --output-format sets it for every patient)
+selects the file format of the images and masks.
+
+Each patient is one job (header scan, CT export, REG/CBCT resampling and mask generation, see DICOMRawData_to_nifti).
+Jobs are scheduled largest first, with their cost and peak memory estimated from the dicom headers (which are kept in
+a dicom_catalog.py catalog so the workers do not read them again). A job is only started when it fits in the memory
+budget next to the jobs already running, smaller jobs filling any gaps, so the run takes about as long as the biggest
+single patient. Each running patient gets its share of the CPUs (CPUs / max_workers) for its own header reads,
+resampling and rasterization (the workers of DICOMRawData_to_nifti), and as many threads to compress its niftis
+(nifti_writer.py).
+
+With --run-log, every stage of every patient (header scan, series reads, resampling, nifti writes, masks) is recorded
+in a json-lines run log, see instrumentation.py.
+'''
+
+CONVERTERS = {
+    'raystation': raystation_dcmDump_to_nifti.DICOMRawData_to_nifti,
+    'clarity': Clarity_dcmDump_to_nifti.DICOMRawData_to_nifti,
+}
+
+# Rough peak memory per voxel of the reference CT: the int16 CT and either the float32 resampled CBCTs in the
+# pipeline (being resampled, queued and being written, see pipeline.py) or the mask arrays
+PEAK_BYTES_PER_CT_VOXEL = 16
+# ... plus the int16 CBCTs being read, queued and being resampled
+PEAK_BYTES_PER_CBCT_VOXEL = 6
+
+
+def read_cohort(fpath_cohort):
+    with open(fpath_cohort) as f:
+        cohort = json.load(f)
+    for patient_name, entry in cohort.items():
+        if 'export_dir' not in entry:
+            raise ValueError("Cohort entry '%s' has no export_dir" % patient_name)
+        entry.setdefault('converter', 'raystation')
+        entry.setdefault('masks_of_interest', None)
+        entry.setdefault('mask_format', 'nifti')
+        entry.setdefault('previews', None)
+        entry.setdefault('output_format', None)
+        if entry['converter'] not in CONVERTERS:
+            raise ValueError("Unknown converter '%s' for patient %s" % (entry['converter'], patient_name))
+    return cohort
+
+
+def estimate_job(series_table):
+    """ Estimate the (cost, peak memory in bytes) of converting one patient from its series table.
+
+    Cost is the number of voxels read plus the number written on the reference CT grid (one volume per resampled CBCT
+    and per mask); memory is dominated by the reference CT grid and the largest CBCT.
+    """
+    voxels = {uid: series_voxels(s) for uid, s in series_table['series'].items()}
+    if not voxels:
+        return 0, 0
+
+    ref_uids = [r['ref_series_uid'] for r in series_table['rtstruct'] if r['ref_series_uid'] in voxels]
+    ct_voxels = max(voxels[uid] for uid in ref_uids) if ref_uids else max(voxels.values())
+    cbct_voxels = [voxels[r['ref_series_uid']] for r in series_table['reg'] if r['ref_series_uid'] in voxels]
+
+    cost = sum(voxels.values()) + ct_voxels * (len(cbct_voxels) + 1)
+    memory = ct_voxels * PEAK_BYTES_PER_CT_VOXEL + max(cbct_voxels, default=0) * PEAK_BYTES_PER_CBCT_VOXEL
+    return cost, memory
+
+
+def convert_patient(patient_name, entry, save_dir, catalog_path, resample_cache_dir=None, resample_cache_bytes=None,
+                    writer_options=None, workers=1):
+    # Runs in a worker process. Only a small summary is sent back, not the images.
+    t0 = time.time()
+    configure_nifti_writer(**(writer_options or {}))
+    converter = CONVERTERS[entry['converter']]
+    options = {'workers': workers, 'catalog_path': catalog_path, 'mask_format': entry['mask_format'],
+               'previews': entry['previews'], 'output_format': entry['output_format'] or 'nifti'}
+    if entry['converter'] == 'raystation':
+        options.update(resample_cache_dir=resample_cache_dir, resample_cache_bytes=resample_cache_bytes)
+    with stage('patient', patient=patient_name, converter=entry['converter']):
+        series_table, ref_ct_image, masks = converter(entry['export_dir'], save_dir, patient_name,
+                                                      entry['masks_of_interest'], **options)
+        flush_nifti_writer()
+    return {'patient': patient_name, 'series': len(series_table['series']), 'masks': len(masks),
+            'seconds': time.time() - t0}
+
+
+def run_batch(cohort, save_dir, max_workers=None, memory_budget=None, catalog_path=None, resample_cache_dir=None,
+              resample_cache_bytes=None, compresslevel=None, compress_threads=None):
+    """ Convert every patient of the cohort.
+
+    Args
+    ====
+    cohort : dict
+        Output of read_cohort.
+
+    save_dir : str
+        nifti_dump directory; images and masks of each patient are written to save_dir/images/<patient> and
+        save_dir/masks/<patient>.
+
+    max_workers : int (default = None, one per CPU)
+        Patients converted at once. Each gets max(1, CPUs // max_workers) workers (see DICOMRawData_to_nifti).
+
+    memory_budget : int (default = None, unlimited)
+        Bytes. A patient is started only when its estimated peak memory fits next to the running ones (a patient that
+        is too large on its own still runs, alone).
+
+    catalog_path : str (default = save_dir/dicom_catalog.sqlite)
+
+    resample_cache_dir, resample_cache_bytes : str, int (default = None, no cache)
+        resample_cache.py cache of resampled CBCTs shared by all patients (RayStation exports).
+
+    compresslevel : int (default = None, nifti_writer.DEFAULT_COMPRESSLEVEL)
+        gzip level of the niftis, 1 (fastest) to 9 (smallest).
+
+    compress_threads : int (default = None, CPUs / max_workers)
+        Compression threads of each patient.
+
+    Returns
+    =======
+    results : list of dict (one per patient; 'error' is set for failed patients)
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if catalog_path is None:
+        catalog_path = os.path.join(save_dir, 'dicom_catalog.sqlite')
+    os.makedirs(save_dir, exist_ok=True)
+    if compress_threads is None:
+        compress_threads = max(1, (os.cpu_count() or 1) // max_workers)
+    writer_options = {'compresslevel': compresslevel, 'threads': compress_threads}
+    patient_workers = max(1, (os.cpu_count() or 1) // max_workers)
+
+    # Scan (or incrementally rescan) every export once, in this process, to estimate the size of each job.
+    jobs = []
+    for patient_name, entry in cohort.items():
+        series_table = load_series_table(entry['export_dir'], patient_name, catalog_path=catalog_path,
+                                         workers=max_workers)
+        cost, memory = estimate_job(series_table)
+        jobs.append((patient_name, cost, memory))
+        print('%s: %d series, est. %.1f Mvoxels, %.2f GB' % (patient_name, len(series_table['series']), cost / 1e6,
+                                                            memory / 1e9))
+
+    # Largest jobs first; jobs that do not fit in the memory budget yet are skipped until others finish
+    pending = sorted(jobs, key=lambda job: job[1], reverse=True)
+    running = {}
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # Start as many jobs as the worker and memory limits allow, largest first
+            in_use = sum(memory for _, _, memory in running.values())
+            for job in list(pending):
+                if len(running) >= max_workers:
+                    break
+                patient_name, cost, memory = job
+                if memory_budget is not None and running and in_use + memory > memory_budget:
+                    continue
+                future = executor.submit(convert_patient, patient_name, cohort[patient_name], save_dir, catalog_path,
+                                         resample_cache_dir, resample_cache_bytes, writer_options, patient_workers)
+                running[future] = job
+                pending.remove(job)
+                in_use += memory
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                patient_name = running.pop(future)[0]
+                try:
+                    result = future.result()
+                    print('%s: done in %.0f s' % (patient_name, result['seconds']))
+                except Exception as e:
+                    result = {'patient': patient_name, 'error': repr(e)}
+                    print('%s: FAILED (%r)' % (patient_name, e))
+                results.append(result)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert a cohort of RayStation/Clarity dicom exports to niftis.')
+    parser.add_argument('cohort', help='json manifest: patient name -> {export_dir, masks_of_interest, converter}')
+    parser.add_argument('--save-dir', required=True, help='nifti_dump directory')
+    parser.add_argument('--max-workers', type=int, default=None, help='number of patients converted at once')
+    parser.add_argument('--memory-budget-gb', type=float, default=None,
+                        help='total estimated peak memory of the patients converted at once')
+    parser.add_argument('--catalog', default=None,
+                        help='dicom_catalog.py catalog (default: <save-dir>/dicom_catalog.sqlite)')
+    parser.add_argument('--resample-cache', default=None, help='directory of a cache of resampled CBCTs')
+    parser.add_argument('--resample-cache-gb', type=float, default=None, help='size limit of the resampled CBCT cache')
+    parser.add_argument('--gzip-level', type=int, default=None, help='nifti compression level, 1 (fastest) to 9')
+    parser.add_argument('--gzip-threads', type=int, default=None,
+                        help='compression threads per patient (default: CPUs / max-workers)')
+    parser.add_argument('--previews', choices=['uint8', 'int16'], default=None,
+                        help='also write 2x and 4x downsampled previews of the images (unless set in the cohort)')
+    parser.add_argument('--output-format', choices=['nifti', 'volume_store'], default='nifti',
+                        help='write .nii.gz files or memory-mappable .vol volume stores (unless set in the cohort)')
+    parser.add_argument('--run-log', default=None, help='json-lines file recording the time spent in every stage')
+    parser.add_argument('--run-log-memory', action='store_true',
+                        help='also record the tracemalloc peak of every stage (slower)')
+    args = parser.parse_args(argv)
+
+    if args.run_log is not None:
+        configure_run_log(args.run_log, memory=args.run_log_memory)
+
+    memory_budget = None if args.memory_budget_gb is None else int(args.memory_budget_gb * 1e9)
+    resample_cache_bytes = None if args.resample_cache_gb is None else int(args.resample_cache_gb * 1e9)
+    cohort = read_cohort(args.cohort)
+    for entry in cohort.values():
+        if entry['previews'] is None:
+            entry['previews'] = args.previews
+        if entry['output_format'] is None:
+            entry['output_format'] = args.output_format
+    results = run_batch(cohort, args.save_dir, max_workers=args.max_workers,
+                        memory_budget=memory_budget, catalog_path=args.catalog, resample_cache_dir=args.resample_cache,
+                        resample_cache_bytes=resample_cache_bytes, compresslevel=args.gzip_level,
+                        compress_threads=args.gzip_threads)
+    failed = [result['patient'] for result in results if 'error' in result]
+    if failed:
+        print('Failed: %s' % ', '.join(failed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,272 @@
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import SimpleITK as sitk
+import pydicom as dicom
+sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
+from synthetic_export import write_raystation_export, write_us_export
+from dicom_indexer import index_dicom_directory
+from volume_reader import read_series_volume
+from create_rtstruct_mask_SB import create_rtstruct_masks
+from rtstruct_reader import read_rtstruct
+from resample_cache import resample_cbct
+from nifti_writer import write_nifti
+from raystationUSdcm_to_nifti import USdcm_to_nifti
+from compound_create import create_im_list, format_individual_ims, compound_calculate, compound_batch
+from mask2border import convert_masks_to_borders
+from nifti_to_dicom import nifti_to_dicoms
+import raystation_dcmDump_to_nifti
+import Clarity_dcmDump_to_nifti
+from instrumentation import max_rss_mb
+
+'''Times and memory-profiles every stage of the pipeline on a synthetic export (see synthetic_export.py), so runs can
+be compared without real patient data.
+
+Usage:
+    python benchmark_pipeline.py --out bench_before.json --ct-size 512 512 120 --n-cbct 4 --n-rois 10 --n-contours 2
+    python benchmark_pipeline.py --out bench_after.json ... --compare bench_before.json
+
+Stages (in this order, each using the outputs of the previous ones):
+    header_scan            dicom_indexer.index_dicom_directory of the RayStation dump
+    read_ct                volume_reader.read_series_volume of the planning CT
+    create_rtstruct_masks  every ROI of the RTSTRUCT rasterized on the planning CT
+    rasterize_skimage      the same with the skimage rasterizer (the masks must be identical, or the run stops)
+    cbct_resample          every CBCT read and resampled onto the planning CT with its REG matrix
+    write_nifti            the resampled CBCTs written as .nii.gz
+    us_to_nifti            raystationUSdcm_to_nifti.USdcm_to_nifti of every US series
+    format_individual_ims  the US images resampled onto the compound grid (in memory)
+    compound_calculate     their compound (mean), in memory
+    compound_batch         the same compound, slab by slab from the resampled image cache
+    mask2border            border niftis of every mask
+    nifti_to_dicoms        the compound written as a dicom series
+    raystation_converter   raystation_dcmDump_to_nifti.DICOMRawData_to_nifti of the whole dump
+    clarity_converter      Clarity_dcmDump_to_nifti.DICOMRawData_to_nifti of the same dump (with an RTPLAN)
+
+Every stage is timed (wall and CPU seconds, best of --repeat runs) without tracing, then run once more under
+tracemalloc for its peak traced memory (numpy arrays and python objects; memory allocated inside SimpleITK or by worker
+processes is not traced, see max_rss_mb for the high-water mark of the whole process). Results are saved as json.
+'''
+
+STAGES = ['header_scan', 'read_ct', 'create_rtstruct_masks', 'rasterize_skimage', 'cbct_resample', 'write_nifti', 'us_to_nifti',
+          'format_individual_ims', 'compound_calculate', 'compound_batch', 'mask2border', 'nifti_to_dicoms',
+          'raystation_converter', 'clarity_converter']
+
+
+def measure(func, repeat=1, memory=True):
+    """ Run func() repeat times (plus once under tracemalloc if memory) and return (result, stats). """
+    stats = {'seconds': None, 'cpu_seconds': None}
+    result = None
+    for i in range(repeat):
+        result = None
+        gc.collect()
+        t0, c0 = time.perf_counter(), time.process_time()
+        result = func()
+        seconds, cpu_seconds = time.perf_counter() - t0, time.process_time() - c0
+        if stats['seconds'] is None or seconds < stats['seconds']:
+            stats['seconds'], stats['cpu_seconds'] = seconds, cpu_seconds
+
+    if memory:
+        result = None
+        gc.collect()
+        tracemalloc.start()
+        try:
+            result = func()
+            stats['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+    stats['max_rss_mb'] = max_rss_mb()
+    return result, stats
+
+
+def environment():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'numpy': np.__version__, 'SimpleITK': sitk.Version_VersionString(), 'pydicom': dicom.__version__}
+
+
+def run_benchmark(work_dir, ct_size=(256, 256, 60), cbct_size=(192, 192, 40), n_cbct=2, n_rois=6, n_contours=1,
+                  n_us=3, us_size=(128, 128, 64), workers=1, repeat=1, memory=True, stages=None):
+    """ Generate a synthetic export in work_dir and benchmark the stages on it.
+
+    Args
+    ====
+    work_dir : str
+        Scratch directory (the export and every output are written there).
+
+    ct_size, cbct_size, us_size : tuple (x, y, z) in voxels
+
+    n_cbct, n_rois, n_contours, n_us : int
+        Number of CBCT series (each with a REG file), ROIs in the RTSTRUCT, contours per slice of each ROI and US
+        series.
+
+    workers : int (default = 1)
+        Passed to the stages that take a number of workers.
+
+    repeat : int (default = 1)
+        Timed runs per stage (the fastest is reported).
+
+    memory : bool (default = True)
+        Also run each stage under tracemalloc.
+
+    stages : list of str (default = None, every stage of STAGES)
+        Stages to report; the ones they depend on are still run (untimed).
+
+    Returns
+    =======
+    results : dict
+        'config', 'environment' and 'stages' ({name: stats}), as saved by main.
+    """
+    config = {'ct_size': list(ct_size), 'cbct_size': list(cbct_size), 'n_cbct': n_cbct, 'n_rois': n_rois,
+              'n_contours': n_contours, 'n_us': n_us, 'us_size': list(us_size), 'workers': workers, 'repeat': repeat}
+    results = {'config': config, 'environment': environment(), 'stages': {},
+               'started': time.strftime('%Y-%m-%d %H:%M:%S')}
+    wanted = set(STAGES if stages is None else stages)
+
+    def stage(name, func):
+        if name not in wanted:
+            return func()
+        result, stats = measure(func, repeat=repeat, memory=memory)
+        results['stages'][name] = stats
+        print('%-22s %8.3f s  %s' % (name, stats['seconds'], '' if 'peak_traced_mb' not in stats else
+                                     '%.1f MB traced' % stats['peak_traced_mb']))
+        return result
+
+    export_dir = os.path.join(work_dir, 'export')
+    us_export_dir = os.path.join(work_dir, 'us_export')
+    out_dir = os.path.join(work_dir, 'out')
+    info = write_raystation_export(export_dir, ct_size=ct_size, cbct_size=cbct_size, n_cbct=n_cbct, n_rois=n_rois,
+                                   n_contours=n_contours, clarity=True)
+    us_dirs = [write_us_export(us_export_dir, size=us_size, name='US_Jun%02d' % (17 + i),
+                               origin=(-us_size[0] * 0.4 + 3 * i, -us_size[1] * 0.4, -us_size[2] * 0.4), seed=i)
+               for i in range(n_us)]
+
+    series_table = stage('header_scan', lambda: index_dicom_directory(export_dir, workers=workers))
+    ct_series = series_table['series'][info['ct_series_uid']]
+    ct_image = stage('read_ct', lambda: read_series_volume(ct_series, workers=workers))
+
+    rtstruct = read_rtstruct(series_table['rtstruct'][-1]['path'])
+    masks = stage('create_rtstruct_masks', lambda: create_rtstruct_masks(rtstruct, ct_image, None, workers=workers))
+    if 'rasterize_skimage' in wanted:
+        skimage_masks = stage('rasterize_skimage', lambda: create_rtstruct_masks(rtstruct, ct_image, None,
+                                                                                  workers=workers,
+                                                                                  rasterizer='skimage'))
+        for mask, skimage_mask in zip(masks, skimage_masks):
+            if not np.array_equal(sitk.GetArrayViewFromImage(mask), sitk.GetArrayViewFromImage(skimage_mask)):
+                raise RuntimeError('Rasterizers differ for %s' % mask.GetMetaData('ContourName'))
+        del skimage_masks
+
+    def resample_cbcts():
+        resampled = []
+        for reg in series_table['reg']:
+            cbct_image = read_series_volume(series_table['series'][reg['ref_series_uid']], workers=workers)
+            resampled.append(resample_cbct(cbct_image, ct_image, reg['reg_matrix']))
+        return resampled
+    resampled = stage('cbct_resample', resample_cbcts)
+
+    im_dir = os.path.join(out_dir, 'images')
+    os.makedirs(im_dir, exist_ok=True)
+    stage('write_nifti', lambda: [write_nifti(im, os.path.join(im_dir, 'CBCT_%d.nii.gz' % i))
+                                  for i, im in enumerate(resampled)])
+    del resampled
+
+    def us_to_nifti():
+        for us_dir in us_dirs:
+            USdcm_to_nifti(us_dir, im_dir)
+        return [os.path.join(im_dir, os.path.basename(us_dir) + '.nii.gz') for us_dir in us_dirs]
+    us_paths = stage('us_to_nifti', us_to_nifti)
+    us_images = create_im_list(*us_paths)
+    us_resampled = stage('format_individual_ims', lambda: format_individual_ims(us_images))
+    del us_images
+    stage('compound_calculate', lambda: compound_calculate(us_resampled, list(range(len(us_resampled)))))
+    del us_resampled
+
+    compound_dir = os.path.join(out_dir, 'compound')
+    compound_cache = os.path.join(out_dir, 'compound_cache')
+
+    def compound():
+        shutil.rmtree(compound_cache, ignore_errors=True)  # time the resampling, not cache hits
+        return compound_batch(us_paths, [(list(range(len(us_paths))), 'compound.nii.gz')], compound_dir,
+                              compound_cache)
+    compound_path = stage('compound_batch', compound)[0]
+
+    mask_dir = os.path.join(out_dir, 'masks')
+    os.makedirs(os.path.join(mask_dir, 'g99'), exist_ok=True)
+    for mask in masks:
+        write_nifti(mask, os.path.join(mask_dir, 'g99', mask.GetMetaData('ContourName') + '.nii.gz'))
+    del masks
+    stage('mask2border', lambda: convert_masks_to_borders({'g99': info['roi_names']}, os.path.join(out_dir, 'borders'),
+                                                          mask_dir, workers=workers, extension='.nii.gz'))
+
+    dicom_dir = os.path.join(out_dir, 'compound_dicom')
+    stage('nifti_to_dicoms', lambda: nifti_to_dicoms(compound_path, dicom_dir, ct_series['files'][0]))
+
+    def convert(converter, save_dir):
+        shutil.rmtree(save_dir, ignore_errors=True)  # outputs left by a previous run would be skipped
+        return converter(export_dir, save_dir, 'g99', None, workers=workers)[2]
+    stage('raystation_converter', lambda: convert(raystation_dcmDump_to_nifti.DICOMRawData_to_nifti,
+                                                  os.path.join(out_dir, 'raystation')))
+    stage('clarity_converter', lambda: convert(Clarity_dcmDump_to_nifti.DICOMRawData_to_nifti,
+                                               os.path.join(out_dir, 'clarity')))
+    return results
+
+
+def compare_results(results, baseline):
+    """ Print the time and memory of every stage of results next to those of baseline (both as saved by main). """
+    print('%-22s %10s %10s %8s %12s %12s' % ('stage', 'before s', 'after s', 'ratio', 'before MB', 'after MB'))
+    for name, stats in results['stages'].items():
+        old = baseline['stages'].get(name)
+        if old is None:
+            continue
+        ratio = stats['seconds'] / old['seconds'] if old['seconds'] else float('nan')
+        print('%-22s %10.3f %10.3f %8.2f %12s %12s' % (name, old['seconds'], stats['seconds'], ratio,
+                                                       '%.1f' % old['peak_traced_mb'] if 'peak_traced_mb' in old else '-',
+                                                       '%.1f' % stats['peak_traced_mb'] if 'peak_traced_mb' in stats else '-'))
+    if baseline['config'] != results['config']:
+        print('Note: the two runs used different configurations')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on a synthetic dicom export.')
+    parser.add_argument('--out', required=True, help='json file the results are saved to')
+    parser.add_argument('--compare', default=None, help='results json of an earlier run to compare with')
+    parser.add_argument('--work-dir', default=None, help='scratch directory (default: a temporary one, removed)')
+    parser.add_argument('--ct-size', type=int, nargs=3, default=[256, 256, 60], metavar=('X', 'Y', 'Z'))
+    parser.add_argument('--cbct-size', type=int, nargs=3, default=[192, 192, 40], metavar=('X', 'Y', 'Z'))
+    parser.add_argument('--us-size', type=int, nargs=3, default=[128, 128, 64], metavar=('X', 'Y', 'Z'))
+    parser.add_argument('--n-cbct', type=int, default=2)
+    parser.add_argument('--n-rois', type=int, default=6)
+    parser.add_argument('--n-contours', type=int, default=1, help='contours per slice of each ROI')
+    parser.add_argument('--n-us', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs per stage (the fastest is reported)')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc runs')
+    parser.add_argument('--stages', nargs='+', default=None, choices=STAGES, help='stages to report (default: all)')
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='geniusii_bench_')
+    try:
+        results = run_benchmark(work_dir, ct_size=args.ct_size, cbct_size=args.cbct_size, n_cbct=args.n_cbct,
+                                n_rois=args.n_rois, n_contours=args.n_contours, n_us=args.n_us, us_size=args.us_size,
+                                workers=args.workers, repeat=args.repeat, memory=not args.no_memory,
+                                stages=args.stages)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare_results(results, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,6 +3,14 @@ import os
 import SimpleITK as sitk
 import matplotlib.pyplot as plt
 import copy
+import sys
+import json
+from contextlib import ExitStack
+sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
+from nifti_writer import get_nifti_writer
+from output_manifest import file_hash, output_key, tmp_path_for
+from instrumentation import stage
+from preview_pyramid import preview_options, preview_slab_writer
 
 
 
@@ -14,6 +22,13 @@ def create_im_list(*args):
         sitk_ims.append(sitk_im)
     return sitk_ims
 
+'''Header (size, origin, spacing, direction) of a nifti without reading its pixels'''
+def read_im_info(fpath):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(fpath)
+    reader.ReadImageInformation()
+    return reader
+
 '''Extract im size, position, and spacing params'''
 def extract_metadata(sitk_im):
     im_origin = np.asarray(sitk_im.GetOrigin())
@@ -23,21 +38,18 @@ def extract_metadata(sitk_im):
     pixel_type = sitk_im.GetPixelIDTypeAsString()
     return im_origin, im_size, im_spacing, im_direction, pixel_type
 
-'''Resample individual images onto common (large) reference grid. Also pre-process to crop LR edges to remove
-weird edge effect.
+'''Geometry of the common (large) reference grid covering every image: origin at the minimum origin, spacing of the
+last image, size up to the furthest image edge.
 
     Inputs:
-        1. sitk_ims: list of sitk image objects; oubput from create_im_list
+        1. sitk_ims: list of sitk image objects (create_im_list) or of image headers (read_im_info)
     Outputs:
-        1. resampled_ims: list of sitk image objects resampeld to common reference grid'''
-def format_individual_ims(sitk_ims):
-    for i, im in enumerate(sitk_ims):
-        if i==0:
-            im_origin0, im_size0, im_spacing0, im_direction0, pixel_type = extract_metadata(im)
-        else:
-            im_origin, im_size, im_spacing, im_direction, pixel_type = extract_metadata(im)
-            im_origin0 = np.vstack((im_origin0, im_origin))
-            im_size0 = np.vstack((im_size0, im_size))
+        1. (size, origin, spacing, direction) of the compound grid (see nifti_stream.image_geometry)'''
+def compound_geometry(sitk_ims):
+    # Only origin, size and spacing are used, so sitk.ImageFileReader objects (read_im_info) work as well as images
+    im_origin0 = np.array([im.GetOrigin() for im in sitk_ims])
+    im_size0 = np.array([im.GetSize() for im in sitk_ims])
+    im_spacing = sitk_ims[-1].GetSpacing()
 
     #Determine position (mm) of last pixel in xyz for compound image
     last_x = np.amax(im_origin0[:, 0] + (im_size0[:, 0]*im_spacing[0]))
@@ -53,14 +65,26 @@ def format_individual_ims(sitk_ims):
     new_size = new_size.astype(int)
     new_size = new_size.tolist() #convert from int64 to int
 
+    return tuple(new_size), tuple(new_origin.tolist()), tuple(im_spacing), (1., 0., 0., 0., 1., 0., 0., 0., 1.)
+
+'''Resample individual images onto common (large) reference grid. Also pre-process to crop LR edges to remove
+weird edge effect.
+
+    Inputs:
+        1. sitk_ims: list of sitk image objects; oubput from create_im_list
+        2. cutoff: number of pixels trimmed from both ends of every row of each resampled image (see trim_edges)
+    Outputs:
+        1. resampled_ims: list of sitk image objects resampeld to common reference grid'''
+def format_individual_ims(sitk_ims, cutoff=5):
+    new_size, new_origin, im_spacing, im_direction = compound_geometry(sitk_ims)
+
     #Create new sitk image object with size of compound image
     compound_3D_template = sitk.Image(new_size[0], new_size[1], new_size[2], sitk.sitkInt16)
-    compound_3D_template.SetOrigin((new_origin[0], new_origin[1], new_origin[2]))
-    compound_3D_template.SetSpacing((im_spacing[0], im_spacing[1], im_spacing[2]))
+    compound_3D_template.SetOrigin(new_origin)
+    compound_3D_template.SetSpacing(im_spacing)
 
     #Resample original images onto new new compound template. Store in list
     resampled_ims = []
-    cutoff = 5
     counter = 0
     for im in sitk_ims:
         counter = counter + 1
@@ -68,24 +92,10 @@ def format_individual_ims(sitk_ims):
         im_resampled = sitk.Resample(im, compound_3D_template, sitk.AffineTransform(3), sitk.sitkLinear, -1000, sitk.sitkFloat32)
         #Convert all background pixels (-1000) to NaN (note: converts any pixels that's -1000 into NaN even if within US)
         im_resampled_array = sitk.GetArrayFromImage(im_resampled)
-        im_resampled_array[im_resampled_array == -1000] = np.NaN
+        im_resampled_array[im_resampled_array == -1000] = np.nan
 
         #Chop off edge pixels to remove weird border effect
-        TF = np.isnan(im_resampled_array)
-        im_size = TF.shape
-        for k in range(im_size[0]):
-            slice = TF[k, :, :]
-            for i in range(im_size[1]):
-                row = slice[i, :]
-                int_inds = np.where(~row)[0]
-                if int_inds.size > 0: #If array is not empty
-                    first_ind = int_inds[0]
-                    last_ind = int_inds[-1]
-                    new_first_ind = first_ind + cutoff
-                    new_last_ind = last_ind - cutoff
-                    new_row = row
-                    im_resampled_array[k, i, first_ind:new_first_ind] = np.NaN
-                    im_resampled_array[k, i, new_last_ind:last_ind+1] = np.NaN
+        trim_edges(im_resampled_array, cutoff)
 
         im_resampled2 = sitk.GetImageFromArray(im_resampled_array)
         im_resampled2.CopyInformation(im_resampled)
@@ -94,6 +104,37 @@ def format_individual_ims(sitk_ims):
 
     return resampled_ims
 
+'''Set the first and last cutoff valid (non-NaN) pixels of every row (x direction) of im_array to NaN, in place.
+
+    Works on the whole array at once: the first and last valid index of each row are found with argmax over the valid
+    mask, and the trimmed pixels are the same as with a per-row loop doing
+        im_array[k, i, first:first + cutoff] = NaN
+        im_array[k, i, last - cutoff:last + 1] = NaN
+    including the wrap-around of a negative start (last < cutoff) in the second slice.
+
+    Inputs:
+        1. im_array: 3D float array (z, y, x) with NaN outside the ultrasound
+        2. cutoff: int
+    Outputs:
+        1. im_array (modified in place)'''
+def trim_edges(im_array, cutoff=5):
+    valid = ~np.isnan(im_array)
+    n = valid.shape[2]
+    has_data = valid.any(axis=2)
+    first = valid.argmax(axis=2)[..., None]
+    last = (n - 1 - valid[:, :, ::-1].argmax(axis=2))[..., None]
+    del valid
+
+    # Start of the trailing trim; a negative start indexes from the end of the row, as in python slicing
+    back_start = last - cutoff
+    back_start = np.where(back_start >= 0, back_start, np.maximum(back_start + n, 0))
+
+    cols = np.arange(n)
+    trim = ((cols >= first) & (cols < first + cutoff)) | ((cols >= back_start) & (cols <= last))
+    trim &= has_data[..., None]
+    im_array[trim] = np.nan
+    return im_array
+
 '''inputs:
     1. resampled_ims: list of all sitk image objects available
     2. indices: list of indices of resampled_ims to include in compound (i.e. [0, 1])'''
@@ -117,39 +158,229 @@ def compound_calculate(resampled_ims, indices):
     return av_im_sitk
 
 
-'''Modify Code below to make desired compounds'''
-#Full pathnames of every image to be considered in the compound. Will be placed in list in the order in which they are
-#input to the function 'create_im_list'
-fpath1 = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/images/g01/US_Jun17_1120.nii.gz'
-fpath2 = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/images/g01/US_Jun17_1121_1.nii.gz'
-fpath3 = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/images/g01/US_Jun17_1121_2.nii.gz'
-fpath4 = ''
-
-
-sitk_ims = create_im_list(fpath1, fpath2, fpath3)
-
-#Directory where compound image nifti files should be saved
-dir_compounds = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/compound_images'
+'''Resample image onto z-slab [z0, z0 + n_slices) of the compound grid and trim its edges. Returns a float32
+array (n_slices, rows, columns) with NaN outside the ultrasound, or None if the image does not reach the slab.'''
+def resample_slab(sitk_im, geometry, z0, n_slices, cutoff=5):
+    size, origin, spacing, direction = geometry
 
-#Indices of image list to include in compound
-indices = [0, 1, 2]
+    # Physical z-range the image can be interpolated over (all 8 corners of its buffer, half a pixel beyond the outer
+    # pixel centres) against that of the slab plus a slice on either side
+    corners = [sitk_im.TransformContinuousIndexToPhysicalPoint([i * n - 0.5 for i, n in zip(c, sitk_im.GetSize())])
+               for c in np.ndindex(2, 2, 2)]
+    im_z = [corner[2] for corner in corners]
+    slab_z = (origin[2] + (z0 - 1) * spacing[2], origin[2] + (z0 + n_slices) * spacing[2])
+    if max(im_z) < slab_z[0] or min(im_z) > slab_z[1]:
+        return None
 
-#Generate compound image
-resampled_ims = format_individual_ims(sitk_ims)
-compound_im = compound_calculate(resampled_ims, indices)
-compound_name = 'June17_compound.nii.gz' #Don't forget to include file extension in name (.nii.gz)
-patient_id = 'g01'
+    slab_origin = (origin[0], origin[1], origin[2] + z0 * spacing[2])
+    im_resampled = sitk.Resample(sitk_im, (size[0], size[1], n_slices), sitk.AffineTransform(3), sitk.sitkLinear,
+                                 slab_origin, spacing, direction, -1000, sitk.sitkFloat32)
+    im_resampled_array = sitk.GetArrayFromImage(im_resampled)
+    im_resampled_array[im_resampled_array == -1000] = np.nan
+    return trim_edges(im_resampled_array, cutoff)
 
-'''End Code modification'''
+'''Out-of-core version of format_individual_ims + compound_calculate: the compound (mean of the images in indices,
+-1000 where no image has data) is computed one z-slab of the compound grid at a time and written straight to savename.
 
-# Create patient sub-directory within dir_compounds directory.
-im_dir = os.path.join(dir_compounds, patient_id)
-CHECK_FOLDER = os.path.isdir(im_dir)
-if not CHECK_FOLDER:
-    os.makedirs(im_dir)
+Each image is resampled only onto the slab being worked on, and the slab keeps a running sum and count of the valid
+pixels instead of a stack of all resampled images, so peak memory is set by the slab size (slab_size slices of the
+compound grid) rather than by the number of images times the size of the compound grid.
 
-#Save compound as nifti
-savename = os.path.join(im_dir, compound_name)
-sitk.WriteImage(compound_im, savename, True)
+    Inputs:
+        1. sitk_ims: list of sitk image objects; oubput from create_im_list
+        2. indices: list of indices of sitk_ims to include in compound (i.e. [0, 1])
+        3. savename: full path of the compound nifti (.nii.gz), or of a volume store (.vol, see volume_store.py)
+        4. slab_size: number of slices per slab
+        5. cutoff: see trim_edges
+        6. previews: optional 2x and 4x downsampled previews of the compound, computed from the slabs as they are
+        written: 'uint8' (8-bit ultrasound window), 'int16' or a dict of options (see preview_pyramid.py)
+    Outputs:
+        1. geometry (size, origin, spacing, direction) of the compound written to savename'''
+def compound_to_nifti(sitk_ims, indices, savename, slab_size=16, cutoff=5, previews=None):
+    geometry = compound_geometry(sitk_ims)
+    nx, ny, nz = geometry[0]
+
+    with ExitStack() as stack:
+        s = stack.enter_context(stage('compound', fname=os.path.basename(savename), images=len(indices)))
+        write_slab = stack.enter_context(get_nifti_writer().slab_writer(savename, geometry, np.float32))
+        if previews is not None:
+            write_slab = _with_previews(stack, write_slab, savename, geometry, previews)
+        for z0 in range(0, nz, slab_size):
+            n_slices = min(slab_size, nz - z0)
+            total = np.zeros((n_slices, ny, nx), dtype=np.float64)
+            count = np.zeros((n_slices, ny, nx), dtype=np.uint16)
+            for ind in indices:
+                im_array = resample_slab(sitk_ims[ind], geometry, z0, n_slices, cutoff)
+                if im_array is None:
+                    continue
+                valid = ~np.isnan(im_array)
+                total[valid] += im_array[valid]
+                count += valid
+                del im_array, valid
+
+            #Compound is the mean of the individual US images; -1000 where there is no data
+            av_slab = np.full((n_slices, ny, nx), -1000, dtype=np.float32)
+            np.divide(total, count, out=av_slab, where=count > 0, casting='unsafe')
+            write_slab(av_slab)
+            s.add(bytes=av_slab.nbytes)
+        s.add(files=1)
+
+    return geometry
+
+
+'''Write function that also adds each slab to the previews of savename (see preview_pyramid.preview_slab_writer); the
+previews are put in place when stack is closed.'''
+def _with_previews(stack, write_slab, savename, geometry, previews):
+    out_dir, fname = os.path.split(savename)
+    write_preview_slab = stack.enter_context(preview_slab_writer(out_dir, fname, geometry,
+                                                                 **preview_options(previews, 'US')))
+
+    def write_both(array):
+        write_slab(array)
+        write_preview_slab(array)
+    return write_both
+
+
+'''Path of the cached resampled + trimmed copy of the image at fpath on the compound grid (geometry), creating it if
+it is not in cache_dir yet.
+
+The cache file is a float32 .npy array (z, y, x) of the whole compound grid with NaN outside the ultrasound, named
+after a key over the hash of the source file, the compound geometry and cutoff, so it is reused by every compound on
+the same grid and rebuilt if the source file changes. It is filled one slab at a time (resample_slab) through a memory
+map, and a .json next to it records what it was made from.
 
+    Inputs:
+        1. fpath: full path of the source nifti
+        2. geometry: compound grid (compound_geometry)
+        3. cache_dir: directory holding the cache
+        4. cutoff, slab_size: see trim_edges and compound_to_nifti
+        5. source_hash: file_hash(fpath), if already known
+    Outputs:
+        1. cache_path: full path of the .npy file (open with np.load(cache_path, mmap_mode='r'))'''
+def cached_resampled_im(fpath, geometry, cache_dir, cutoff=5, slab_size=16, source_hash=None):
+    if source_hash is None:
+        source_hash = file_hash(fpath)
+    size, origin, spacing, direction = geometry
+    facts = {'source': source_hash, 'size': list(size), 'origin': list(origin), 'spacing': list(spacing),
+             'direction': list(direction), 'cutoff': cutoff}
+    key = output_key(facts)
+    cache_path = os.path.join(cache_dir, key + '.npy')
+    if os.path.isfile(cache_path):
+        return cache_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    sitk_im = sitk.ReadImage(fpath)
+    nx, ny, nz = size
+    tmp_path = tmp_path_for(cache_path)
+    try:
+        cached = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(nz, ny, nx))
+        for z0 in range(0, nz, slab_size):
+            n_slices = min(slab_size, nz - z0)
+            im_array = resample_slab(sitk_im, geometry, z0, n_slices, cutoff)
+            cached[z0:z0 + n_slices] = np.nan if im_array is None else im_array
+        cached.flush()
+        del cached
+        os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    with open(os.path.join(cache_dir, key + '.json'), 'w') as f:
+        json.dump(dict(facts, fpath=fpath), f, indent=1)
+    return cache_path
+
+'''Make several compounds from the same set of images in one pass.
+
+The compound grid is the one covering every image in fpaths (as in format_individual_ims), so all compounds share it
+and each image is resampled at most once into cache_dir (cached_resampled_im); later runs on the same images reuse the
+cache. The compounds are then computed together slab by slab from the memory-mapped cache, every image slab being
+read once for all the compounds it belongs to, and written to save_dir as in compound_to_nifti.
 
+    Inputs:
+        1. fpaths: list of full paths of the images (as given to create_im_list)
+        2. compounds: list of (indices, compound_name) pairs, e.g. [([0, 1, 2], 'June17_compound.nii.gz'),
+        ([0, 1], 'June17_1120_1121.nii.gz')]
+        3. save_dir: directory where the compound niftis are saved
+        4. cache_dir: directory of the resampled image cache
+        5. slab_size, cutoff, previews: see compound_to_nifti
+    Outputs:
+        1. savenames: full paths of the compounds, in the order of compounds'''
+def compound_batch(fpaths, compounds, save_dir, cache_dir, slab_size=16, cutoff=5, previews=None):
+    geometry = compound_geometry([read_im_info(fpath) for fpath in fpaths])
+    nx, ny, nz = geometry[0]
+
+    used = sorted(set(ind for indices, compound_name in compounds for ind in indices))
+    cached = {}
+    for ind in used:
+        with stage('compound_resample', fname=os.path.basename(fpaths[ind])) as s:
+            cache_path = cached_resampled_im(fpaths[ind], geometry, cache_dir, cutoff=cutoff, slab_size=slab_size)
+            s.add(files=1, bytes=os.path.getsize(cache_path))
+        cached[ind] = np.load(cache_path, mmap_mode='r')
+
+    os.makedirs(save_dir, exist_ok=True)
+    savenames = [os.path.join(save_dir, compound_name) for indices, compound_name in compounds]
+    with ExitStack() as stack:
+        s = stack.enter_context(stage('compound', fname=[compound_name for indices, compound_name in compounds],
+                                      images=len(used)))
+        writers = [stack.enter_context(get_nifti_writer().slab_writer(savename, geometry, np.float32))
+                   for savename in savenames]
+        if previews is not None:
+            writers = [_with_previews(stack, write_slab, savename, geometry, previews)
+                       for write_slab, savename in zip(writers, savenames)]
+        for z0 in range(0, nz, slab_size):
+            n_slices = min(slab_size, nz - z0)
+            totals = [np.zeros((n_slices, ny, nx), dtype=np.float64) for compound in compounds]
+            counts = [np.zeros((n_slices, ny, nx), dtype=np.uint16) for compound in compounds]
+            for ind in used:
+                im_array = np.asarray(cached[ind][z0:z0 + n_slices])
+                valid = ~np.isnan(im_array)
+                if not valid.any():
+                    continue
+                values = np.where(valid, im_array, 0)
+                for (indices, compound_name), total, count in zip(compounds, totals, counts):
+                    if ind in indices:
+                        total += values
+                        count += valid
+
+            #Compound is the mean of the individual US images; -1000 where there is no data
+            for write_slab, total, count in zip(writers, totals, counts):
+                av_slab = np.full((n_slices, ny, nx), -1000, dtype=np.float32)
+                np.divide(total, count, out=av_slab, where=count > 0, casting='unsafe')
+                write_slab(av_slab)
+                s.add(bytes=av_slab.nbytes)
+        s.add(files=len(writers))
+
+    return savenames
+
+
+if __name__ == '__main__':
+    '''Modify Code below to make desired compounds'''
+    #Full pathnames of every image to be considered in the compound. Will be placed in list in the order in which they are
+    #input to the function 'create_im_list'
+    fpath1 = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/images/g01/US_Jun17_1120.nii.gz'
+    fpath2 = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/images/g01/US_Jun17_1121_1.nii.gz'
+    fpath3 = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/images/g01/US_Jun17_1121_2.nii.gz'
+    fpath4 = ''
+
+
+    fpaths = [fpath1, fpath2, fpath3]
+
+    #Directory where compound image nifti files should be saved
+    dir_compounds = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/compound_images'
+
+    #Compounds to make: indices of image list to include in each compound and its name. Don't forget to include file
+    #extension in name (.nii.gz, or .vol for a memory-mappable volume store)
+    compounds = [([0, 1, 2], 'June17_compound.nii.gz')]
+    patient_id = 'g01'
+
+    '''End Code modification'''
+
+    # Create patient sub-directory within dir_compounds directory.
+    im_dir = os.path.join(dir_compounds, patient_id)
+    CHECK_FOLDER = os.path.isdir(im_dir)
+    if not CHECK_FOLDER:
+        os.makedirs(im_dir)
+
+    #Generate compound images, slab by slab, and save as nifti. Resampled images are cached for later compounds.
+    cache_dir = os.path.join(dir_compounds, 'resample_cache', patient_id)
+    compound_batch(fpaths, compounds, im_dir, cache_dir)
@@ -1,9 +1,11 @@
 import sys
 sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
-from get_python_tags import get_dicom_tags
+from get_python_tags import cached_dicom_tags, apply_dicom_tags
 
 
-def copy_dicom_tags(sitk_image, dcm, ignore_private=True, ignore_groups=()):
-    tags = get_dicom_tags(dcm, ignore_private=ignore_private, ignore_groups=ignore_groups)
-    for key in tags:
-        sitk_image.SetMetaData(key, tags[key])
\ No newline at end of file
+def copy_dicom_tags(sitk_image, dcm, ignore_private=True, ignore_groups=(), include=None, exclude=(),
+                    max_sequence_depth=None):
+    # sitk_image may be a list of images; the tags of dcm are only stringified once (see get_python_tags.py)
+    tags = cached_dicom_tags(dcm, ignore_private=ignore_private, ignore_groups=ignore_groups, include=include,
+                             exclude=exclude, max_sequence_depth=max_sequence_depth)
+    apply_dicom_tags(sitk_image, tags)
@@ -1,102 +1,308 @@
 import SimpleITK as sitk
 import numpy as np
 from skimage.draw import polygon
+import os
 import sys
-from tqdm import tqdm
-import copy
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
-from get_python_tags import get_dicom_tags
+from get_python_tags import cached_dicom_tags, apply_dicom_tags
+from instrumentation import stage
+from rtstruct_reader import roi_contours
 
 
-def create_rtstruct_masks(rtstruct_dicom, ct_image, masks_of_interest):
-    """ Convert rtstruct dicom file to sitk images
+# Pixels closer than this (in pixels) to an edge or vertex of a contour are decided by point_in_polygon
+EDGE_TOLERANCE = 1e-6
+
+
+def iter_rtstruct_masks(rtstruct_dicom, ct_image, masks_of_interest, workers=1, tag_filter=None,
+                        rasterizer='scanline'):
+    """ Convert rtstruct dicom file to sitk images, one structure at a time
+
+    Only the structures in masks_of_interest are rasterized. Each one is drawn into a uint8 array covering just its
+    bounding box (slices and in-plane extent of its contours), which is then placed in a uint8 volume the size of the
+    CT and yielded straight away, so only about one mask is held in memory at a time if the caller writes (or
+    otherwise consumes) each mask before asking for the next one.
 
     Args
     ====
-    fpath_rtstruct : full file path to RTSTRUCT.dcm file
+    rtstruct_dicom : pydicom.Dataset
+    The loaded RTSTRUCT.dcm file (preferably with rtstruct_reader.read_rtstruct). Only the contours of the structures
+    in masks_of_interest are decoded.
 
     ct_image : SimpleITK.Image
     The CT image on which the RTStruct is defined.
 
-    save_dir : full file path to directory where masks should be saved
+    masks_of_interest : list of str
+    Names of the structures to convert. None converts every structure in the RTSTRUCT.
 
-    Return
-    ======
-    masks : list
-    A list of SimpleITK.Image instances for the masks
+    workers : int (default = 1)
+    Number of processes rasterizing structures concurrently (None: one per CPU). The output is the same for any number
+    of workers.
 
-    """
-    # Provides the names
-    #0x30060022 = ROI Number
-    #0x30060026 = ROI Name
-    structure_sets = {int(d[0x30060022].value):d for d in rtstruct_dicom[0x30060020]}
+    tag_filter : dict (default = None, every public tag outside group 3006)
+    include, exclude and/or max_sequence_depth (see get_python_tags.get_dicom_tags) selecting the RTSTRUCT tags
+    stored on each mask.
+
+    rasterizer : str (default = 'scanline')
+    'scanline' (scanline_fill, one pass per slice) or 'skimage' (skimage.draw.polygon per contour). Both give the
+    same masks.
 
+    Yields
+    ======
+    mask : SimpleITK.Image (uint8)
+    One mask per structure, in the order of the ROIContourSequence. The structure name is stored in the
+    "ContourName" metadata.
+    """
     orX, orY, orZ = ct_image.GetOrigin()
     szX, szY, szZ = ct_image.GetSize()
     spX, spY, spZ = ct_image.GetSpacing()
     z_locs = orZ + np.arange(szZ) * spZ
 
-    masks = []
-    names = {}
+    tags = cached_dicom_tags(rtstruct_dicom, ignore_private=True, ignore_groups=[0x3006], **(tag_filter or {}))
+    ref_ct_series_uid = rtstruct_dicom[0x3006, 0x10][0][0x3006, 0x12][0][0x3006, 0x14][0][0x20, 0xe].value
 
-    mask_idx = 0
-    contour_sequences = rtstruct_dicom.ROIContourSequence
+    # Pixel coordinates and nearest slice of every contour of each requested structure (in ROIContourSequence order).
+    # The contours of the other structures are not decoded (see rtstruct_reader.py).
+    names = []
+    roi_polygons = []
+    for contour_name, contours in roi_contours(rtstruct_dicom, masks_of_interest):
+        z_indices = nearest_slices([xyz[0, 2] for xyz in contours], z_locs)
+        polygons = []
+        for xyz, z_idx in zip(contours, z_indices):
+            x = (xyz[:, 0] - orX) / spX
+            y = (xyz[:, 1] - orY) / spY
+            polygons.append((x, y, z_idx))
+        names.append(contour_name)
+        roi_polygons.append(polygons)
 
-    # For each contour itemized in ROIContourSequence tag
-    for item in contour_sequences:
-        roi_mask = np.zeros(ct_image.GetSize(), dtype="int")
-        contourSequence = item.ContourSequence
-        structure_idx = item[0x30060084].value
-        contour_name = structure_sets[structure_idx][0x30060026].value
+    # Structures are independent: rasterize them in a process pool if asked to. Workers only receive the vertex
+    # arrays and the CT size; results come back in the original order.
+    size = (szX, szY, szZ)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 and len(roi_polygons) > 1 else None
+    try:
+        if executor is None:
+            boxes = map(rasterize_polygons, roi_polygons, repeat(size), repeat(rasterizer))
+        else:
+            boxes = executor.map(rasterize_polygons, roi_polygons, repeat(size), repeat(rasterizer))
 
-        if contour_name in masks_of_interest:
-            names[mask_idx] = contour_name
+        boxes = iter(boxes)
+        for contour_name, polygons in zip(names, roi_polygons):
             print(contour_name)
+            # Only the rasterization is timed, not what the caller does with the mask before asking for the next one
+            with stage('rasterize', structure=contour_name, contours=len(polygons)) as s:
+                box_slices, box = next(boxes)
+                roi_mask = np.zeros((szZ, szY, szX), dtype=np.uint8)
+                if box is not None:
+                    roi_mask[box_slices] = box
+
+                mask_image_sub = sitk.GetImageFromArray(roi_mask)
+                s.add(bytes=roi_mask.nbytes)
+                del roi_mask
+                mask_image_sub.CopyInformation(ct_image)
+                mask_image_sub.SetMetaData("ContourName", contour_name)
+                mask_image_sub.SetMetaData("CTSeriesUID", ref_ct_series_uid)
+                apply_dicom_tags(mask_image_sub, tags)
+            yield mask_image_sub
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def bounding_box(polygons, size):
+    """ (z, y, x) slices of the CT volume covering every pixel the polygons can fill. """
+    szX, szY, szZ = size
+    x = np.concatenate([p[0] for p in polygons])
+    y = np.concatenate([p[1] for p in polygons])
+    z = [p[2] for p in polygons]
+    x0, x1 = int(max(0, np.floor(x.min()))), int(min(szX, np.ceil(x.max()) + 1))
+    y0, y1 = int(max(0, np.floor(y.min()))), int(min(szY, np.ceil(y.max()) + 1))
+    return slice(min(z), max(z) + 1), slice(y0, max(y0, y1)), slice(x0, max(x0, x1))
 
-            #For each slice comprising stucture
-            for j in contourSequence:
-                xyz = j.ContourData
-                x = xyz[0::3]
-                y = xyz[1::3]
-                z = xyz[2::3]
-                z_diff = np.abs(z_locs - z[0])
-                z_idx = np.where(z_diff == np.min(z_diff))[0][0]
-                x_arr  =np.asarray(x)
-                y_arr = np.asarray(y)
-                x = (x_arr - orX) / spX
-                y = (y_arr - orY) / spY
-                mask = roi_mask[:, :, z_idx]
-                mask_new = np.zeros_like(mask)
-                rr, cc = polygon(x, y, mask.shape)
-                mask_new[rr, cc] = True
-                mask = np.logical_xor(mask, mask_new)
-                roi_mask[:, :, z_idx] = mask
-
-            masks.append(roi_mask)
-            mask_idx += 1
-
-
-    masks = np.array(masks).transpose((3, 2, 1, 0))
-    mask_images = []
-    tags = get_dicom_tags(rtstruct_dicom, ignore_private=True, ignore_groups=[0x3006])
-    name_idx_dict = dict((v, k) for k, v in names.items())
-
-    #generate sitk image for each mask and concatenate into single array
-    for idx in tqdm(names, leave=False, desc="Creating individual"):
-        #print(idx)
-        mask_image_sub = sitk.GetImageFromArray(masks[:, :, :, idx].astype("uint8"))
-        mask_image_sub.CopyInformation(ct_image)
-        mask_image_sub.SetMetaData("ContourName", names[idx])
-        ref_ct_series_uid = rtstruct_dicom[0x3006, 0x10][0][0x3006, 0x12][0][0x3006, 0x14][0][0x20, 0xe].value
-        mask_image_sub.SetMetaData("CTSeriesUID", ref_ct_series_uid)
-        for key in tags:
-            mask_image_sub.SetMetaData(key, tags[key])
-        if names[idx] in masks_of_interest:
-            mask_images.append(mask_image_sub)
-        #If a bowel contour does not exist, create one, but filled with zeros.
-
-    return mask_images
 
+def nearest_slices(z, z_locs):
+    """ Index of the slice of z_locs (evenly spaced, ascending) nearest to each z; the lower one on a tie. """
+    z = np.asarray(z, dtype=float)
+    if len(z_locs) < 3:
+        return np.argmin(np.abs(z_locs[None, :] - z[:, None]), axis=1)
+    spZ = z_locs[1] - z_locs[0]
+    guess = np.clip(np.ceil((z - z_locs[0]) / spZ - 0.5).astype(int), 1, len(z_locs) - 2)
+    # Compare with the neighbours of the guess as the linear search did, so rounding cannot pick another slice
+    candidates = guess[:, None] + np.arange(-1, 2)
+    z_diff = np.abs(z_locs[candidates] - z[:, None])
+    return candidates[np.arange(len(z)), np.argmin(z_diff, axis=1)]
 
 
+def point_in_polygon(r, c, points_r, points_c):
+    """ True for the points inside the polygon (r, c) or on its boundary, as skimage.draw.polygon decides it.
 
+    Crossing test of O'Rourke (Computational Geometry in C, 7), with the float operations of skimage, so that points
+    on an edge or vertex come out the same. Vectorized over the points; used for the few pixels scanline_fill cannot
+    decide from its crossings alone.
+    """
+    x0 = c[None, :] - points_c[:, None]
+    y0 = r[None, :] - points_r[:, None]
+    x1 = np.roll(c, 1)[None, :] - points_c[:, None]
+    y1 = np.roll(r, 1)[None, :] - points_r[:, None]
+    vertex = ((-1e-12 < x0) & (x0 < 1e-12) & (-1e-12 < y0) & (y0 < 1e-12)).any(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing = (x0 * y1 - x1 * y0) / (y1 - y0)
+    right = (((y0 > 0) != (y1 > 0)) & (crossing > 0)).sum(axis=1) & 1
+    left = (((y0 < 0) != (y1 < 0)) & (crossing < 0)).sum(axis=1) & 1
+    return vertex | (right == 1) | (left == 1)
+
+
+def _crossings(r, c, r0, r1):
+    # Crossings of the edges of polygon (r, c) with the integer rows r0 <= row < r1, counted with the half-open rule
+    # of point_in_polygon (edge from vertex i-1 to vertex i crosses the row if exactly one end is above it). Returns
+    # the row of each crossing and its (fractional) column.
+    ri, ci, rj, cj = r, c, np.roll(r, 1), np.roll(c, 1)
+    first = np.maximum(np.ceil(np.minimum(ri, rj)), r0).astype(np.int64)
+    stop = np.minimum(np.ceil(np.maximum(ri, rj)), r1).astype(np.int64)
+    n = np.maximum(stop - first, 0)
+    edge = np.repeat(np.arange(len(n)), n)
+    rows = first[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(n) - n, n)
+    cols = (cj[edge] - ci[edge]) * (rows - ri[edge]) / (rj[edge] - ri[edge]) + ci[edge]
+    return rows, cols
+
+
+def _boundary_pixels(r, c, r0, r1, c0, c1):
+    # Pixels within EDGE_TOLERANCE of an edge or vertex of polygon (r, c), as (row, col) arrays
+    ri, ci, rj, cj = r, c, np.roll(r, 1), np.roll(c, 1)
+    lo, hi = np.minimum(ri, rj), np.maximum(ri, rj)
+    # Rows touched by an edge, ends included
+    first = np.ceil(lo - EDGE_TOLERANCE).astype(np.int64)
+    n = np.maximum(np.floor(hi + EDGE_TOLERANCE).astype(np.int64) - first + 1, 0)
+    edge = np.repeat(np.arange(len(n)), n)
+    rows = first[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(n) - n, n)
+    flat = (hi - lo)[edge] <= EDGE_TOLERANCE
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cols = (cj[edge] - ci[edge]) * (rows - ri[edge]) / (rj[edge] - ri[edge]) + ci[edge]
+    near = ~flat & (np.abs(cols - np.round(cols)) <= EDGE_TOLERANCE)
+    found_r, found_c = [rows[near]], [np.round(cols[near]).astype(np.int64)]
+
+    # Every pixel along edges lying on a row
+    for e in np.flatnonzero(hi - lo <= EDGE_TOLERANCE):
+        row = int(np.round(ri[e]))
+        if abs(ri[e] - row) <= EDGE_TOLERANCE:
+            span = np.arange(np.ceil(min(ci[e], cj[e]) - EDGE_TOLERANCE),
+                             np.floor(max(ci[e], cj[e]) + EDGE_TOLERANCE) + 1)
+            found_r.append(np.full(len(span), row, dtype=np.int64))
+            found_c.append(span.astype(np.int64))
+
+    # Vertices on a pixel
+    on_pixel = (np.abs(r - np.round(r)) <= EDGE_TOLERANCE) & (np.abs(c - np.round(c)) <= EDGE_TOLERANCE)
+    found_r.append(np.round(r[on_pixel]).astype(np.int64))
+    found_c.append(np.round(c[on_pixel]).astype(np.int64))
+
+    rows, cols = np.concatenate(found_r), np.concatenate(found_c)
+    inside = (rows >= r0) & (rows < r1) & (cols >= c0) & (cols < c1)
+    pixels = np.unique(np.stack([rows[inside], cols[inside]]), axis=1)
+    return pixels[0], pixels[1]
+
+
+def scanline_fill(polygons, r0, r1, c0, c1):
+    """ XOR of the fills of polygons over the pixels r0 <= r < r1, c0 <= c < c1 (a contour inside another makes a hole).
+
+    Gives the same pixels as XOR-ing skimage.draw.polygon(r, c) of every polygon, in one even-odd pass over all the
+    edges: for each row, a pixel is inside if an odd number of edge crossings of the row lie after it. Only pixels on
+    (or within EDGE_TOLERANCE of) an edge or vertex, where skimage counts boundary pixels as inside, are tested against
+    their own polygon with point_in_polygon.
+
+    Args
+    ====
+    polygons : list of (r, c)
+        Vertex coordinates (float arrays, in pixels) of each polygon.
+
+    r0, r1, c0, c1 : int
+        Pixel range to fill.
+
+    Returns
+    =======
+    mask : numpy.ndarray (uint8, shape (r1 - r0, c1 - c0))
+    """
+    width = c1 - c0
+    polygons = [(np.asarray(r, dtype=np.float64), np.asarray(c, dtype=np.float64)) for r, c in polygons]
+
+    # Even-odd pass: count the crossings after each pixel of every row, from the cumulative sum of crossings per column
+    crossings = [_crossings(r, c, r0, r1) for r, c in polygons]
+    rows = np.concatenate([rows for rows, cols in crossings]) - r0
+    after = np.clip(np.ceil(np.concatenate([cols for rows, cols in crossings])) - c0, 0, width).astype(np.int64)
+    counts = np.bincount(rows * (width + 1) + after, minlength=(r1 - r0) * (width + 1)).reshape(r1 - r0, width + 1)
+    mask = (np.cumsum(counts[:, ::-1], axis=1)[:, ::-1][:, 1:] & 1).astype(np.uint8)
+
+    # Boundary pixels: the even-odd count of their own polygon is replaced by point_in_polygon
+    for (r, c), (crossing_rows, crossing_cols) in zip(polygons, crossings):
+        pixel_r, pixel_c = _boundary_pixels(r, c, r0, r1, c0, c1)
+        if not len(pixel_r):
+            continue
+        same_row = crossing_rows[None, :] == pixel_r[:, None]
+        counted = ((same_row & (crossing_cols[None, :] > pixel_c[:, None])).sum(axis=1) & 1).astype(bool)
+        flip = counted != point_in_polygon(r, c, pixel_r.astype(np.float64), pixel_c.astype(np.float64))
+        np.bitwise_xor.at(mask, (pixel_r[flip] - r0, pixel_c[flip] - c0), 1)
+    return mask
+
+
+def rasterize_polygons(polygons, size, rasterizer='scanline'):
+    """ Fill the polygons of one structure into a uint8 array the size of its bounding box.
+
+    Each polygon is XOR-ed into its slice, so a contour drawn inside another one on the same slice makes a hole.
+    polygons is a list of (x, y, z_idx) with x and y in (fractional) pixel coordinates. rasterizer is 'scanline' (the
+    contours of each slice are filled together by scanline_fill) or 'skimage' (skimage.draw.polygon, one contour at a
+    time); both give the same box. Returns the (z, y, x) slices of the bounding box within the CT volume and the filled
+    box (None, None for a structure without contours).
+    """
+    if not polygons:
+        return None, None
+    box_z, box_y, box_x = bounding_box(polygons, size)
+    szX, szY, szZ = size
+    box = np.zeros((box_z.stop - box_z.start, box_y.stop - box_y.start, box_x.stop - box_x.start), dtype=np.uint8)
+    if rasterizer == 'skimage':
+        for x, y, z_idx in polygons:
+            rr, cc = polygon(x, y, (szX, szY))
+            box[z_idx - box_z.start, cc - box_y.start, rr - box_x.start] ^= 1
+    elif rasterizer == 'scanline':
+        by_slice = {}
+        for x, y, z_idx in polygons:
+            by_slice.setdefault(z_idx, []).append((x, y))
+        for z_idx, slice_polygons in by_slice.items():
+            # Rows of the fill are x (as for skimage.draw.polygon(x, y)), the box is (z, y, x)
+            fill = scanline_fill(slice_polygons, box_x.start, box_x.stop, box_y.start, box_y.stop)
+            box[z_idx - box_z.start] = fill.T
+    else:
+        raise ValueError('Unknown rasterizer: %s' % rasterizer)
+    return (box_z, box_y, box_x), box
+
+
+def create_rtstruct_masks(rtstruct_dicom, ct_image, masks_of_interest, workers=1, tag_filter=None,
+                          rasterizer='scanline'):
+    """ Convert rtstruct dicom file to sitk images
+
+    Args
+    ====
+    rtstruct_dicom : pydicom.Dataset
+    The loaded RTSTRUCT.dcm file
+
+    ct_image : SimpleITK.Image
+    The CT image on which the RTStruct is defined.
+
+    masks_of_interest : list of str
+    Names of the structures to convert. None converts every structure in the RTSTRUCT.
+
+    workers : int (default = 1)
+    Number of processes rasterizing structures concurrently.
+
+    tag_filter, rasterizer : dict, str
+    See iter_rtstruct_masks.
+
+    Return
+    ======
+    masks : list
+    A list of SimpleITK.Image instances for the masks. Use iter_rtstruct_masks instead to handle the masks one at a
+    time without keeping all of them in memory.
+
+    """
+    return list(iter_rtstruct_masks(rtstruct_dicom, ct_image, masks_of_interest, workers=workers,
+                                    tag_filter=tag_filter, rasterizer=rasterizer))
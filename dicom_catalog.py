@@ -0,0 +1,256 @@
+import os
+import json
+import sqlite3
+import sys
+sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
+from dicom_indexer import INDEX_VERSION, list_dicom_files, scan_dicom_headers, build_series_table, \
+    index_dicom_directory
+
+'''Persistent SQLite catalog of dicom exports.
+
+Every file of an export directory is stored once (keyed by path, size and mtime) with the header facts read by
+dicom_indexer, together with the series it belongs to and the series/RTSTRUCT it references (REG -> CBCT series,
+RTSTRUCT -> CT series, RTPLAN -> RTSTRUCT). Rescanning a directory only re-reads files that are new or changed since
+the last scan, and rows of files that have disappeared are dropped.
+
+Typical use:
+    conn = open_catalog('/Users/sblackledge/Documents/GENIUSII_exports/catalog.sqlite')
+    update_catalog(conn, 'g05', '/Users/sblackledge/Documents/GENIUSII_exports/RayStation/g05/RayStation_CTdump')
+    cbcts = cbct_series_with_reg(conn, 'g05')
+    ref_ct = rtstruct_reference_ct(conn, 'g05')
+
+The converters given a catalog_path take their work list (approved RTSTRUCT, REG files of the CBCTs) from these queries
+through catalog_work_list.
+'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    patient TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    index_version INTEGER NOT NULL,
+    sop_uid TEXT,
+    series_uid TEXT,
+    study_uid TEXT,
+    modality TEXT,
+    content_date TEXT,
+    ref_series_uid TEXT,
+    ref_sop_uid TEXT,
+    approval_status TEXT,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_patient ON files (patient, directory, modality);
+CREATE INDEX IF NOT EXISTS files_series ON files (series_uid);
+CREATE INDEX IF NOT EXISTS files_sop ON files (sop_uid);
+
+CREATE TABLE IF NOT EXISTS series (
+    patient TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    series_uid TEXT NOT NULL,
+    modality TEXT,
+    study_uid TEXT,
+    content_date TEXT,
+    series_description TEXT,
+    rows INTEGER,
+    columns INTEGER,
+    n_files INTEGER,
+    PRIMARY KEY (patient, directory, series_uid)
+);
+'''
+
+
+def open_catalog(db_path):
+    """ Open (and create if needed) the catalog at db_path. Returns a sqlite3.Connection. """
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')  # several patients can be catalogued concurrently
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _row_values(patient_name, directory, stat, record):
+    return (record['path'], patient_name, directory, stat.st_size, stat.st_mtime_ns, INDEX_VERSION,
+            record['sop_uid'], record['series_uid'], record['study_uid'], record['modality'], record['content_date'],
+            record['ref_series_uid'], record['ref_sop_uid'], record['approval_status'], json.dumps(record))
+
+
+def update_catalog(conn, patient_name, export_dir, workers=None):
+    """ Bring the catalog up to date with the files currently in export_dir.
+
+    Args
+    ====
+    conn : sqlite3.Connection (from open_catalog)
+
+    patient_name : str
+        e.g. 'g05'
+
+    export_dir : str
+        Full file path to the dicom dump of this patient.
+
+    workers : int (default = None)
+        Number of processes used to read the headers of new/changed files (see dicom_indexer.scan_dicom_headers).
+
+    Returns
+    =======
+    counts : dict
+        Number of 'added', 'changed', 'removed' and 'unchanged' files.
+    """
+    directory = os.path.abspath(export_dir)
+    known = {row['path']: (row['size'], row['mtime_ns'], row['index_version']) for row in conn.execute(
+        'SELECT path, size, mtime_ns, index_version FROM files WHERE patient = ? AND directory = ?',
+        (patient_name, directory))}
+
+    counts = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
+    stats = {}
+    to_scan = []
+    for fpath in list_dicom_files(directory):
+        stat = os.stat(fpath)
+        stats[fpath] = stat
+        if fpath not in known:
+            counts['added'] += 1
+            to_scan.append(fpath)
+        elif known[fpath] != (stat.st_size, stat.st_mtime_ns, INDEX_VERSION):
+            counts['changed'] += 1
+            to_scan.append(fpath)
+        else:
+            counts['unchanged'] += 1
+
+    removed = [fpath for fpath in known if fpath not in stats]
+    counts['removed'] = len(removed)
+
+    records = scan_dicom_headers(to_scan, workers=workers)
+
+    with conn:
+        conn.executemany('DELETE FROM files WHERE path = ?', [(fpath,) for fpath in removed])
+        conn.executemany('INSERT OR REPLACE INTO files VALUES (%s)' % ', '.join(['?'] * 15),
+                         [_row_values(patient_name, directory, stats[record['path']], record) for record in records])
+        if records or removed:
+            _refresh_series(conn, patient_name, directory)
+
+    return counts
+
+
+def _refresh_series(conn, patient_name, directory):
+    # Rebuild the per-series summary of one export directory from its file rows
+    table = build_series_table(_records(conn, patient_name, directory))
+    conn.execute('DELETE FROM series WHERE patient = ? AND directory = ?', (patient_name, directory))
+    conn.executemany('INSERT INTO series VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+        (patient_name, directory, uid, s['modality'], s['study_uid'], s['content_date'], s['series_description'],
+         s['rows'], s['columns'], len(s['files'])) for uid, s in table['series'].items()])
+
+
+def _records(conn, patient_name, directory=None):
+    if directory is None:
+        rows = conn.execute('SELECT record FROM files WHERE patient = ?', (patient_name,))
+    else:
+        rows = conn.execute('SELECT record FROM files WHERE patient = ? AND directory = ?',
+                            (patient_name, os.path.abspath(directory)))
+    return [json.loads(row['record']) for row in rows]
+
+
+def catalog_series_table(conn, patient_name, export_dir=None):
+    """ The dicom_indexer series table of a patient (optionally restricted to one export directory), rebuilt from
+    the catalog without touching the dicom files. """
+    return build_series_table(_records(conn, patient_name, export_dir))
+
+
+def load_series_table(ct_directory, patient_name, catalog_path=None, workers=None):
+    """ Series table for the converters: a fresh index of ct_directory, or, if catalog_path is given, an incremental
+    rescan of ct_directory into the catalog followed by a read back from it. """
+    if catalog_path is None:
+        return index_dicom_directory(ct_directory, workers=workers)
+
+    conn = open_catalog(catalog_path)
+    try:
+        update_catalog(conn, patient_name, ct_directory, workers=workers)
+        return catalog_series_table(conn, patient_name, ct_directory)
+    finally:
+        conn.close()
+
+
+def _directory_filter(alias, export_dir):
+    # SQL condition (and parameters) restricting the files of alias to one export directory, if given
+    if export_dir is None:
+        return '', ()
+    return ' AND %s.directory = ?' % alias, (os.path.abspath(export_dir),)
+
+
+def cbct_series_with_reg(conn, patient_name, export_dir=None):
+    """ All image series of a patient (optionally in one export directory) that are registered by a REG file (i.e. the
+    CBCTs), oldest first.
+
+    Returns
+    =======
+    cbcts : list of dict
+        series_uid, content_date, n_files, plus reg_path, reg_matrix and reg (the index record) of the REG file.
+    """
+    condition, params = _directory_filter('f', export_dir)
+    rows = conn.execute('''
+        SELECT s.series_uid, s.content_date, s.n_files, f.path AS reg_path, f.record AS reg_record
+        FROM files f JOIN series s ON s.series_uid = f.ref_series_uid AND s.patient = f.patient
+                                      AND s.directory = f.directory
+        WHERE f.patient = ? AND f.modality = 'REG'%s
+        ORDER BY s.content_date, s.series_uid''' % condition, (patient_name,) + params)
+
+    cbcts = []
+    for row in rows:
+        reg = json.loads(row['reg_record'])
+        cbcts.append({'series_uid': row['series_uid'], 'content_date': row['content_date'], 'n_files': row['n_files'],
+                      'reg_path': row['reg_path'], 'reg_matrix': reg['reg_matrix'], 'reg': reg})
+    return cbcts
+
+
+def approved_rtstruct(conn, patient_name, export_dir=None):
+    """ Index record of the approved RTSTRUCT of a patient (optionally in one export directory), or None.
+
+    The approved structure set is the one referenced by an RTPLAN (Clarity exports), otherwise the one with
+    ApprovalStatus APPROVED, otherwise (like series_table['rtstruct'][-1] without a catalog) the most recent RTSTRUCT
+    in the export. When several match, the one with the latest content date (then the last path) is taken.
+    """
+    condition, params = _directory_filter('f', export_dir)
+    order = ' ORDER BY f.content_date, f.path'
+    rows = conn.execute('''
+        SELECT f.record FROM files f JOIN files p ON p.ref_sop_uid = f.sop_uid AND p.patient = f.patient
+        WHERE f.patient = ? AND f.modality = 'RTSTRUCT' AND p.modality = 'RTPLAN'%s%s''' % (condition, order),
+                        (patient_name,) + params).fetchall()
+    if not rows:
+        rows = conn.execute('''SELECT f.record FROM files f WHERE f.patient = ? AND f.modality = 'RTSTRUCT'
+                               AND f.approval_status = 'APPROVED'%s%s''' % (condition, order),
+                            (patient_name,) + params).fetchall()
+    if not rows:
+        rows = conn.execute('''SELECT f.record FROM files f WHERE f.patient = ? AND f.modality = 'RTSTRUCT'%s%s'''
+                            % (condition, order), (patient_name,) + params).fetchall()
+    return json.loads(rows[-1]['record']) if rows else None
+
+
+def rtstruct_reference_ct(conn, patient_name, export_dir=None):
+    """ Series row (as a dict) of the CT referenced by the approved RTSTRUCT of a patient, or None. """
+    rtstruct = approved_rtstruct(conn, patient_name, export_dir)
+    if rtstruct is None:
+        return None
+    condition, params = _directory_filter('s', export_dir)
+    row = conn.execute('SELECT * FROM series s WHERE s.patient = ? AND s.series_uid = ?%s' % condition,
+                       (patient_name, rtstruct['ref_series_uid']) + params).fetchone()
+    return dict(row) if row is not None else None
+
+
+def catalog_work_list(catalog_path, patient_name, export_dir=None):
+    """ Work list of a converter from the catalog queries.
+
+    Returns
+    =======
+    rtstruct : dict
+        Index record of the approved RTSTRUCT (approved_rtstruct), None if the export holds no RTSTRUCT.
+
+    regs : list of dict
+        Index records of the REG files of the registered CBCTs, oldest CBCT first (cbct_series_with_reg).
+    """
+    conn = open_catalog(catalog_path)
+    try:
+        rtstruct = approved_rtstruct(conn, patient_name, export_dir)
+        regs = [cbct['reg'] for cbct in cbct_series_with_reg(conn, patient_name, export_dir)]
+        return rtstruct, regs
+    finally:
+        conn.close()
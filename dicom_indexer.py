@@ -0,0 +1,210 @@
+import os
+import numpy as np
+import pydicom as dicom
+from concurrent.futures import ProcessPoolExecutor
+
+'''Builds a series table for a directory of DICOM files (e.g. a RayStation or Clarity dump) in a single pass.
+
+Only the tags listed in INDEX_TAGS are parsed from each file, each file is read exactly once, and the files are spread
+over a process pool. The facts needed later on (referenced series of RTSTRUCT and REG files, the REG matrix, the
+structure set referenced by an RTPLAN) are extracted while the file is open, so nothing has to be re-read afterwards.
+
+Output (series table): dict with keys
+    1. 'series': dict of image series keyed by SeriesInstanceUID. Each entry holds the modality, study uid, content and
+    study dates, series description, rows/columns, orientation ('iop') and 'pixel_spacing', and the 'files',
+    'sop_uids', 'z' and 'ipp' lists sorted by ascending slice location.
+    2. 'rtstruct', 'reg', 'rtplan': lists of per-file records (see read_index_record) for the non-image objects.
+'''
+
+# Bump whenever the contents of a record change, so persisted indexes know to re-read their files.
+INDEX_VERSION = 3
+
+# The only tags parsed from each file
+INDEX_TAGS = [
+    'SOPInstanceUID',
+    'SeriesInstanceUID',
+    'StudyInstanceUID',
+    'Modality',
+    'ContentDate',
+    'StudyDate',
+    'SeriesDescription',
+    'ImagePositionPatient',
+    'ImageOrientationPatient',
+    'PixelSpacing',
+    'Rows',
+    'Columns',
+    'ReferencedFrameOfReferenceSequence',  # RTSTRUCT -> referenced CT series
+    'ReferencedSeriesSequence',  # REG -> registered (CBCT) series
+    'RegistrationSequence',  # REG -> transformation matrix
+    'ReferencedStructureSetSequence',  # RTPLAN -> approved RTSTRUCT
+    'ApprovalStatus',  # RTSTRUCT approval (RayStation)
+]
+INDEX_TAG_NUMBERS = [dicom.tag.Tag(keyword) for keyword in INDEX_TAGS]
+
+NON_IMAGE_MODALITIES = {'RTSTRUCT': 'rtstruct', 'REG': 'reg', 'RTPLAN': 'rtplan'}
+
+
+def read_index_record(dicom_path):
+    """ Read the indexed tags of a single dicom file.
+
+    Args
+    ====
+    dicom_path : str
+        Full file path to the dicom file.
+
+    Returns
+    =======
+    record : dict
+        Plain python values only (so it can be sent back from a worker process). 'z' is the slice location of image
+        files ('ipp', 'iop' and 'pixel_spacing' their ImagePositionPatient, ImageOrientationPatient and PixelSpacing),
+        'ref_series_uid' the series referenced by an RTSTRUCT/REG, 'ref_sop_uid' the RTSTRUCT referenced by an
+        RTPLAN, 'reg_matrix' the 16 element FrameOfReferenceTransformationMatrix of a REG and 'approval_status' the
+        ApprovalStatus of an RTSTRUCT.
+    """
+    dcm = dicom.dcmread(dicom_path, stop_before_pixels=True, specific_tags=INDEX_TAG_NUMBERS)
+    modality = str(dcm.get('Modality', ''))
+
+    record = {
+        'path': dicom_path,
+        'sop_uid': str(dcm.get('SOPInstanceUID', '')),
+        'series_uid': str(dcm.get('SeriesInstanceUID', '')),
+        'study_uid': str(dcm.get('StudyInstanceUID', '')),
+        'modality': modality,
+        'content_date': str(dcm.get('ContentDate', '')),
+        'study_date': str(dcm.get('StudyDate', '')),
+        'series_description': str(dcm.get('SeriesDescription', '')),
+        'z': None,
+        'ipp': None,
+        'iop': None,
+        'pixel_spacing': None,
+        'rows': None,
+        'columns': None,
+        'ref_series_uid': None,
+        'ref_sop_uid': None,
+        'reg_matrix': None,
+        'approval_status': str(dcm.get('ApprovalStatus', '')),
+    }
+
+    if 'ImagePositionPatient' in dcm:
+        record['z'] = float(dcm.ImagePositionPatient[-1])
+        record['ipp'] = [float(v) for v in dcm.ImagePositionPatient]
+        if 'ImageOrientationPatient' in dcm:
+            record['iop'] = [float(v) for v in dcm.ImageOrientationPatient]
+        if 'PixelSpacing' in dcm:
+            record['pixel_spacing'] = [float(v) for v in dcm.PixelSpacing]
+        record['rows'] = int(dcm.get('Rows', 0))
+        record['columns'] = int(dcm.get('Columns', 0))
+
+    if modality == 'RTSTRUCT':
+        record['ref_series_uid'] = str(dcm[0x3006, 0x10][0][0x3006, 0x12][0][0x3006, 0x14][0][0x20, 0xe].value)
+
+    if modality == 'REG':
+        record['ref_series_uid'] = str(dcm.ReferencedSeriesSequence[-1].SeriesInstanceUID)
+        matrix = dcm.RegistrationSequence[1].MatrixRegistrationSequence[0].MatrixSequence[0]
+        record['reg_matrix'] = [float(v) for v in matrix.FrameOfReferenceTransformationMatrix]
+
+    if modality == 'RTPLAN':
+        record['ref_sop_uid'] = str(dcm[0x300c, 0x0060][0][0x0008, 0x1155].value)
+
+    return record
+
+
+def list_dicom_files(ct_directory):
+    # Every file in the dump except macOS folder metadata
+    return [os.path.join(ct_directory, fl) for fl in sorted(os.listdir(ct_directory)) if fl != '.DS_Store']
+
+
+def scan_dicom_headers(dicom_paths, workers=None):
+    """ Read the index records of many files, fanning out over a process pool.
+
+    Args
+    ====
+    dicom_paths : list of str
+
+    workers : int (default = None)
+        Number of worker processes. None uses os.cpu_count(); 1 reads in the calling process.
+
+    Returns
+    =======
+    records : list of dict, in the same order as dicom_paths
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(dicom_paths) < 2:
+        return [read_index_record(fl) for fl in dicom_paths]
+
+    chunksize = max(1, len(dicom_paths) // (workers * 8))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(read_index_record, dicom_paths, chunksize=chunksize))
+
+
+def build_series_table(records):
+    """ Group index records into the series table described at the top of this module. """
+    table = {'series': {}, 'rtstruct': [], 'reg': [], 'rtplan': []}
+    slices = {}
+
+    for record in records:
+        if record['modality'] in NON_IMAGE_MODALITIES:
+            table[NON_IMAGE_MODALITIES[record['modality']]].append(record)
+            continue
+        if record['z'] is None:
+            continue
+
+        series_uid = record['series_uid']
+        if series_uid not in slices:
+            slices[series_uid] = []
+            table['series'][series_uid] = {
+                'series_uid': series_uid,
+                'modality': record['modality'],
+                'study_uid': record['study_uid'],
+                'content_date': record['content_date'],
+                'study_date': record['study_date'],
+                'series_description': record['series_description'],
+                'rows': record['rows'],
+                'columns': record['columns'],
+                'iop': record['iop'],
+                'pixel_spacing': record['pixel_spacing'],
+            }
+        slices[series_uid].append(record)
+
+    # Now organise files in each series by ascending slice location
+    for series_uid, series_records in slices.items():
+        z = np.array([record['z'] for record in series_records])
+        order = np.argsort(z, kind='stable')
+        series = table['series'][series_uid]
+        series['files'] = [series_records[i]['path'] for i in order]
+        series['sop_uids'] = [series_records[i]['sop_uid'] for i in order]
+        series['z'] = z[order].tolist()
+        series['ipp'] = [series_records[i]['ipp'] for i in order]
+
+        # The first slice (in slice order) provides the dates, like the first dataset did in the converters
+        series['content_date'] = series_records[order[0]]['content_date']
+        series['study_date'] = series_records[order[0]]['study_date']
+
+    return table
+
+
+def series_voxels(series):
+    """ Number of voxels of a series of the table (rows x columns x slices), a measure of the cost of converting it. """
+    return (series['rows'] or 0) * (series['columns'] or 0) * len(series['files'])
+
+
+def series_file_count(table):
+    """ Number of files in a series table (image slices and non-image objects). """
+    return (sum(len(series['files']) for series in table['series'].values())
+            + sum(len(table[key]) for key in NON_IMAGE_MODALITIES.values()))
+
+
+def index_dicom_directory(ct_directory, workers=None):
+    """ Index every dicom file in ct_directory and return the series table.
+
+    Args
+    ====
+    ct_directory : str
+        Full file path to the dicom dump (e.g. RayStation_CTdump or DICOMRawData).
+
+    workers : int (default = None)
+        Number of worker processes used for reading headers (see scan_dicom_headers).
+    """
+    records = scan_dicom_headers(list_dicom_files(ct_directory), workers=workers)
+    return build_series_table(records)
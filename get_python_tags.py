@@ -1,4 +1,45 @@
-def get_dicom_tags(dcm, ignore_private=True, ignore_groups=()):
+import threading
+from collections import OrderedDict
+from pydicom.tag import Tag
+from pydicom.sequence import Sequence
+
+'''Dicom tags of a dataset as the string metadata stored on the sitk images (and from there in the mask json files).
+
+get_dicom_tags stringifies the elements of a dataset. Which elements are kept can be declared up front: a whitelist
+(include, only those elements are looked at), a denylist (exclude), private tags and whole groups, and the depth of
+the sequences kept (the str() of a sequence is the str() of every nested item, the most expensive part).
+
+The converters copy the tags of the first slice of a series onto every image made from that series (the CT, each
+resampled CBCT, every mask). cached_dicom_tags stringifies a dataset once and returns the same dict for every later
+call with the same dataset (SOPInstanceUID) and options, and apply_dicom_tags sets a dict of tags on any number of
+images:
+    tags = cached_dicom_tags(ref_ct_header, ignore_private=True)
+    apply_dicom_tags([ct_image, cbct_image_1, cbct_image_2], tags)
+'''
+
+# Datasets (and option sets) whose tags are kept by cached_dicom_tags
+TAG_CACHE_SIZE = 64
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _as_tag(key):
+    # 'gggg,eeee' (the metadata key format), a keyword ('StudyDate'), an int or a (group, element) pair
+    if isinstance(key, str) and ',' in key:
+        group, element = key.split(',')
+        return Tag(int(group, 16), int(element, 16))
+    return Tag(key)
+
+
+def sequence_depth(value):
+    """ Nesting depth of the sequences in an element value: 0 for a plain value, 1 for a sequence of plain items... """
+    if not isinstance(value, Sequence):
+        return 0
+    return 1 + max((sequence_depth(item[key].value) for item in value for key in item.keys()), default=0)
+
+
+def get_dicom_tags(dcm, ignore_private=True, ignore_groups=(), include=None, exclude=(), max_sequence_depth=None):
     """ Return a dictionary of all Dicom tags in an input dicom instance.
 
     Args
@@ -12,19 +53,72 @@ def get_dicom_tags(dcm, ignore_private=True, ignore_groups=()):
     ignore_groups : list (default = ())
         Ignore these dicom groups in the output
 
+    include : list (default = None, every tag)
+        Only these tags ('gggg,eeee' strings, keywords such as 'StudyDate', ints or (group, element) pairs). Tags
+        missing from dcm are left out.
+
+    exclude : list (default = ())
+        Leave these tags out (same formats as include).
+
+    max_sequence_depth : int (default = None, no limit)
+        Leave out sequences nested deeper than this (0 leaves out every sequence, 1 keeps sequences whose items hold
+        no sequence...).
+
     Returns
     =======
     results : dict
         A dictionary containing the tags.
     """
+    exclude = {_as_tag(key) for key in exclude}
+    keys = list(dcm.keys()) if include is None else [_as_tag(key) for key in include]
     tags = {}
-    for key in list(dcm.keys()):
+    for key in keys:
         g = key.group
         if g % 2 == 1 and ignore_private == True:
             continue # private tag
-        if g in ignore_groups:
+        if g in ignore_groups or key in exclude or key not in dcm:
+            continue
+        value = dcm[key].value
+        if max_sequence_depth is not None and sequence_depth(value) > max_sequence_depth:
             continue
         e = key.element
         key_string = "%04x,%04x" % (g, e) # use e.g. int("000a", 16) to convert back to long.
-        tags[key_string] = str(dcm[key].value)
-    return tags
\ No newline at end of file
+        tags[key_string] = str(value)
+    return tags
+
+
+def cached_dicom_tags(dcm, ignore_private=True, ignore_groups=(), include=None, exclude=(), max_sequence_depth=None):
+    """ get_dicom_tags, stringifying each dataset only once.
+
+    Datasets are recognised by their SOPInstanceUID (a dataset without one is not cached). The same dict is returned to
+    every caller, so it must not be modified.
+    """
+    # Tags normalised through _as_tag: filters loaded from json hold [group, element] lists, which are not hashable
+    include = None if include is None else tuple(_as_tag(key) for key in include)
+    options = (ignore_private, tuple(ignore_groups), include, tuple(_as_tag(key) for key in exclude),
+               max_sequence_depth)
+    sop_uid = dcm.get('SOPInstanceUID')
+    if sop_uid is None:
+        return get_dicom_tags(dcm, *options)
+    key = (str(sop_uid), options)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    tags = get_dicom_tags(dcm, *options)
+    with _cache_lock:
+        _cache[key] = tags
+        while len(_cache) > TAG_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return tags
+
+
+def apply_dicom_tags(sitk_images, tags):
+    """ Set every tag of tags (from get_dicom_tags) as metadata of each image (a SimpleITK.Image or a list of them). """
+    if not isinstance(sitk_images, (list, tuple)):
+        sitk_images = [sitk_images]
+    items = list(tags.items())
+    for image in sitk_images:
+        set_metadata = image.SetMetaData
+        for key, value in items:
+            set_metadata(key, value)
@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+
+'''Per-stage timing, throughput and memory records of a run, written as a json-lines run log.
+
+The converters, create_rtstruct_mask_SB, compound_create and nifti_to_dicom wrap each step of their work (header scan,
+reading a series, resampling, rasterizing a structure, writing a nifti, ...) in stage(). With a run log configured,
+every stage appends one json line to it when it ends:
+
+    {"stage": "read_series", "patient": "g02", "series_uid": "1.2...", "pid": 4242, "thread": "MainThread",
+     "start": 1700000000.0, "seconds": 1.82, "files": 120, "bytes": 62914560, "files_per_s": 65.9, "mb_per_s": 34.6,
+     "max_rss_mb": 812.4}
+
+files and bytes are what the stage reports with add() (files read or written, bytes of image data); max_rss_mb is the
+high-water mark of the resident memory of the process when the stage ended. With memory=True, tracemalloc also runs and
+peak_traced_mb is the peak of python/numpy allocations since the outermost running stage started (SimpleITK buffers
+are not traced). A stage that raises is recorded with an "error" field.
+
+Without a run log, stage() returns a shared object that does nothing, so the instrumented code runs as before.
+
+The run log is set with the GENIUSII_RUN_LOG environment variable (GENIUSII_RUN_LOG_MEMORY=1 for tracemalloc), or
+with configure_run_log, which also sets the variables so worker processes log to the same file:
+    configure_run_log('/Users/sblackledge/Documents/GENIUSII_exports/run_log.jsonl')
+    DICOMRawData_to_nifti(...)
+    python instrumentation.py run_log.jsonl  # totals per stage
+'''
+
+RUN_LOG_ENV = 'GENIUSII_RUN_LOG'
+RUN_LOG_MEMORY_ENV = 'GENIUSII_RUN_LOG_MEMORY'
+
+_log = {'path': None, 'file': None, 'memory': False}
+_lock = threading.Lock()
+_active = [0]  # stages running (any thread), so the tracemalloc peak is only reset by the outermost one
+
+
+def max_rss_mb():
+    """ High-water mark of the resident memory of this process (MB), None where unavailable. """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1e6 if sys.platform == 'darwin' else rss / 1e3  # bytes on macOS, kB on linux
+
+
+def image_bytes(image):
+    """ Size of the pixel data of a SimpleITK image. """
+    return image.GetNumberOfPixels() * image.GetNumberOfComponentsPerPixel() * image.GetSizeOfPixelComponent()
+
+
+def configure_run_log(path, memory=False):
+    """ Append stage records to path (None turns the run log off).
+
+    Args
+    ====
+    path : str
+        json-lines file, created if needed; records of earlier runs are kept.
+
+    memory : bool (default = False)
+        Also record the tracemalloc peak of each stage (slows python allocations down).
+    """
+    with _lock:
+        if _log['file'] is not None:
+            _log['file'].close()
+        _log.update(path=path, file=None, memory=bool(path) and memory)
+    if path is None:
+        os.environ.pop(RUN_LOG_ENV, None)
+        os.environ.pop(RUN_LOG_MEMORY_ENV, None)
+    else:
+        os.environ[RUN_LOG_ENV] = path
+        os.environ[RUN_LOG_MEMORY_ENV] = '1' if memory else '0'
+    if _log['memory'] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def run_log_enabled():
+    return _log['path'] is not None
+
+
+def _write_record(record):
+    line = json.dumps(record) + '\n'
+    with _lock:
+        if _log['path'] is None:
+            return
+        if _log['file'] is None:
+            # Line buffered and in append mode: each record is a single write, so processes sharing the log do not
+            # interleave within a line
+            _log['file'] = open(_log['path'], 'a', buffering=1)
+        _log['file'].write(line)
+
+
+class _NullStage:
+    # What stage() returns when there is no run log
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def add(self, files=0, bytes=0):
+        pass
+
+    def set(self, **fields):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+
+    def __init__(self, name, fields):
+        self.record = dict(fields, stage=name)
+        self.files = 0
+        self.bytes = 0
+
+    def add(self, files=0, bytes=0):
+        """ Count files and bytes processed by the stage (for files_per_s and mb_per_s). """
+        self.files += files
+        self.bytes += bytes
+
+    def set(self, **fields):
+        """ Add fields to the record of the stage. """
+        self.record.update(fields)
+
+    def __enter__(self):
+        if _log['memory']:
+            with _lock:
+                _active[0] += 1
+                if _active[0] == 1 and tracemalloc.is_tracing():
+                    tracemalloc.reset_peak()
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.t0
+        record = self.record
+        record.update(pid=os.getpid(), thread=threading.current_thread().name, start=self.start, seconds=seconds)
+        if self.files:
+            record.update(files=self.files, files_per_s=self.files / seconds if seconds > 0 else None)
+        if self.bytes:
+            record.update(bytes=self.bytes, mb_per_s=self.bytes / 1e6 / seconds if seconds > 0 else None)
+        record['max_rss_mb'] = max_rss_mb()
+        if _log['memory']:
+            if tracemalloc.is_tracing():
+                record['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+            with _lock:
+                _active[0] -= 1
+        if exc_type is not None:
+            record['error'] = repr(exc)
+        _write_record(record)
+        return False
+
+
+def stage(name, **fields):
+    """ Context manager timing one stage of the run (a no-op without a run log).
+
+    Args
+    ====
+    name : str
+        Stage name, e.g. 'header_scan', 'read_series', 'resample', 'write_nifti'.
+
+    **fields
+        Extra json fields of the record (patient, series_uid, structure, ...).
+
+    Typical use:
+        with stage('read_series', patient=patient_name, series_uid=uid) as s:
+            image = read_series_volume(series)
+            s.add(files=len(series['files']), bytes=image_bytes(image))
+    """
+    if _log['path'] is None:
+        return _NULL_STAGE
+    return _Stage(name, fields)
+
+
+def read_run_log(path):
+    """ The records of a run log, in the order they were written. """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize_run_log(records):
+    """ Totals per stage: number of records, seconds, files and bytes, and the highest max_rss_mb/peak_traced_mb. """
+    summary = {}
+    for record in records:
+        total = summary.setdefault(record['stage'], {'count': 0, 'seconds': 0., 'files': 0, 'bytes': 0, 'errors': 0,
+                                                     'max_rss_mb': None, 'peak_traced_mb': None})
+        total['count'] += 1
+        total['seconds'] += record['seconds']
+        total['files'] += record.get('files', 0)
+        total['bytes'] += record.get('bytes', 0)
+        total['errors'] += 'error' in record
+        for key in ('max_rss_mb', 'peak_traced_mb'):
+            if record.get(key) is not None:
+                total[key] = max(total[key] or 0., record[key])
+    return summary
+
+
+def _reset_after_fork():
+    # The parent's file object and lock are not safe to use in a forked worker; it reopens the log itself
+    global _lock
+    _lock = threading.Lock()
+    _log['file'] = None
+    _active[0] = 0
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+if os.environ.get(RUN_LOG_ENV):
+    configure_run_log(os.environ[RUN_LOG_ENV], memory=os.environ.get(RUN_LOG_MEMORY_ENV, '0') == '1')
+
+
+if __name__ == '__main__':
+    summary = summarize_run_log(read_run_log(sys.argv[1]))
+    print('%-24s %6s %10s %8s %10s %10s %10s' % ('stage', 'count', 'seconds', 'files', 'MB', 'MB/s', 'max RSS MB'))
+    for name, total in sorted(summary.items(), key=lambda item: -item[1]['seconds']):
+        mb = total['bytes'] / 1e6
+        print('%-24s %6d %10.2f %8d %10.1f %10s %10s' % (
+            name, total['count'], total['seconds'], total['files'], mb,
+            '%.1f' % (mb / total['seconds']) if total['seconds'] > 0 and mb else '-',
+            '%.0f' % total['max_rss_mb'] if total['max_rss_mb'] is not None else '-'))
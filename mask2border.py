@@ -3,6 +3,54 @@ import SimpleITK as sitk
 import cv2 as cv
 import matplotlib.pyplot as plt
 import os
+from concurrent.futures import ProcessPoolExecutor
+import sys
+sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
+from nifti_writer import write_nifti
+
+''' In-plane (axial) border of every slice of a mask volume at once: the mask pixels that have a background pixel (or
+the edge of the slice) among their 4 in-plane neighbours, i.e. mask XOR (mask eroded with a cross). This is exactly the
+set of pixels cv.findContours (RETR_TREE, CHAIN_APPROX_NONE) + cv.drawContours (thickness 1) mark on each slice, outer
+borders and hole borders alike.
+
+inputs:
+    1. mask_array: 3D numpy array (z, y, x); non-zero inside the mask
+outputs:
+    1. border_array: uint8 array of the same shape, 255 on the border and 0 elsewhere
+     '''
+
+def border_array(mask_array):
+    mask = mask_array != 0
+    interior = mask.copy()
+    interior[:, 1:, :] &= mask[:, :-1, :]
+    interior[:, :-1, :] &= mask[:, 1:, :]
+    interior[:, :, 1:] &= mask[:, :, :-1]
+    interior[:, :, :-1] &= mask[:, :, 1:]
+    # Pixels on the edge of a slice border the (zero) outside of the image
+    interior[:, 0, :] = False
+    interior[:, -1, :] = False
+    interior[:, :, 0] = False
+    interior[:, :, -1] = False
+
+    mask &= ~interior
+    del interior
+    return mask.view(np.uint8) * np.uint8(255)
+
+''' Same as border_array, slice by slice with opencv contours (the original implementation, kept for comparison). '''
+
+def border_array_opencv(mask_array):
+    im_dims = mask_array.shape
+
+    #Preallocate 3D array
+    contours_3D_ax = np.zeros(im_dims, dtype=np.uint8)
+
+    #Populate array with contour version of mask (slice by slice - axial)
+    for i in range(im_dims[0]):
+        test_slice = np.ascontiguousarray(mask_array[i,:, :], dtype=np.uint8)
+        contours = cv.findContours(test_slice, cv.RETR_TREE, cv.CHAIN_APPROX_NONE)[-2]  # opencv 3 and 4+ return values
+        drawing = np.zeros((test_slice.shape), dtype=np.uint8)
+        contours_3D_ax[i, :, :] = cv.drawContours(drawing, contours, -1, 255, 1)
+    return contours_3D_ax
 
 ''' Converts user-specified nifti mask into border. Saves as separate nifti file with same name as mask, but in different
 subdirectory.
@@ -12,30 +60,29 @@ inputs:
     Example: fpath_nii = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/masks/g01/PTV45_1.nii'
     2. save_dir: str - full filepath to directory where border nifti file should be saved.
     Example: save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/contours/g01'.
+    3. method: str - 'morphology' (default, whole volume at once, see border_array) or 'opencv' (slice by slice, see
+    border_array_opencv). Both give the same uint8 (0/255) border.
+outputs:
+    1. savepath: full filepath of the border nifti file
      '''
 
-def mask2border(fpath_nii, save_dir):
+def mask2border(fpath_nii, save_dir, method='morphology'):
     orig_mask_sitk = sitk.ReadImage(fpath_nii)
-    mask_array = sitk.GetArrayFromImage(orig_mask_sitk)
-    im_dims = mask_array.shape
-
-    #Preallocate 3D array
-    contours_3D_ax = np.zeros(im_dims)
-
-    #Populate array with contour version of mask (slice by slice - axial). Also find sup and inf- most slices
-    for i in range(im_dims[0]):
-        test_slice = mask_array[i,:, :]
-        im, contours, hierarchy = cv.findContours(test_slice, cv.RETR_TREE, cv.CHAIN_APPROX_NONE)
-        drawing = np.zeros((test_slice.shape))
-        test2 = cv.drawContours(drawing, contours, -1, (255, 0, 0), 1)
-        contours_3D_ax[i, :, :] = test2
+    mask_array = sitk.GetArrayViewFromImage(orig_mask_sitk)
+    if method == 'morphology':
+        contours_3D_ax = border_array(mask_array)
+    elif method == 'opencv':
+        contours_3D_ax = border_array_opencv(mask_array)
+    else:
+        raise ValueError("method must be 'morphology' or 'opencv'")
 
     #Save border-only mask as nifti
     fname = os.path.split(fpath_nii)[1]
     contour_im = sitk.GetImageFromArray(contours_3D_ax)
     contour_im.CopyInformation(orig_mask_sitk)
     savepath = os.path.join(save_dir, fname)
-    sitk.WriteImage(contour_im, savepath, True)
+    write_nifti(contour_im, savepath)
+    return savepath
 
 ''' Loops through all user-specified masks for an individual patient to create border versions for visualisation in ITK-SNAP.
 inputs:
@@ -46,19 +93,50 @@ inputs:
         Example: save_dir = save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/contours'
     4. source_dir: str - full path to directory where mask nifti files have been saved (output from dcmDump_to_nifti).
         Example: source_dir ='/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/masks'
+    5. workers: int - number of processes converting structures concurrently (default: 1)
+    6. extension: str - file extension of the mask files (default: '.nii')
         '''
 
-def convert_selected_masks_to_borders(structure_list, patient_name, save_dir, source_dir):
-    patient_dir = os.path.join(save_dir, patient_name)
-    for i in structure_list:
-        fname = i + '.nii'
-        fpath_nii = os.path.join(source_dir, patient_name, fname)
-        mask2border(fpath_nii, patient_dir)
+def convert_selected_masks_to_borders(structure_list, patient_name, save_dir, source_dir, workers=1, extension='.nii'):
+    return convert_masks_to_borders({patient_name: structure_list}, save_dir, source_dir, workers=workers,
+                                    extension=extension)
+
+''' Border versions of the masks of several patients in one call, spread over a process pool (one job per structure).
+inputs:
+    1. patient_structures: dict - patient name -> structure_list (see convert_selected_masks_to_borders)
+        Example: patient_structures = {'g01': ['Bladder', 'Rectum'], 'g02': ['Bladder', 'PTV45_1']}
+    2. save_dir, source_dir: see convert_selected_masks_to_borders. Borders are saved to save_dir/<patient name>
+    3. workers: int - number of processes (default: None, one per CPU)
+    4. extension: str - file extension of the mask files (default: '.nii')
+    5. method: see mask2border
+outputs:
+    1. savepaths: list of the border nifti files written
+        '''
+
+def convert_masks_to_borders(patient_structures, save_dir, source_dir, workers=None, extension='.nii',
+                             method='morphology'):
+    jobs = []
+    for patient_name, structure_list in patient_structures.items():
+        patient_dir = os.path.join(save_dir, patient_name)
+        os.makedirs(patient_dir, exist_ok=True)
+        for i in structure_list:
+            fname = i + extension
+            fpath_nii = os.path.join(source_dir, patient_name, fname)
+            jobs.append((fpath_nii, patient_dir))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(jobs) < 2:
+        return [mask2border(fpath_nii, patient_dir, method) for fpath_nii, patient_dir in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(mask2border, fpath_nii, patient_dir, method) for fpath_nii, patient_dir in jobs]
+        return [future.result() for future in futures]
 
 
-structure_list = ['Bladder', 'CTV-T HRinit', 'CTV-T LRinit_1_Full', 'PTV45_1', 'PTV45_2', 'PTV45_3', 'PTV45_Robust', 'Rectum']
-patient_name = 'g01'
-save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/contours'
-source_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/masks'
+if __name__ == '__main__':
+    structure_list = ['Bladder', 'CTV-T HRinit', 'CTV-T LRinit_1_Full', 'PTV45_1', 'PTV45_2', 'PTV45_3', 'PTV45_Robust', 'Rectum']
+    patient_name = 'g01'
+    save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/contours'
+    source_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/masks'
 
-convert_selected_masks_to_borders(structure_list, patient_name, save_dir, source_dir)
+    convert_selected_masks_to_borders(structure_list, patient_name, save_dir, source_dir)
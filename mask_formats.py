@@ -0,0 +1,266 @@
+import os
+import json
+import numpy as np
+import SimpleITK as sitk
+import sys
+sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
+from output_manifest import write_output, record_output, image_hash, file_hash, tmp_path_for
+from nifti_writer import write_nifti
+from volume_store import output_fname, read_image
+
+'''Output formats for the structure masks of an RTSTRUCT (see create_rtstruct_mask_SB.iter_rtstruct_masks).
+
+    1. 'nifti' (default): one uint8 <structure>.nii.gz per structure, as before.
+    2. 'labelmap': a single structures.nii.gz holding every structure as one bit of an unsigned integer volume
+    (structure i sets bit i, so overlapping structures such as PTV45_1 and PTV45_Robust are both kept), plus a
+    structures.json label table mapping each structure name to its bit and value. The volume is uint8 for up to 8
+    structures, uint16 for up to 16, and so on up to 64. A structure is recovered with (labelmap >> bit) & 1, see
+    read_label_map_structure.
+    3. 'rle': a run-length encoded structures.rle file plus a structures.rle.json header. For every structure the .rle
+    file holds its (start, length) runs of ones over the flattened (z, y, x) CT grid; the header holds the CT geometry
+    and the byte offset and number of runs of each structure, so read_rle_structure decodes one structure without
+    reading the others.
+
+The converters (DICOMRawData_to_nifti) take a mask_format argument; plan_mask_outputs lists the files a format writes
+(with the facts recorded in the output manifest) and write_mask_outputs writes them from the stream of masks. With
+output_format='volume_store' the niftis of 'nifti' and 'labelmap' are written as <name>.vol volume stores instead
+(see volume_store.py).
+'''
+
+MASK_FORMATS = ('nifti', 'labelmap', 'rle')
+LABELMAP_NAME = 'structures.nii.gz'
+RLE_NAME = 'structures.rle'
+
+LABELMAP_DTYPES = [(8, np.uint8), (16, np.uint16), (32, np.uint32), (64, np.uint64)]
+
+
+def label_table_path(labelmap_path):
+    # structures.nii.gz -> structures.json
+    base = labelmap_path[:-len('.nii.gz')] if labelmap_path.endswith('.nii.gz') else os.path.splitext(labelmap_path)[0]
+    return base + '.json'
+
+
+def rle_header_path(rle_path):
+    return rle_path + '.json'
+
+
+def _write_json_atomic(obj, save_path):
+    tmp_path = tmp_path_for(save_path)
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp_path, save_path)
+
+
+def _mask_metadata(mask):
+    # Metadata shared by every mask of an RTSTRUCT (dicom tags, CTSeriesUID), i.e. all but the structure name
+    return {key: mask.GetMetaData(key) for key in mask.GetMetaDataKeys() if key != 'ContourName'}
+
+
+def write_label_map(masks, save_path):
+    """ Combine masks into a single bitfield label map and write it with its label table.
+
+    Args
+    ====
+    masks : iterable of SimpleITK.Image (uint8, 0/1)
+        e.g. iter_rtstruct_masks(...). Consumed one at a time; all masks must share the CT grid.
+
+    save_path : str
+        Full file path of the label map (e.g. .../masks/g02/structures.nii.gz). The label table is written next to it
+        (structures.json).
+
+    Returns
+    =======
+    label_map : SimpleITK.Image
+    label_table : dict
+        {'encoding': 'bitfield', 'labels': {name: {'bit': i, 'value': 2**i}}}
+    """
+    labels = {}
+    label_array = None
+    reference = None
+    for mask in masks:
+        bit = len(labels)
+        if bit >= LABELMAP_DTYPES[-1][0]:
+            raise ValueError('A bitfield label map holds at most %d structures' % LABELMAP_DTYPES[-1][0])
+        if label_array is None:
+            reference = mask
+            label_array = np.zeros(sitk.GetArrayViewFromImage(mask).shape, dtype=np.uint8)
+        elif bit >= label_array.dtype.itemsize * 8:
+            # Widen to the next unsigned type once the current one has no free bit left
+            label_array = label_array.astype([dtype for n_bits, dtype in LABELMAP_DTYPES if n_bits > bit][0])
+
+        mask_array = sitk.GetArrayViewFromImage(mask)
+        label_array[mask_array != 0] |= label_array.dtype.type(1 << bit)
+        labels[mask.GetMetaData('ContourName')] = {'bit': bit, 'value': 1 << bit}
+
+    if label_array is None:
+        raise ValueError('No masks to write to %s' % save_path)
+
+    label_map = sitk.GetImageFromArray(label_array)
+    del label_array
+    label_map.CopyInformation(reference)
+    metadata = _mask_metadata(reference)
+    for key in metadata:
+        label_map.SetMetaData(key, metadata[key])
+
+    label_table = {'encoding': 'bitfield', 'labels': labels}
+    write_nifti(label_map, save_path)
+    _write_json_atomic(label_table, label_table_path(save_path))
+    return label_map, label_table
+
+
+def read_label_map_structure(labelmap_path, name):
+    """ uint8 mask (SimpleITK.Image) of structure name from a label map written by write_label_map. """
+    with open(label_table_path(labelmap_path)) as f:
+        label_table = json.load(f)
+    bit = label_table['labels'][name]['bit']
+
+    label_map = read_image(labelmap_path)
+    mask = sitk.GetImageFromArray(((sitk.GetArrayViewFromImage(label_map) >> bit) & 1).astype(np.uint8))
+    mask.CopyInformation(label_map)
+    for key in label_map.GetMetaDataKeys():
+        mask.SetMetaData(key, label_map.GetMetaData(key))
+    mask.SetMetaData('ContourName', name)
+    return mask
+
+
+def rle_encode(mask_array):
+    """ (start, length) runs of the non-zero voxels of mask_array, flattened in C (z, y, x) order. Returns an
+    (n_runs, 2) int64 array. """
+    flat = (np.ravel(mask_array) != 0).view(np.int8)
+    edges = np.diff(flat, prepend=np.int8(0), append=np.int8(0))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return np.stack([starts, ends - starts], axis=1)
+
+
+def rle_decode(runs, n_voxels):
+    """ Flat uint8 array of n_voxels with ones over the (start, length) runs. """
+    edges = np.zeros(n_voxels + 1, dtype=np.int8)
+    runs = np.asarray(runs, dtype=np.int64).reshape(-1, 2)
+    edges[runs[:, 0]] = 1
+    edges[runs[:, 0] + runs[:, 1]] -= 1
+    return np.cumsum(edges[:-1], dtype=np.int8).view(np.uint8)
+
+
+def write_rle_masks(masks, save_path):
+    """ Run-length encode masks into save_path (e.g. .../masks/g02/structures.rle) and its json header.
+
+    Args
+    ====
+    masks : iterable of SimpleITK.Image (uint8, 0/1)
+        Consumed one at a time; all masks must share the CT grid.
+
+    save_path : str
+
+    Returns
+    =======
+    header : dict
+        CT geometry ('size', 'origin', 'spacing', 'direction'), shared 'metadata', 'run_dtype' and per structure
+        'name', 'offset' (bytes), 'n_runs' and 'n_voxels' (number of voxels inside the structure).
+    """
+    header = {'format': 'rle', 'run_dtype': None, 'structures': []}
+    tmp_path = tmp_path_for(save_path)
+    try:
+        with open(tmp_path, 'wb') as f:
+            for mask in masks:
+                if header['run_dtype'] is None:
+                    n_voxels = int(np.prod(mask.GetSize()))
+                    header['run_dtype'] = '<u4' if n_voxels < 2 ** 32 else '<u8'
+                    header.update({'size': list(mask.GetSize()), 'origin': list(mask.GetOrigin()),
+                                   'spacing': list(mask.GetSpacing()), 'direction': list(mask.GetDirection()),
+                                   'metadata': _mask_metadata(mask)})
+                runs = rle_encode(sitk.GetArrayViewFromImage(mask))
+                header['structures'].append({'name': mask.GetMetaData('ContourName'), 'offset': f.tell(),
+                                             'n_runs': len(runs), 'n_voxels': int(runs[:, 1].sum())})
+                f.write(runs.astype(header['run_dtype']).tobytes())
+        os.replace(tmp_path, save_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    _write_json_atomic(header, rle_header_path(save_path))
+    return header
+
+
+def read_rle_structure(rle_path, name):
+    """ uint8 mask (SimpleITK.Image) of structure name from a file written by write_rle_masks. Only the runs of that
+    structure are read from disk. """
+    with open(rle_header_path(rle_path)) as f:
+        header = json.load(f)
+    entry = [s for s in header['structures'] if s['name'] == name]
+    if not entry:
+        raise KeyError('No structure %s in %s' % (name, rle_path))
+    entry = entry[0]
+
+    runs = np.fromfile(rle_path, dtype=header['run_dtype'], count=2 * entry['n_runs'], offset=entry['offset'])
+    szX, szY, szZ = header['size']
+    mask = sitk.GetImageFromArray(rle_decode(runs, szX * szY * szZ).reshape(szZ, szY, szX))
+    mask.SetOrigin(header['origin'])
+    mask.SetSpacing(header['spacing'])
+    mask.SetDirection(header['direction'])
+    for key, value in header['metadata'].items():
+        mask.SetMetaData(key, value)
+    mask.SetMetaData('ContourName', name)
+    return mask
+
+
+def plan_mask_outputs(structure_names, mask_format, facts, output_format='nifti'):
+    """ Files written for structure_names in mask_format.
+
+    Args
+    ====
+    structure_names : list of str
+        In the order the masks are generated.
+
+    mask_format : str
+        One of MASK_FORMATS.
+
+    facts : dict
+        Facts shared by every mask (RTSTRUCT SOPInstanceUID, reference CT SOPInstanceUIDs).
+
+    output_format : str (default = 'nifti')
+        'nifti' or 'volume_store' (see volume_store.output_fname); the 'rle' file is the same in both.
+
+    Returns
+    =======
+    outputs : list of (fname, structure names, facts) tuples
+    """
+    if mask_format not in MASK_FORMATS:
+        raise ValueError("Unknown mask_format '%s' (expected one of %s)" % (mask_format, ', '.join(MASK_FORMATS)))
+    if mask_format == 'nifti':
+        return [(output_fname(name + '.nii.gz', output_format), [name], dict(facts, structure=name))
+                for name in structure_names]
+    if not structure_names:
+        return []
+    fname = output_fname(LABELMAP_NAME, output_format) if mask_format == 'labelmap' else RLE_NAME
+    return [(fname, list(structure_names), dict(facts, structures=list(structure_names), format=mask_format))]
+
+
+def write_mask_outputs(masks, outputs, mask_format, mask_dir, manifest, info=None):
+    """ Write the outputs (from plan_mask_outputs) from a stream of masks and record them in the manifest.
+
+    masks must yield the masks of the structures of outputs (e.g. iter_rtstruct_masks(..., stale structure names)).
+    Per-structure niftis are written as soon as each mask arrives. Returns the paths written.
+    """
+    if not outputs:
+        return []
+
+    if mask_format == 'nifti':
+        files = {names[0]: (fname, output_facts) for fname, names, output_facts in outputs}
+        paths = []
+        for im in masks:
+            fname, facts = files[im.GetMetaData('ContourName')]
+            write_output(im, mask_dir, fname, manifest, facts, info=info)
+            paths.append(os.path.join(mask_dir, fname))
+        return paths
+
+    fname, names, facts = outputs[0]
+    save_path = os.path.join(mask_dir, fname)
+    if mask_format == 'labelmap':
+        label_map, label_table = write_label_map(masks, save_path)
+        content_hash = image_hash(label_map)
+    else:
+        write_rle_masks(masks, save_path)
+        content_hash = file_hash(save_path)
+    record_output(manifest, mask_dir, fname, facts, content_hash, info=info)
+    return [save_path]
@@ -0,0 +1,229 @@
+import os
+import gzip
+import struct
+import tempfile
+import numpy as np
+import SimpleITK as sitk
+from contextlib import contextmanager
+import sys
+sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
+from output_manifest import tmp_path_for
+from parallel_gzip import ParallelGzipWriter
+
+'''Writes (and reads) a nifti volume a slab of slices at a time, so the whole volume never has to be held in memory.
+
+The nifti-1 header is produced by SimpleITK (from a single-slice image with the geometry of the full volume, so
+orientation, qform/sform and units are exactly what sitk.WriteImage would write), after which only the number of
+slices (dim[3]) is patched. The voxel data follows the header in (z, y, x) C order, which is nifti's x-fastest order,
+so slabs are simply appended in increasing z. .nii.gz files are compressed on the fly, in several threads (see
+parallel_gzip.py).
+
+Reading goes the other way: iter_nifti_slabs parses the nifti-1 header itself and then decodes the voxel data (through
+gzip for .nii.gz) a slab at a time, yielding (z, y, x) arrays in the same order as sitk.GetArrayFromImage.
+
+Typical use:
+    with nifti_slab_writer(save_path, image_geometry(template)) as write_slab:
+        for z0 in range(0, nz, slab_size):
+            write_slab(slab_array)  # (slices, rows, columns)
+
+    for z0, slab_array in iter_nifti_slabs(fpath, slab_size):
+        ...
+'''
+
+NIFTI_DTYPES = {
+    np.dtype(np.int8): sitk.sitkInt8,
+    np.dtype(np.uint8): sitk.sitkUInt8,
+    np.dtype(np.int16): sitk.sitkInt16,
+    np.dtype(np.uint16): sitk.sitkUInt16,
+    np.dtype(np.int32): sitk.sitkInt32,
+    np.dtype(np.uint32): sitk.sitkUInt32,
+    np.dtype(np.int64): sitk.sitkInt64,
+    np.dtype(np.uint64): sitk.sitkUInt64,
+    np.dtype(np.float32): sitk.sitkFloat32,
+    np.dtype(np.float64): sitk.sitkFloat64,
+}
+
+# nifti-1 datatype codes
+NIFTI_DATATYPES = {2: np.uint8, 4: np.int16, 8: np.int32, 16: np.float32, 64: np.float64, 256: np.int8,
+                   512: np.uint16, 768: np.uint32, 1024: np.int64, 1280: np.uint64}
+
+# Offsets in the nifti-1 header
+DIM_OFFSET = 40  # short dim[8]
+DATATYPE_OFFSET = 70  # short datatype
+VOX_OFFSET_OFFSET = 108  # float vox_offset
+SCL_OFFSET = 112  # float scl_slope, scl_inter
+CAL_OFFSET = 124  # float cal_max, cal_min
+
+
+def image_geometry(image):
+    """ (size, origin, spacing, direction) of a sitk image. """
+    return image.GetSize(), image.GetOrigin(), image.GetSpacing(), image.GetDirection()
+
+
+def nifti_header(geometry, dtype, metadata=None):
+    """ nifti-1 header bytes (up to vox_offset) for a volume with the given (size, origin, spacing, direction) and
+    voxel type dtype, as written by SimpleITK. metadata (dict) is the metadata of the image, some of which (e.g.
+    ITK_FileNotes) ends up in the header. """
+    size, origin, spacing, direction = geometry
+    nx, ny, nz = size
+    first_slice = sitk.Image(nx, ny, 1, NIFTI_DTYPES[np.dtype(dtype).newbyteorder('=')])
+    first_slice.SetOrigin(origin)
+    first_slice.SetSpacing(spacing)
+    first_slice.SetDirection(direction)
+    for key, value in (metadata or {}).items():
+        first_slice.SetMetaData(key, value)
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.nii')
+    os.close(fd)
+    try:
+        sitk.WriteImage(first_slice, tmp_path, False)
+        with open(tmp_path, 'rb') as f:
+            header = bytearray(f.read())
+    finally:
+        os.remove(tmp_path)
+
+    if struct.unpack_from('<i', header, 0)[0] != 348:
+        raise ValueError('Unexpected nifti header written by SimpleITK')
+    vox_offset = int(struct.unpack_from('<f', header, VOX_OFFSET_OFFSET)[0])
+    header = header[:vox_offset]
+    struct.pack_into('<h', header, DIM_OFFSET, 3)
+    struct.pack_into('<h', header, DIM_OFFSET + 6, nz)
+    return bytes(header)
+
+
+@contextmanager
+def nifti_slab_writer(save_path, geometry, dtype=np.float32, compresslevel=6, threads=None, executor=None):
+    """ Context manager giving a function that appends slabs of slices to the nifti at save_path.
+
+    Args
+    ====
+    save_path : str
+        .nii or .nii.gz. Written to a temporary file and renamed into place once every slice has been written.
+
+    geometry : tuple
+        (size, origin, spacing, direction) of the volume, e.g. image_geometry(template).
+
+    dtype : numpy dtype (default = np.float32)
+
+    compresslevel : int (default = 6)
+        gzip level for .nii.gz.
+
+    threads : int (default = None, one per CPU)
+        Number of threads compressing a .nii.gz.
+
+    executor : concurrent.futures.Executor (default = None)
+        Thread pool to compress in (see parallel_gzip.ParallelGzipWriter).
+
+    Yields
+    ======
+    write_slab : function
+        write_slab(array) with array of shape (slices, rows, columns) appends those slices, in increasing z.
+    """
+    nx, ny, nz = geometry[0]
+    dtype = np.dtype(dtype).newbyteorder('<')
+    header = nifti_header(geometry, dtype)
+    tmp_path = tmp_path_for(save_path)
+    written = [0]
+
+    def write_slab(array):
+        if array.shape[1:] != (ny, nx) or written[0] + array.shape[0] > nz:
+            raise ValueError('Slab of shape %s does not fit a volume of size %s at slice %d'
+                             % (array.shape, (nx, ny, nz), written[0]))
+        f.write(np.ascontiguousarray(array, dtype=dtype))
+        written[0] += array.shape[0]
+
+    try:
+        if save_path.endswith('.gz'):
+            f = ParallelGzipWriter(tmp_path, compresslevel=compresslevel, threads=threads, executor=executor)
+        else:
+            f = open(tmp_path, 'wb')
+        with f:
+            f.write(header)
+            yield write_slab
+        if written[0] != nz:
+            raise ValueError('Only %d of %d slices were written to %s' % (written[0], nz, save_path))
+        os.replace(tmp_path, save_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _open_nifti(fpath):
+    return gzip.open(fpath, 'rb') if fpath.endswith('.gz') else open(fpath, 'rb')
+
+
+def parse_nifti_header(header):
+    """ The fields of a nifti-1 header (the first 348 bytes of the file) needed to decode its voxels.
+
+    Returns
+    =======
+    info : dict
+        'size' (x, y, z), 'dtype' (numpy, with the byte order of the file), 'vox_offset', 'scl_slope', 'scl_inter',
+        'cal_min' and 'cal_max'.
+    """
+    for endian in '<>':
+        if struct.unpack_from(endian + 'i', header, 0)[0] == 348:
+            break
+    else:
+        raise ValueError('Not a nifti-1 header')
+
+    dim = struct.unpack_from(endian + '8h', header, DIM_OFFSET)
+    datatype = struct.unpack_from(endian + 'h', header, DATATYPE_OFFSET)[0]
+    if datatype not in NIFTI_DATATYPES:
+        raise ValueError('Unsupported nifti datatype %d' % datatype)
+    if dim[0] > 3 and any(d > 1 for d in dim[4:dim[0] + 1]):
+        raise ValueError('Only 3D niftis can be read slab by slab')
+    scl_slope, scl_inter = struct.unpack_from(endian + '2f', header, SCL_OFFSET)
+    cal_max, cal_min = struct.unpack_from(endian + '2f', header, CAL_OFFSET)
+    return {
+        'size': tuple(max(1, d) if i < dim[0] else 1 for i, d in enumerate(dim[1:4])),
+        'dtype': np.dtype(NIFTI_DATATYPES[datatype]).newbyteorder(endian),
+        'vox_offset': int(struct.unpack_from(endian + 'f', header, VOX_OFFSET_OFFSET)[0]),
+        'scl_slope': scl_slope,
+        'scl_inter': scl_inter,
+        'cal_min': cal_min,
+        'cal_max': cal_max,
+    }
+
+
+def read_nifti_header(fpath):
+    """ parse_nifti_header of the nifti (.nii or .nii.gz) at fpath. """
+    with _open_nifti(fpath) as f:
+        return parse_nifti_header(f.read(348))
+
+
+def iter_nifti_slabs(fpath, slab_size=1):
+    """ Decode a 3D nifti slab by slab.
+
+    Args
+    ====
+    fpath : str
+        .nii or .nii.gz
+
+    slab_size : int (default = 1)
+        Number of slices per slab (the last slab may be smaller).
+
+    Yields
+    ======
+    (z0, array) : first slice index and (slices, rows, columns) array of the slab. Values are in the stored type, or
+    float32 with scl_slope/scl_inter applied if the header sets a scaling (as sitk.ReadImage does).
+    """
+    with _open_nifti(fpath) as f:
+        info = parse_nifti_header(f.read(348))
+        f.read(info['vox_offset'] - 348)
+        nx, ny, nz = info['size']
+        dtype = info['dtype']
+        scaled = info['scl_slope'] != 0 and (info['scl_slope'] != 1 or info['scl_inter'] != 0)
+
+        for z0 in range(0, nz, slab_size):
+            n_slices = min(slab_size, nz - z0)
+            n_bytes = n_slices * ny * nx * dtype.itemsize
+            data = f.read(n_bytes)
+            if len(data) != n_bytes:
+                raise ValueError('%s ends before slice %d' % (fpath, z0 + n_slices))
+            array = np.frombuffer(data, dtype=dtype).reshape(n_slices, ny, nx)
+            if scaled:
+                array = array.astype(np.float32) * np.float32(info['scl_slope']) + np.float32(info['scl_inter'])
+            else:
+                array = array.astype(dtype.newbyteorder('='), copy=False)
+            yield z0, array
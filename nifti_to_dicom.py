@@ -2,8 +2,16 @@ import pydicom
 import SimpleITK as sitk
 import os
 from pydicom.uid import generate_uid
+from pydicom.tag import Tag
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import datetime
 import numpy as np
+import sys
+sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
+from nifti_stream import iter_nifti_slabs, read_nifti_header
+from instrumentation import stage
 
 ''' rescales array so values lie between range specified in 'out_range'. Also returns slope and intercept used 
 for conversion.
@@ -25,96 +33,218 @@ def rescale_array(arr, out_range):
 
     return rescaled_arr, m, b, orig_max, orig_min
 
-'''Converts specified slice(index) of 3D numpy array into dicom file (2D slice)
+'''Range (min, max) of the values of a nifti file, without loading the whole volume.
 Inputs:
-    1. rescaled_arr: nxmxd numpy array that has been rescaled so values lie between 0 and 4095 (uint12)
-    2. m: slope applied in linear transformation from original array to rescaled array (inverse taken in code)
-    3. b: intersection applied in linear transformation from rescaled array to original array 
-    4. ipp: image position patient (3xn) value (physical coordinate of top left pixel)
-    5. pix_spacing (3xn): pixel spacing (mm) of voxel
-    6. series_id: unique SOP identifier
-    7. save_dir: full filepath where you wish dicom to be saved.
-    8. index: slice number of 3D array to be saved
-    9. fpath_template: full filepath of template dicome file whose tags will be overwritten and re-saved as new dcm
-    
+    1. fpath: full filename of the nifti file
+    2. value_range: 'scan' (default) reads the volume once, chunk_slices slices at a time; 'header' uses cal_min/cal_max
+    of the nifti header when they are set (falling back to a scan otherwise)
+    3. chunk_slices: number of slices decoded at a time while scanning'''
+
+def nifti_value_range(fpath, value_range='scan', chunk_slices=16):
+    if value_range == 'header':
+        info = read_nifti_header(fpath)
+        if info['cal_max'] > info['cal_min']:
+            return np.float32(info['cal_min']), np.float32(info['cal_max'])
+    elif value_range != 'scan':
+        raise ValueError("value_range must be 'scan' or 'header'")
+
+    orig_min = orig_max = None
+    for z0, chunk in iter_nifti_slabs(fpath, chunk_slices):
+        chunk_min, chunk_max = np.amin(chunk), np.amax(chunk)
+        orig_min = chunk_min if orig_min is None else min(orig_min, chunk_min)
+        orig_max = chunk_max if orig_max is None else max(orig_max, chunk_max)
+    return orig_min, orig_max
+
+'''Slope m (original -> rescaled) and rounded intercept b (rescaled -> original) of the rescale of values in
+[orig_min, orig_max] to out_range, computed directly from the range (same values as the two rescale_array calls that
+nifti_to_dicoms used to make). A constant image (orig_max == orig_min) gets slope 1.'''
+
+def rescale_params(orig_min, orig_max, out_range=(0, 4095)):
+    y2 = out_range[0]  #min of uint16
+    y1 = out_range[1] #max of uint16
+    if orig_max == orig_min:
+        m = 1.0
+    else:
+        m = (y2-y1)/(orig_min-orig_max)
+    b = np.round(orig_min - y2/m)
+    return m, b
+
+# Tags set for each series (dates, series uid, rescale, image size and voxel size) and for each slice; the slices of a
+# series share every other element of the template
+SERIES_KEYWORDS = ['InstanceCreationTime', 'InstanceCreationDate', 'StudyDate', 'SeriesDate', 'AcquisitionDate',
+                   'ContentDate', 'SeriesInstanceUID', 'RescaleSlope', 'RescaleIntercept', 'Rows', 'Columns',
+                   'PixelSpacing', 'SliceThickness']
+SLICE_KEYWORDS = ['SOPInstanceUID', 'ImagePositionPatient', 'SliceLocation', 'InstanceNumber', 'PixelData']
+SERIES_TAGS = set(Tag(keyword) for keyword in SERIES_KEYWORDS)
+SLICE_TAGS = set(Tag(keyword) for keyword in SLICE_KEYWORDS)
+
+
+'''Copy of dataset without the elements in tags. The remaining elements are shared with dataset (not copied), so they
+must not be modified; the left out ones can be set freely on the copy.'''
+def copy_without(dataset, tags):
+    return Dataset({tag: elem for tag, elem in dataset.items() if tag not in tags})
+
+
+'''Template dataset of one series: the template dicom with the per-series tags set. Tags are not modified on the
+template itself, so one parsed template can be used for any number of series.
+Inputs:
+    1. template: pydicom Dataset of the template dicom file (parsed once, see nifti_to_dicoms)
+    2. series_id: SeriesInstanceUID of the new series
+    3. m: slope applied in linear transformation from original array to rescaled array (inverse taken in code)
+    4. b: intersection applied in linear transformation from rescaled array to original array
+    5. shape: (rows, columns) of the slices
+    6. pix_spacing (3xn): pixel spacing (mm) of voxel
+    7. dt: datetime written as the creation/study date and time of the series (default: now)'''
+
+def series_dataset(template, series_id, m, b, shape, pix_spacing, dt=None):
+    series_ds = copy_without(template, SERIES_TAGS | SLICE_TAGS)
+
+    #Update time and date info with current datetime (once for the whole series)
+    if dt is None:
+        dt = datetime.datetime.now()
+    timeStr = dt.strftime('%H%M%S.%f')  # long format with micro seconds
+    dateStr = dt.strftime('%Y%m%d')
+    series_ds.InstanceCreationTime = timeStr
+    series_ds.InstanceCreationDate = dateStr
+    series_ds.StudyDate = dateStr
+    series_ds.SeriesDate = dateStr
+    series_ds.AcquisitionDate = dateStr
+    series_ds.ContentDate = dateStr
+
+    #SeriesInstanceUID (constant for all slices in series)
+    series_ds.SeriesInstanceUID = series_id
+
+    #Rescale of the pixel data
+    series_ds.RescaleSlope = 1/m
+    series_ds.RescaleIntercept = b
+
+    #Update image dimensions and voxel size
+    series_ds.Rows = shape[0]
+    series_ds.Columns = shape[1]
+    series_ds.PixelSpacing = [pix_spacing[0], pix_spacing[1]]
+    series_ds.SliceThickness = pix_spacing[2]
+    return series_ds
+
+
+'''Converts one slice (index) of a 3D array into a dicom file (2D slice)
+Inputs:
+    1. rescaled_arr: nxm numpy array (one slice) that has been rescaled so values lie between 0 and 4095 (uint12)
+    2. ipp: image position patient (3xn) value (physical coordinate of top left pixel)
+    3. series_ds: per-series template dataset (series_dataset)
+    4. template: pydicom Dataset of the template dicom file, providing the file meta information and encoding
+    5. save_dir: full filepath where you wish dicom to be saved.
+    6. index: slice number of 3D array to be saved
+
 Output: dicom files labeled "sliceXXX.dcm" in user-specified directory'''
 
-def convertNsave(rescaled_arr, m, b, ipp, pix_spacing, series_id, save_dir, index, fpath_template):
+def convertNsave(rescaled_arr, ipp, series_ds, template, save_dir, index):
 
     #Generate new uid
     new_SOP_id = generate_uid()
 
-    #Read in template dicom file
-    dicom_file = pydicom.dcmread(fpath_template)
+    #Per-slice dataset sharing the elements of the series (only the per-slice tags are new)
+    dicom_file = copy_without(series_ds, SLICE_TAGS)
 
-    #Update time and date info with current datetime
-    dt = datetime.datetime.now()
-    timeStr = dt.strftime('%H%M%S.%f')  # long format with micro seconds
-    dateStr = dt.strftime('%Y%m%d')
-    dicom_file.InstanceCreationTime = timeStr
-    dicom_file.InstanceCreationDate = dateStr
-    dicom_file.StudyDate = dateStr
-    dicom_file.SeriesDate = dateStr
-    dicom_file.AcquisitionDate = dateStr
-    dicom_file.ContentDate = dateStr
-
-    #Update SOPInstanceUID (each slice) and SeriesInstanceUID (constant for all slices in series)
+    #Update SOPInstanceUID (each slice)
     dicom_file.SOPInstanceUID = new_SOP_id
-    dicom_file.SeriesInstanceUID = series_id
+    file_meta = FileMetaDataset(copy_without(template.file_meta, {Tag('MediaStorageSOPInstanceUID')}))
+    file_meta.MediaStorageSOPInstanceUID = new_SOP_id
 
-   #Update pixel data
-    rescaled_arr = rescaled_arr.astype('uint16')
-    dicom_file.RescaleSlope = 1/m
-    dicom_file.RescaleIntercept = b
-    dicom_file.PixelData = rescaled_arr.tobytes()
-
-    #Update image dimensions
-    dicom_file.Rows = rescaled_arr.shape[0]
-    dicom_file.Columns = rescaled_arr.shape[1]
-
-    #Update spatial information and voxel size
-    dicom_file.ImagePositionPatient[0] = ipp[0]
-    dicom_file.ImagePositionPatient[1] = ipp[1]
-    dicom_file.ImagePositionPatient[2] = ipp[2]
+    #Update spatial information
+    dicom_file.ImagePositionPatient = [ipp[0], ipp[1], ipp[2]]
     dicom_file.SliceLocation = ipp[2]
-    dicom_file.PixelSpacing[0] = pix_spacing[0]
-    dicom_file.PixelSpacing[1] = pix_spacing[1]
-    dicom_file.SliceThickness = pix_spacing[2]
 
     #Update instance number
     dicom_file.InstanceNumber = index + 1
 
-    dicom_file.save_as(os.path.join(save_dir, f'slice{index}.dcm'))
-
-'''Generates dicom file for every slice in nifti file
-inputs:
-    1. fpath_nifit_compound: full filename of nifti file that you wish to convert to dicom
-    2. save_dir: full filepath of directory where you wish to save dicom files
-    3. fpath_template: full filename of template dicom file (i.e. original dicom export of single US)'''
-
-def nifti_to_dicoms(fpath_nifti_compound, save_dir, fpath_template):
-
-    im_sitk = sitk.ReadImage(fpath_nifti_compound)
-    im_arr = sitk.GetArrayFromImage(im_sitk)
-    series_id = generate_uid()
-    pix_spacing = im_sitk.GetSpacing()
-    out_range = [0, 4095]
-    rescaled_arr, m, btrash, orig_max, orig_min = rescale_array(im_arr, out_range)
-    orig_arr, mtrash, b, new_max, new_min = rescale_array(rescaled_arr, [orig_min, orig_max])
-    b = np.round(b)
-
-    for i in range(rescaled_arr.shape[0]):
-        arr = rescaled_arr[i, :, :]
-        ipp = im_sitk.TransformIndexToPhysicalPoint((0, 0, i))
-        convertNsave(arr, m, b, ipp, pix_spacing, series_id, save_dir, i, fpath_template)
-
-
-fpath_template = '/Users/sblackledge/Documents/GENIUSII_exports/RayStation/g02/July_25_1447/CT1.2.826.0.1.3680043.2.1181.1.4.273440548174504.1666686875.0.dcm'
+    #Update pixel data
+    rescaled_arr = rescaled_arr.astype('uint16')
+    dicom_file.add_new(Tag('PixelData'), 'OW', rescaled_arr.tobytes())
 
-'''START EDIT'''
-save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/compound_dicoms/g01/June17'
-fpath_nifti_compound = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/compound_images/g01/June17_compound.nii.gz'
-'''END EDIT'''
+    transfer_syntax = template.file_meta.TransferSyntaxUID
+    dicom_out = FileDataset(os.path.join(save_dir, f'slice{index}.dcm'), dicom_file, preamble=template.preamble,
+                            file_meta=file_meta, is_implicit_VR=transfer_syntax.is_implicit_VR,
+                            is_little_endian=transfer_syntax.is_little_endian)
+    dicom_out.save_as(os.path.join(save_dir, f'slice{index}.dcm'))
 
+'''Generates dicom file for every slice in nifti file(s)
 
-nifti_to_dicoms(fpath_nifti_compound, save_dir, fpath_template)
+The niftis are streamed: the value range is found first (nifti_value_range), then slices are decoded, rescaled to
+uint16 and handed to the writer threads one at a time, with at most max_pending slices waiting to be written. Peak
+memory is therefore a few slices rather than several copies of the volume.
+inputs:
+    1. fpath_nifit_compound: full filename of nifti file that you wish to convert to dicom, or a list of them
+    2. save_dir: full filepath of directory where you wish to save dicom files, or a list with one directory per nifti
+    3. fpath_template: full filename of template dicom file (i.e. original dicom export of single US). Parsed once
+    for all niftis.
+    4. workers: number of threads writing slice files concurrently (default: as ThreadPoolExecutor)
+    5. value_range: 'scan' or 'header', see nifti_value_range
+    6. max_pending: number of rescaled slices queued for writing at most (default: 4 per worker)
+outputs:
+    1. series_ids: SeriesInstanceUID of each new series (a single one if a single nifti was given)'''
+
+def nifti_to_dicoms(fpath_nifti_compound, save_dir, fpath_template, workers=None, value_range='scan',
+                    max_pending=None):
+    single = isinstance(fpath_nifti_compound, str)
+    fpaths = [fpath_nifti_compound] if single else list(fpath_nifti_compound)
+    save_dirs = [save_dir] if single else list(save_dir)
+    if len(save_dirs) != len(fpaths):
+        raise ValueError('One save_dir is needed per nifti')
+
+    #Read in template dicom file (once)
+    template = pydicom.dcmread(fpath_template)
+
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1) + 4)  # ThreadPoolExecutor default
+    if max_pending is None:
+        max_pending = 4 * workers
+
+    series_ids = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for fpath, series_dir in zip(fpaths, save_dirs):
+            with stage('nifti_to_dicom', fname=os.path.basename(fpath)) as s:
+                os.makedirs(series_dir, exist_ok=True)
+
+                #Geometry from the header only; a 1 voxel image with that geometry gives the slice positions
+                reader = sitk.ImageFileReader()
+                reader.SetFileName(fpath)
+                reader.ReadImageInformation()
+                geometry = sitk.Image(1, 1, 1, sitk.sitkUInt8)
+                geometry.SetOrigin(reader.GetOrigin())
+                geometry.SetSpacing(reader.GetSpacing())
+                geometry.SetDirection(reader.GetDirection())
+                nx, ny, nz = reader.GetSize()
+
+                series_id = generate_uid()
+                pix_spacing = reader.GetSpacing()
+                out_range = [0, 4095]
+                orig_min, orig_max = nifti_value_range(fpath, value_range)
+                m, b = rescale_params(orig_min, orig_max, out_range)
+
+                series_ds = series_dataset(template, series_id, m, b, (ny, nx), pix_spacing)
+                pending = deque()
+                for i, arr in iter_nifti_slabs(fpath, 1):
+                    rescaled_arr = (m*(arr[0] - orig_min) + out_range[0]).astype('uint16')
+                    ipp = geometry.TransformIndexToPhysicalPoint((0, 0, i))
+                    pending.append(executor.submit(convertNsave, rescaled_arr, ipp, series_ds, template, series_dir,
+                                                   i))
+                    while len(pending) >= max_pending:
+                        pending.popleft().result()
+                while pending:
+                    pending.popleft().result()
+                s.add(files=nz, bytes=nx * ny * nz * 2)  # uint16 slices written
+                series_ids.append(series_id)
+
+    return series_ids[0] if single else series_ids
+
+
+if __name__ == '__main__':
+    fpath_template = '/Users/sblackledge/Documents/GENIUSII_exports/RayStation/g02/July_25_1447/CT1.2.826.0.1.3680043.2.1181.1.4.273440548174504.1666686875.0.dcm'
+
+    '''START EDIT'''
+    save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/compound_dicoms/g01/June17'
+    fpath_nifti_compound = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/compound_images/g01/June17_compound.nii.gz'
+    '''END EDIT'''
+
+
+    nifti_to_dicoms(fpath_nifti_compound, save_dir, fpath_template)
@@ -0,0 +1,214 @@
+import os
+import threading
+import numpy as np
+import SimpleITK as sitk
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import sys
+sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
+from output_manifest import write_image_atomic, tmp_path_for
+from nifti_stream import NIFTI_DTYPES, nifti_header, image_geometry, nifti_slab_writer
+from parallel_gzip import ParallelGzipWriter, DEFAULT_THREADS
+from volume_store import is_volume_store, write_volume_store, volume_slab_writer
+
+'''Writer used for every nifti output (converters, compound_create, mask2border, mask formats).
+
+sitk.WriteImage(image, path, True) compresses a .nii.gz on a single core, which is most of the time spent writing a
+float32 CBCT on the planning CT grid. A NiftiWriter writes the same nifti (header from SimpleITK, see
+nifti_stream.nifti_header, followed by the voxels) but compresses it in several threads as a multi-member gzip file
+(parallel_gzip.py), which SimpleITK, nibabel and gzip read like any other .nii.gz. Images SimpleITK would write
+differently (vector pixels, 2D/4D images) and other file types are written by sitk.WriteImage as before.
+
+In background mode (for interactive sessions) write() saves the image uncompressed as <name>.nii straight away and
+returns; the .nii.gz is then compressed in a background thread, after which the .nii is removed. flush() waits for the
+pending compressions.
+
+Outputs named <name>.vol are written as uncompressed, memory-mappable volume stores instead (see volume_store.py).
+
+All outputs go through one writer per process, set up with configure_nifti_writer:
+    configure_nifti_writer(compresslevel=1, background=True)
+    DICOMRawData_to_nifti(...)
+    flush_nifti_writer()
+'''
+
+DEFAULT_COMPRESSLEVEL = 6  # zlib's default, as used by SimpleITK
+
+
+def nifti_streamable(image):
+    """ True if the writer can produce image itself: a 3D scalar image of a type SimpleITK writes as is. """
+    if image.GetDimension() != 3 or image.GetNumberOfComponentsPerPixel() != 1:
+        return False
+    return image.GetPixelID() in NIFTI_DTYPES.values()
+
+
+def write_nifti_gz(image, save_path, compresslevel=DEFAULT_COMPRESSLEVEL, threads=None, executor=None):
+    """ Write image to save_path (.nii.gz, atomically), compressing in threads.
+
+    Decompressed, the file holds exactly the bytes sitk.WriteImage writes for the image (see nifti_streamable).
+    """
+    array = sitk.GetArrayViewFromImage(image)
+    metadata = {key: image.GetMetaData(key) for key in image.GetMetaDataKeys()}
+    header = nifti_header(image_geometry(image), array.dtype, metadata)
+    tmp_path = tmp_path_for(save_path)
+    try:
+        with ParallelGzipWriter(tmp_path, compresslevel=compresslevel, threads=threads, executor=executor) as f:
+            f.write(header)
+            f.write(np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<')))
+        os.replace(tmp_path, save_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _done(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class NiftiWriter:
+    """ Writes niftis with multi-threaded compression, optionally in the background.
+
+    Args
+    ====
+    compresslevel : int (default = DEFAULT_COMPRESSLEVEL)
+        gzip level, 1 (fastest) to 9 (smallest).
+
+    threads : int (default = None, one per CPU)
+        Number of compression threads.
+
+    background : bool (default = False)
+        Write .nii.gz outputs uncompressed (<name>.nii) first and compress them in the background.
+    """
+
+    def __init__(self, compresslevel=DEFAULT_COMPRESSLEVEL, threads=None, background=False):
+        self.compresslevel = compresslevel
+        self.threads = threads or DEFAULT_THREADS
+        self.background = background
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._background_executor = None
+        self._jobs = []
+        self._lock = threading.Lock()
+
+    def write(self, image, save_path, use_compression=True, background=None):
+        """ Write image to save_path (atomically).
+
+        Args
+        ====
+        image : SimpleITK.Image
+
+        save_path : str
+
+        use_compression : bool (default = True)
+            As for sitk.WriteImage.
+
+        background : bool (default = None, the writer's setting)
+
+        Returns
+        =======
+        future : concurrent.futures.Future
+            Resolves to save_path once the file is in place (already done unless compressing in the background).
+        """
+        if is_volume_store(save_path):
+            write_volume_store(image, save_path)
+            return _done(save_path)
+        if not (use_compression and save_path.endswith('.nii.gz') and nifti_streamable(image)):
+            write_image_atomic(image, save_path, use_compression)
+            return _done(save_path)
+
+        if not (self.background if background is None else background):
+            if self.threads == 1 and self.compresslevel == DEFAULT_COMPRESSLEVEL:
+                # Nothing to gain from chunking on one thread, and SimpleITK's zlib is faster than python's (it always
+                # compresses niftis at the default level though)
+                write_image_atomic(image, save_path, use_compression)
+            else:
+                write_nifti_gz(image, save_path, self.compresslevel, executor=self._executor)
+            return _done(save_path)
+
+        uncompressed_path = save_path[:-len('.gz')]
+        write_image_atomic(image, uncompressed_path, False)
+        with self._lock:
+            if self._background_executor is None:
+                self._background_executor = ThreadPoolExecutor(max_workers=1)
+            # sitk.Image(image) shares the pixel buffer; later changes to image by the caller do not affect it
+            job = self._background_executor.submit(self._compress, sitk.Image(image), save_path, uncompressed_path)
+            self._jobs.append(job)
+        return job
+
+    def _compress(self, image, save_path, uncompressed_path):
+        write_nifti_gz(image, save_path, self.compresslevel, executor=self._executor)
+        if os.path.exists(uncompressed_path):
+            os.remove(uncompressed_path)
+        return save_path
+
+    def slab_writer(self, save_path, geometry, dtype=np.float32):
+        """ nifti_stream.nifti_slab_writer compressing with the settings (and threads) of this writer
+        (volume_store.volume_slab_writer for a <name>.vol save_path). """
+        if is_volume_store(save_path):
+            return volume_slab_writer(save_path, geometry, dtype)
+        return nifti_slab_writer(save_path, geometry, dtype, compresslevel=self.compresslevel, threads=self.threads,
+                                 executor=self._executor)
+
+    def flush(self):
+        """ Wait for the background compressions; returns the paths written and raises the first error. """
+        with self._lock:
+            jobs, self._jobs = self._jobs, []
+        wait(jobs)
+        return [job.result() for job in jobs]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._background_executor is not None:
+                self._background_executor.shutdown()
+            self._executor.shutdown()
+
+
+_settings = {'compresslevel': DEFAULT_COMPRESSLEVEL, 'threads': None, 'background': False}
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def configure_nifti_writer(compresslevel=None, threads=None, background=None):
+    """ Change the settings of the writer used for every output of this process (None keeps a setting as it is).
+    Background writes pending with the previous settings are finished first. """
+    global _writer
+    with _writer_lock:
+        old_writer, _writer = _writer, None
+        for key, value in (('compresslevel', compresslevel), ('threads', threads), ('background', background)):
+            if value is not None:
+                _settings[key] = value
+    if old_writer is not None:
+        old_writer.close()
+
+
+def get_nifti_writer():
+    """ The NiftiWriter of this process (see configure_nifti_writer). """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = NiftiWriter(**_settings)
+        return _writer
+
+
+def flush_nifti_writer():
+    """ Wait for every background compression of this process. """
+    with _writer_lock:
+        writer = _writer
+    return writer.flush() if writer is not None else []
+
+
+def write_nifti(image, save_path, use_compression=True):
+    """ Write image to save_path now (atomically), compressing with the writer of this process. """
+    return get_nifti_writer().write(image, save_path, use_compression, background=False).result()
+
+
+def _forget_writer():
+    # A forked worker process cannot use the threads of its parent's writer; it makes its own
+    global _writer, _writer_lock
+    _writer = None
+    _writer_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_writer)
@@ -0,0 +1,160 @@
+import os
+import json
+import shutil
+import time
+import hashlib
+import threading
+import numpy as np
+import SimpleITK as sitk
+
+'''Manifest of the niftis written to an output directory (e.g. nifti_dump/images/g02 or nifti_dump/masks/g02).
+
+For every output file the manifest (manifest.json in the same directory) records the facts it was made from (source
+SOPInstanceUIDs, REG matrix, structure name...), a key derived from those facts and a hash of the image content. A
+re-run can then skip every output whose facts are unchanged and whose file is still there (is_up_to_date).
+
+Outputs are written to a temporary file and renamed into place, and the manifest is updated (also atomically) after
+each output. A killed run therefore never leaves a half-written nifti behind, and the next run resumes with the
+outputs that were not finished yet. Niftis are written by the writer of nifti_writer.py; an output it compresses in
+the background is recorded once its file is in place. An output may also be a directory (a volume_store.py store), in
+which case its size is the total size of its files.
+'''
+
+MANIFEST_NAME = 'manifest.json'
+TMP_PREFIX = '.tmp-'
+
+# Outputs compressed in the background are recorded from another thread
+_manifest_lock = threading.Lock()
+
+
+def load_manifest(out_dir):
+    """ Manifest of out_dir ({'outputs': {fname: entry}}); empty if there is none yet. Temporary files left behind by
+    a killed run are removed (those of this process may still be being written). """
+    own_prefix = '%s%d-' % (TMP_PREFIX, os.getpid())
+    for fl in os.listdir(out_dir):
+        if fl.startswith(TMP_PREFIX) and not fl.startswith(own_prefix):
+            tmp_path = os.path.join(out_dir, fl)
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path)
+            else:
+                os.remove(tmp_path)
+
+    fpath = os.path.join(out_dir, MANIFEST_NAME)
+    if not os.path.isfile(fpath):
+        return {'outputs': {}}
+    with open(fpath) as f:
+        return json.load(f)
+
+
+def save_manifest(out_dir, manifest):
+    fpath = os.path.join(out_dir, MANIFEST_NAME)
+    tmp_path = os.path.join(out_dir, '%s%d-%s' % (TMP_PREFIX, os.getpid(), MANIFEST_NAME))
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, fpath)
+
+
+def output_key(facts):
+    """ Hash of the facts (json-serialisable dict) an output is made from. """
+    return hashlib.sha256(json.dumps(facts, sort_keys=True).encode()).hexdigest()
+
+
+def image_hash(image):
+    """ Hash of the content of a sitk image: geometry, pixel type and pixel values. """
+    h = hashlib.sha256()
+    h.update(repr((image.GetSize(), image.GetOrigin(), image.GetSpacing(), image.GetDirection(),
+                   image.GetPixelIDTypeAsString())).encode())
+    h.update(np.ascontiguousarray(sitk.GetArrayViewFromImage(image)).data)
+    return h.hexdigest()
+
+
+def file_hash(fpath):
+    """ Hash of the bytes of a file. """
+    h = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def output_size(fpath):
+    """ Size of an output file, or total size of the files of an output directory (volume store). """
+    if not os.path.isdir(fpath):
+        return os.path.getsize(fpath)
+    return sum(os.path.getsize(os.path.join(root, fl)) for root, dirs, files in os.walk(fpath) for fl in files)
+
+
+def is_up_to_date(manifest, out_dir, fname, facts):
+    """ True if out_dir/fname was written from exactly these facts and is still on disk, unchanged in size. """
+    entry = manifest['outputs'].get(fname)
+    if entry is None or entry['key'] != output_key(facts):
+        return False
+    fpath = os.path.join(out_dir, fname)
+    return os.path.exists(fpath) and output_size(fpath) == entry['size']
+
+
+def write_image_atomic(image, save_path, use_compression=True):
+    """ sitk.WriteImage to a temporary file next to save_path, then rename it into place. """
+    tmp_path = tmp_path_for(save_path)
+    try:
+        sitk.WriteImage(image, tmp_path, use_compression)
+        os.replace(tmp_path, save_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_output(image, out_dir, fname, manifest, facts, info=None):
+    """ Atomically write image to out_dir/fname and record it in the manifest.
+
+    Args
+    ====
+    image : SimpleITK.Image
+
+    out_dir, fname : str
+
+    manifest : dict
+        Manifest of out_dir (load_manifest); updated and saved.
+
+    facts : dict
+        Everything the output depends on, e.g. {'sources': [SOPInstanceUIDs], 'reg_matrix': [...]}. Changing any of
+        these makes the output stale.
+
+    info : dict (default = None)
+        Recorded alongside the facts but not part of the key (e.g. the masks_of_interest of the run).
+
+    Returns
+    =======
+    future : concurrent.futures.Future
+        Done once the output is in place, at which point it is recorded (see nifti_writer.NiftiWriter.write).
+    """
+    from nifti_writer import get_nifti_writer  # nifti_writer imports this module
+    content_hash = image_hash(image)
+
+    def record(written):
+        if written.exception() is None:
+            record_output(manifest, out_dir, fname, facts, content_hash, info=info)
+
+    future = get_nifti_writer().write(image, os.path.join(out_dir, fname))
+    future.add_done_callback(record)  # called straight away unless the file is compressed in the background
+    return future
+
+
+def record_output(manifest, out_dir, fname, facts, content_hash, info=None):
+    """ Record an output that has already been written (atomically) to out_dir/fname, and save the manifest. Used
+    directly for outputs that are not a single sitk image. """
+    entry = dict(facts)
+    entry.update(info or {})
+    entry['key'] = output_key(facts)
+    entry['content_hash'] = content_hash
+    entry['size'] = output_size(os.path.join(out_dir, fname))
+    entry['written'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    with _manifest_lock:
+        manifest['outputs'][fname] = entry
+        save_manifest(out_dir, manifest)
+
+
+def tmp_path_for(save_path):
+    """ Temporary file name used to write save_path atomically (removed by load_manifest if left behind). """
+    out_dir, fname = os.path.split(save_path)
+    return os.path.join(out_dir, '%s%d-%s' % (TMP_PREFIX, os.getpid(), fname))
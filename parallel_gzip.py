@@ -0,0 +1,111 @@
+import os
+import gzip
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+'''Gzip compression on several cores.
+
+The data written to a ParallelGzipWriter is cut into chunks (4 MB by default) and every chunk is compressed as a gzip
+member of its own by a pool of threads (zlib releases the GIL while it compresses). The members are written to the
+file in order. A file of concatenated gzip members is a valid .gz file: gzip, zlib (and so ITK/SimpleITK), nibabel and
+python's gzip module all read it back as the concatenation of the chunks. The compressed file is slightly larger than a
+single-stream one, as every chunk starts with an empty dictionary.
+
+Typical use:
+    with ParallelGzipWriter(save_path, compresslevel=6) as f:
+        f.write(header)
+        f.write(array.data)
+'''
+
+CHUNK_BYTES = 4 << 20
+
+# Compression threads when none are given
+DEFAULT_THREADS = os.cpu_count() or 1
+
+
+def compress_member(data, compresslevel):
+    """ One complete gzip member (mtime 0, so the output only depends on the data). """
+    return gzip.compress(data, compresslevel=compresslevel, mtime=0)
+
+
+class ParallelGzipWriter:
+    """ File-like object writing a multi-member gzip file, compressing chunks of the data in a thread pool.
+
+    Args
+    ====
+    fpath : str
+        File to write (truncated).
+
+    compresslevel : int (default = 6)
+        zlib level, 1 (fastest) to 9 (smallest).
+
+    threads : int (default = None, one per CPU)
+        Ignored if executor is given.
+
+    chunk_bytes : int (default = CHUNK_BYTES)
+        Uncompressed size of each gzip member.
+
+    executor : concurrent.futures.Executor (default = None)
+        Pool to compress in, shared with other writers; None creates one for this file.
+    """
+
+    def __init__(self, fpath, compresslevel=6, threads=None, chunk_bytes=CHUNK_BYTES, executor=None):
+        self.compresslevel = compresslevel
+        self.chunk_bytes = chunk_bytes
+        self._own_executor = executor is None
+        if executor is None:
+            threads = threads or DEFAULT_THREADS
+            executor = ThreadPoolExecutor(max_workers=threads)
+        self._executor = executor
+        # Compressed members not written yet; bounded so memory stays at a few chunks per thread
+        self._max_pending = 2 * (threads or DEFAULT_THREADS)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._n_members = 0
+        self._file = open(fpath, 'wb')
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        start = 0
+        if self._buffer:
+            # Complete the partial chunk left over from the previous write
+            start = min(len(data), self.chunk_bytes - len(self._buffer))
+            self._buffer += data[:start]
+            if len(self._buffer) < self.chunk_bytes:
+                return len(data)
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while len(data) - start >= self.chunk_bytes:
+            self._submit(bytes(data[start:start + self.chunk_bytes]))
+            start += self.chunk_bytes
+        self._buffer += data[start:]
+        return len(data)
+
+    def _submit(self, chunk):
+        self._pending.append(self._executor.submit(compress_member, chunk, self.compresslevel))
+        self._n_members += 1
+        while len(self._pending) > self._max_pending:
+            self._file.write(self._pending.popleft().result())
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            if self._buffer or self._n_members == 0:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+        finally:
+            for future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            self._file.close()
+            if self._own_executor:
+                self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
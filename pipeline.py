@@ -0,0 +1,99 @@
+import queue
+import threading
+
+'''Runs a list of jobs through a chain of stages (e.g. read -> resample -> write), one thread per stage.
+
+Stages are connected by bounded queues, so while the last stage writes job N-1 the next one can resample job N and the
+first one read job N+1. Reading (file I/O), resampling (SimpleITK) and writing (zlib, see nifti_writer.py) all release
+the GIL, so the stages really do overlap. A stage blocks once the queue after it is full: at most queue_depth results
+wait between two stages, which (with the job each stage is working on) caps how many volumes are held in memory.
+
+The last stage runs in the calling thread. If any stage raises, the other stages stop after their current job and the
+exception is raised by run_pipeline.
+
+Typical use:
+    results = run_pipeline(cbct_jobs, [read_cbct, resample_cbct, write_cbct], queue_depth=1)
+'''
+
+_END = object()
+
+
+class _Failed:
+    # Passed downstream in place of a result when a stage raised
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def _put(outbox, item, stop):
+    # Blocking put that gives up once the pipeline is stopped
+    while not stop.is_set():
+        try:
+            outbox.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _received(inbox, stop):
+    # Results of the previous stage until it ends (or the pipeline is stopped); re-raises its failure
+    while not stop.is_set():
+        try:
+            item = inbox.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _END:
+            return
+        if isinstance(item, _Failed):
+            raise item.exception
+        yield item
+
+
+def _run_stage(stage, source, outbox, stop):
+    try:
+        for item in source:
+            if stop.is_set() or not _put(outbox, stage(item), stop):
+                return
+    except BaseException as e:
+        _put(outbox, _Failed(e), stop)
+        return
+    _put(outbox, _END, stop)
+
+
+def run_pipeline(jobs, stages, queue_depth=1):
+    """ Apply the stages in turn to every job, overlapping the stages of consecutive jobs.
+
+    Args
+    ====
+    jobs : iterable
+        Consumed by the first stage, in order.
+
+    stages : list of functions
+        Each one takes the result of the previous stage (the job, for the first one) and returns its own result.
+
+    queue_depth : int (default = 1)
+        Number of results that may wait between two consecutive stages.
+
+    Returns
+    =======
+    results : list
+        Results of the last stage, in the order of jobs.
+    """
+    if queue_depth < 1:
+        raise ValueError('queue_depth must be at least 1')
+    stop = threading.Event()
+    source = iter(jobs)
+    threads = []
+    for stage in stages[:-1]:
+        outbox = queue.Queue(maxsize=queue_depth)
+        thread = threading.Thread(target=_run_stage, args=(stage, source, outbox, stop), daemon=True)
+        thread.start()
+        threads.append(thread)
+        source = _received(outbox, stop)
+
+    try:
+        return [stages[-1](item) for item in source]
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
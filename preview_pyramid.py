@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+import SimpleITK as sitk
+from contextlib import contextmanager, ExitStack
+import sys
+sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
+from nifti_writer import get_nifti_writer
+from nifti_stream import image_geometry
+from output_manifest import tmp_path_for
+
+'''Downsampled previews (2x and 4x by default) of the image niftis, for browsing a patient without loading every
+full-resolution float32 volume.
+
+Each level is the mean of factor x factor x factor blocks of voxels (blocks at the far edges hold fewer voxels),
+stored either window-levelled as uint8 (mode 'uint8') or rounded to int16 (mode 'int16'). The previews of
+out_dir/<name>.nii.gz are written to out_dir/previews/<name>_x2.nii.gz, <name>_x4.nii.gz..., with the same orientation
+and physical extent as the full-resolution image (spacing times factor, origin at the centre of the first block), so
+they overlay it in ITK-SNAP. They carry no dicom tags.
+
+out_dir/previews/index.json lists the previews of every image of out_dir:
+    {"previews": {"CT_20210601.nii.gz": {"mode": "uint8", "window": [40, 400], "size": [512, 512, 120],
+                                         "spacing": [0.98, 0.98, 2.5],
+                                         "levels": {"2": {"fname": "previews/CT_20210601_x2.nii.gz",
+                                                          "size": [256, 256, 60], "spacing": [1.95, 1.95, 5.0]},
+                                                    "4": {...}}}}}
+(fname relative to out_dir), so an app can load the previews of a whole fraction series and open the full-resolution
+nifti only when needed.
+
+The previews are computed from the voxels as they are written, with no second read: write_previews for an image in
+memory (the converters), preview_slab_writer for volumes written a slab at a time (compound_create):
+    with preview_slab_writer(out_dir, fname, geometry, **preview_options('uint8', 'US')) as write_preview_slab:
+        for z0 in range(0, nz, slab_size):
+            write_slab(slab)
+            write_preview_slab(slab)
+'''
+
+PREVIEW_DIR = 'previews'
+INDEX_NAME = 'index.json'
+PREVIEW_FACTORS = (2, 4)
+PREVIEW_MODES = ('uint8', 'int16')
+
+# (level, width) of the uint8 window by kind of image: soft tissue for CT/CBCT (HU), the 8-bit range for ultrasound
+# (whose background, -1000, maps to 0)
+PREVIEW_WINDOWS = {'CT': (40, 400), 'US': (127.5, 255)}
+
+_index_lock = threading.Lock()
+
+
+def preview_options(previews, kind='CT'):
+    """ Keyword arguments of write_previews/preview_slab_writer from the previews setting of a converter.
+
+    Args
+    ====
+    previews : None, str or dict
+        None: no previews. A mode ('uint8' or 'int16'), or a dict of options (mode, factors, window).
+
+    kind : str (default = 'CT')
+        Key of PREVIEW_WINDOWS giving the default window.
+
+    Returns
+    =======
+    options : dict (None if previews is None)
+    """
+    if previews is None:
+        return None
+    options = {'mode': previews} if isinstance(previews, str) else dict(previews)
+    options.setdefault('mode', 'uint8')
+    options.setdefault('factors', PREVIEW_FACTORS)
+    options['factors'] = tuple(options['factors'])
+    if options['mode'] not in PREVIEW_MODES:
+        raise ValueError("Unknown preview mode '%s' (expected one of %s)" % (options['mode'], PREVIEW_MODES))
+    if options['mode'] == 'uint8':
+        options['window'] = tuple(options.get('window') or PREVIEW_WINDOWS[kind])
+    else:
+        options['window'] = None
+    return options
+
+
+def preview_fname(fname, factor):
+    """ Path, relative to the directory of fname, of its preview downsampled by factor. """
+    stem = fname[:-len('.nii.gz')] if fname.endswith('.nii.gz') else os.path.splitext(fname)[0]
+    return os.path.join(PREVIEW_DIR, '%s_x%d.nii.gz' % (stem, factor))
+
+
+def preview_geometry(geometry, factor):
+    """ (size, origin, spacing, direction) of the preview downsampled by factor of a volume with this geometry. """
+    size, origin, spacing, direction = geometry
+    new_size = tuple(-(-n // factor) for n in size)
+    new_spacing = tuple(s * factor for s in spacing)
+    # Centre of the first block of voxels
+    offset = np.reshape(direction, (3, 3)) @ ((factor - 1) / 2. * np.asarray(spacing))
+    new_origin = tuple((np.asarray(origin) + offset).tolist())
+    return new_size, new_origin, new_spacing, tuple(direction)
+
+
+def block_mean(array, factor):
+    """ Mean over factor x factor x factor blocks of a (z, y, x) array, as float32 (edge blocks may hold fewer
+    voxels). """
+    for axis in range(3):
+        n = array.shape[axis]
+        starts = np.arange(0, n, factor)
+        counts = np.diff(np.append(starts, n)).astype(np.float32)
+        array = np.add.reduceat(array, starts, axis=axis, dtype=np.float32)
+        shape = [1, 1, 1]
+        shape[axis] = -1
+        array /= counts.reshape(shape)
+    return array
+
+
+def preview_pixels(mean, mode, window=None):
+    """ Block means as preview voxels: window-levelled to 0-255 (mode 'uint8') or rounded (mode 'int16'). """
+    if mode == 'uint8':
+        level, width = window
+        pixels = (mean - (level - width / 2.)) * (255. / width)
+        np.clip(pixels, 0, 255, out=pixels)
+        return (pixels + 0.5).astype(np.uint8)
+    return np.clip(np.rint(mean), -32768, 32767).astype(np.int16)
+
+
+def read_preview_index(out_dir):
+    """ Preview index of out_dir ({'previews': {fname: entry}}); empty if there is none yet. """
+    fpath = os.path.join(out_dir, PREVIEW_DIR, INDEX_NAME)
+    if not os.path.isfile(fpath):
+        return {'previews': {}}
+    with open(fpath) as f:
+        return json.load(f)
+
+
+def _record_previews(out_dir, fname, entry):
+    # Read, update and atomically replace the index (other threads of this process may be recording previews too)
+    fpath = os.path.join(out_dir, PREVIEW_DIR, INDEX_NAME)
+    with _index_lock:
+        index = read_preview_index(out_dir)
+        index['previews'][fname] = entry
+        tmp_path = tmp_path_for(fpath)
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp_path, fpath)
+
+
+def has_previews(out_dir, fname, mode='uint8', factors=PREVIEW_FACTORS, window=None):
+    """ True if the index of out_dir lists previews of fname made with these options, and their files exist. """
+    entry = read_preview_index(out_dir)['previews'].get(fname)
+    if entry is None or entry['mode'] != mode or entry['window'] != (None if window is None else list(window)):
+        return False
+    if sorted(entry['levels']) != sorted(str(factor) for factor in factors):
+        return False
+    return all(os.path.isfile(os.path.join(out_dir, level['fname'])) for level in entry['levels'].values())
+
+
+class _PreviewLevel:
+    # Block means of the slabs written so far, downsampled by one factor; slices of an unfinished block are kept
+    # until the next slab (or the end) completes it
+
+    def __init__(self, factor, write_slab, mode, window):
+        self.factor = factor
+        self.write_slab = write_slab
+        self.mode = mode
+        self.window = window
+        self.pending = None
+
+    def add(self, slab):
+        if self.pending is not None:
+            slab = np.concatenate([self.pending, slab])
+        n_full = slab.shape[0] // self.factor * self.factor
+        if n_full:
+            self.write_slab(preview_pixels(block_mean(slab[:n_full], self.factor), self.mode, self.window))
+        self.pending = slab[n_full:].copy() if n_full < slab.shape[0] else None
+
+    def finish(self):
+        if self.pending is not None:
+            self.write_slab(preview_pixels(block_mean(self.pending, self.factor), self.mode, self.window))
+            self.pending = None
+
+
+@contextmanager
+def preview_slab_writer(out_dir, fname, geometry, mode='uint8', factors=PREVIEW_FACTORS, window=None):
+    """ Context manager giving a function that adds slabs of slices of out_dir/fname to its previews.
+
+    Args
+    ====
+    out_dir, fname : str
+        Directory and file name of the full-resolution nifti.
+
+    geometry : tuple
+        (size, origin, spacing, direction) of the full-resolution volume (nifti_stream.image_geometry).
+
+    mode : str (default = 'uint8')
+        'uint8' (window-levelled) or 'int16'.
+
+    factors : tuple of int (default = PREVIEW_FACTORS)
+        Downsampling factor of each level.
+
+    window : (level, width) (default = None)
+        Intensity window mapped to 0-255 in mode 'uint8' (see preview_options).
+
+    Yields
+    ======
+    write_preview_slab : function
+        write_preview_slab(array) with array of shape (slices, rows, columns), in increasing z. The previews are put in
+        place, and recorded in the index, once every slice has been added.
+    """
+    if mode == 'uint8' and window is None:
+        raise ValueError("Previews in mode 'uint8' need a window")
+    os.makedirs(os.path.join(out_dir, PREVIEW_DIR), exist_ok=True)
+    dtype = np.uint8 if mode == 'uint8' else np.int16
+    writer = get_nifti_writer()
+    entry = {'mode': mode, 'window': None if window is None else list(window), 'size': list(geometry[0]),
+             'spacing': list(geometry[2]), 'levels': {}}
+    with ExitStack() as stack:
+        levels = []
+        for factor in factors:
+            level_geometry = preview_geometry(geometry, factor)
+            level_fname = preview_fname(fname, factor)
+            write_slab = stack.enter_context(writer.slab_writer(os.path.join(out_dir, level_fname), level_geometry,
+                                                                dtype))
+            levels.append(_PreviewLevel(factor, write_slab, mode, window))
+            entry['levels'][str(factor)] = {'fname': level_fname, 'size': list(level_geometry[0]),
+                                            'spacing': list(level_geometry[2])}
+
+        def write_preview_slab(array):
+            for level in levels:
+                level.add(array)
+
+        yield write_preview_slab
+        for level in levels:
+            level.finish()
+    entry['written'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    _record_previews(out_dir, fname, entry)
+
+
+def write_previews(image, out_dir, fname, mode='uint8', factors=PREVIEW_FACTORS, window=None):
+    """ Write the previews of image (saved as out_dir/fname) and record them in the index of out_dir.
+
+    Args
+    ====
+    image : SimpleITK.Image
+        3D scalar image, read through a view of its buffer (not copied).
+
+    out_dir, fname, mode, factors, window
+        See preview_slab_writer.
+
+    Returns
+    =======
+    fnames : list of str
+        Paths of the previews, relative to out_dir.
+    """
+    with preview_slab_writer(out_dir, fname, image_geometry(image), mode, factors, window) as write_preview_slab:
+        write_preview_slab(sitk.GetArrayViewFromImage(image))
+    return [preview_fname(fname, factor) for factor in factors]
@@ -2,11 +2,13 @@ import pydicom as dicom
 import SimpleITK as sitk
 import matplotlib.pyplot as plt
 import numpy as np
-from numpy import linalg
 import sys
 import os
 sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
 from copy_dicom_tags import copy_dicom_tags
+from resample_cache import cached_resample
+from volume_reader import read_volume
+from nifti_writer import write_nifti
 
 '''Registers CBCT to CTref and writes to compressed nifti file to user-specified location.
 Details:
@@ -23,33 +25,39 @@ Inputs:
         all desired files and export in one go, otherwise everything will be mixed in one directory
     3. save_dir: full file path to the directory where you wish to save the nifti files. 
         i.e. save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/images/g01' 
+    4. cache_dir: optional directory of a resample_cache.py cache. A CBCT already resampled onto the same CT grid with
+        the same REG matrix (by this script or by raystation_dcmDump_to_nifti.py) is then taken from the cache instead
+        of being read and resampled again. The entry is labelled '<patient>/<CBCT_dir name>' (e.g. 'g01/CBCT_Jul01', patient
+        taken from the name of save_dir), see resample_cache.find_by_label.
+    5. cache_max_bytes: size limit of the cache (least recently used entries are evicted).
         
         
 Output:
     1. nii.gz file of CBCT that has been registered/resampled to the CTref.'''
 
-def CBCTdcm_to_nifti(CT_dir, CBCT_dir, save_dir):
+def CBCTdcm_to_nifti(CT_dir, CBCT_dir, save_dir, cache_dir=None, cache_max_bytes=None):
     # Make sitk CT image (reference)
     files_CT = np.array([os.path.join(CT_dir, fl) for fl in os.listdir(CT_dir) if "dcm" in fl and "CT" in fl])
-    dicoms = np.array([dicom.read_file(fl, stop_before_pixels = True) for fl in files_CT])
+    dicoms = np.array([dicom.dcmread(fl, stop_before_pixels = True) for fl in files_CT])
     locations = np.array([float(dcm.ImagePositionPatient[-1]) for dcm in dicoms])
     files_CT = files_CT[np.argsort(locations)]
-    CT = sitk.ReadImage(files_CT)
+    ct_dicoms = dicoms[np.argsort(locations)]
+    CT = read_volume(files_CT, headers=ct_dicoms)
 
 
     # Make sitk CBCT image (moving)
     files_CBCT = np.array([os.path.join(CBCT_dir, fl) for fl in os.listdir(CBCT_dir) if "dcm" in fl and "CT" in fl])
-    dicoms = np.array([dicom.read_file(fl, stop_before_pixels = True) for fl in files_CBCT])
+    dicoms = np.array([dicom.dcmread(fl, stop_before_pixels = True) for fl in files_CBCT])
     locations = np.array([float(dcm.ImagePositionPatient[-1]) for dcm in dicoms])
     files_CBCT = files_CBCT[np.argsort(locations)]
-    CBCT = sitk.ReadImage(files_CBCT)
+    cbct_dicoms = dicoms[np.argsort(locations)]
 
 
     # Get transformation matrix from reg file. Assume reg file in same directory as CBCT dcm files
     reg_file = np.array([os.path.join(CBCT_dir, fl) for fl in os.listdir(CBCT_dir) if "dcm" in fl and "REG" in fl])
     fpath = reg_file[0]
 
-    reg_dicom = dicom.read_file(fpath)
+    reg_dicom = dicom.dcmread(fpath)
     RegistrationSequence = reg_dicom.RegistrationSequence
     Item_2 = RegistrationSequence[1]
     MatrixRegistrationSequence = Item_2.MatrixRegistrationSequence
@@ -57,39 +65,31 @@ def CBCTdcm_to_nifti(CT_dir, CBCT_dir, save_dir):
     MatrixSequence = Item_1_1.MatrixSequence
     Item_1_2 = MatrixSequence[0]
     T = Item_1_2.FrameOfReferenceTransformationMatrix
-    T = np.asarray(T)
-    TM = np.reshape(T, (4,4))
-    TM = linalg.inv(TM)
+    T = [float(v) for v in T]
 
-    # Get 3x3 rotation sub-matrix
-    Mr = TM[0:3, 0:3]
-    r = Mr.ravel()
-
-    # Get offset
-    offset = TM[0:3,3]
-
-    # Apply transformation and resampling to CBCT image to register to CT image
-    affine = sitk.AffineTransform(3)
-    affine.SetMatrix(r)
-    affine.SetTranslation(offset)
-    CBCT_resample = sitk.Resample(CBCT, CT, affine, sitk.sitkLinear, -1024, sitk.sitkFloat32)
+    # Apply transformation and resampling to CBCT image to register to CT image (or fetch it from the cache)
+    cbct_sop_uids = [str(dcm.SOPInstanceUID) for dcm in cbct_dicoms]
+    cache_label = '%s/%s' % (os.path.basename(os.path.normpath(save_dir)), os.path.split(CBCT_dir)[1])  # 'g01/CBCT_Jul01'
+    CBCT_resample = cached_resample(cache_dir, cbct_sop_uids, T, CT, lambda: read_volume(files_CBCT, headers=cbct_dicoms),
+                                    label=cache_label, max_bytes=cache_max_bytes)
 
     #Generate name and path for saving compressed nifti. Assume source directory is named with modality and date (i.e. 'CBCT_Jun29')
     fname = (os.path.split(CBCT_dir))[1] + '.nii.gz'
     save_path = os.path.join(save_dir, fname)
 
     #Generate sample CT dicom for the purpose of copying the metadata
-    sample_ct_dcm = dicom.read_file(files_CT[0], stop_before_pixels = True)
+    sample_ct_dcm = dicom.dcmread(files_CT[0], stop_before_pixels = True)
     copy_dicom_tags(CBCT_resample, sample_ct_dcm, ignore_private=True)
 
     #Write registered CBCT to nifti
-    sitk.WriteImage(CBCT_resample, save_path, True)
+    write_nifti(CBCT_resample, save_path)
 
-CT_dir = "/Users/sblackledge/Documents/GENIUSII_exports/RayStation/g01/CT_full"
-CBCT_dir = "/Users/sblackledge/Documents/GENIUSII_exports/RayStation/g01/CBCT_Jul01"
-save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/images/g01'
+if __name__ == '__main__':
+    CT_dir = "/Users/sblackledge/Documents/GENIUSII_exports/RayStation/g01/CT_full"
+    CBCT_dir = "/Users/sblackledge/Documents/GENIUSII_exports/RayStation/g01/CBCT_Jul01"
+    save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/images/g01'
 
-CBCTdcm_to_nifti(CT_dir, CBCT_dir, save_dir)
+    CBCTdcm_to_nifti(CT_dir, CBCT_dir, save_dir)
 
 
 
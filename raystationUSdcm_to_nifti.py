@@ -1,11 +1,10 @@
 import os
-import numpy as np
-import SimpleITK as sitk
 import pydicom as dicom
 import sys
 sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
 from copy_dicom_tags import copy_dicom_tags
 from sitk_im_create_simple import sitk_im_create_simple
+from nifti_writer import write_nifti
 
 '''Writes US dicom exported from Raystation to compressed nifti file to user-specified location.
 Details:
@@ -35,7 +34,7 @@ def USdcm_to_nifti(dcm_dir_us, save_dir):
     USfiles = os.listdir(dcm_dir_us)
     USfiles = [x for x in USfiles if 'CT' in x] #US files names have CT prefix even though they aren't CT images
     sample_us_fpath = os.path.join(dcm_dir_us, USfiles[0])
-    sample_us_dcm = dicom.read_file(sample_us_fpath)
+    sample_us_dcm = dicom.dcmread(sample_us_fpath)
 
     copy_dicom_tags(us_sitk, sample_us_dcm, ignore_private=True)
 
@@ -43,8 +42,9 @@ def USdcm_to_nifti(dcm_dir_us, save_dir):
     USdate = os.path.basename(dcm_dir_us)
     fname = USdate + '.nii.gz'
     fpath_US_nifti = os.path.join(save_dir, fname)
-    sitk.WriteImage(us_sitk, fpath_US_nifti, True)
+    write_nifti(us_sitk, fpath_US_nifti)
 
-save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/images/g01'
-dcm_dir_us = '/Users/sblackledge/Documents/GENIUSII_exports/RayStation/g01/US_June20'
-USdcm_to_nifti(dcm_dir_us, save_dir)
\ No newline at end of file
+if __name__ == '__main__':
+    save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/images/g01'
+    dcm_dir_us = '/Users/sblackledge/Documents/GENIUSII_exports/RayStation/g01/US_June20'
+    USdcm_to_nifti(dcm_dir_us, save_dir)
\ No newline at end of file
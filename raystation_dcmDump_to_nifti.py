@@ -1,13 +1,22 @@
 import os
-import numpy as np
-import SimpleITK as sitk
 import pydicom as dicom
 import sys
 
 sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
 from copy_dicom_tags import copy_dicom_tags
-from create_rtstruct_mask_SB import create_rtstruct_masks
-from utils_RayStation import transformation_from_reg_dcm, get_date_name
+from create_rtstruct_mask_SB import iter_rtstruct_masks
+from rtstruct_reader import read_rtstruct, rtstruct_rois
+from utils_RayStation import get_date_name, fname_from_date
+from dicom_catalog import load_series_table, catalog_work_list
+from dicom_indexer import series_file_count, series_voxels
+from output_manifest import load_manifest, is_up_to_date, write_output
+from mask_formats import plan_mask_outputs, write_mask_outputs
+from resample_cache import lookup_resample, resample_and_store
+from volume_reader import read_series_volume
+from volume_store import output_fname
+from preview_pyramid import preview_options, has_previews, write_previews
+from pipeline import run_pipeline
+from instrumentation import stage, image_bytes
 
 '''Organizes CT and CBCT images exported from RayStation based on Series Instance UID. 
 Saves as nifti files to user-specified directory. 
@@ -27,18 +36,45 @@ Inputs:
     3. patient_name: str - string indicating name of patient. Example: 'g02'
     4. masks_of_interest: list of strings: exact names of masks that should be exported and saved as niftis.
         example: masks_of_interest = ['Bladder', 'PTV45_1', 'PTV45_2', 'PTV45_3', 'PTV45_Robust', 'Rectum', 'CTV-E', 'CTV-T HRinit', 'CTV-T LRinit_1_Full']
+    5. workers: int - number of processes used to read the dicom headers and to rasterize the structures (default: one
+    per CPU). See dicom_indexer.py and create_rtstruct_mask_SB.py
+    6. catalog_path: str - optional path of a dicom_catalog.py SQLite catalog. If given, only files that are new or changed
+    since the last run are read, and the work list (the approved RTSTRUCT and the REG files of the CBCTs) is taken from
+    the catalog queries (see dicom_catalog.catalog_work_list).
+    7. mask_format: str - 'nifti' (default, one nifti per structure), 'labelmap' (a single bitfield structures.nii.gz
+    with a structures.json label table) or 'rle' (run-length encoded structures.rle). See mask_formats.py
+    8. resample_cache_dir: str - optional directory of a resample_cache.py cache of resampled CBCTs, so a CBCT already
+    resampled onto the same CT grid with the same REG matrix is not read or resampled again.
+    9. resample_cache_bytes: int - size limit of that cache (least recently used entries are evicted).
+    10. queue_depth: int - the CT and CBCTs are read, resampled and written in a pipeline (see pipeline.py), so that
+    reading CBCT N+1, resampling CBCT N and writing CBCT N-1 overlap. queue_depth (default: 1) volumes at most wait
+    between two stages, which caps the memory used.
+    11. tag_filter: dict - optional include, exclude and/or max_sequence_depth (see get_python_tags.get_dicom_tags)
+    selecting the dicom tags stored as metadata of the images and masks (default: every public tag). The tags of a
+    dataset are only converted to strings once, however many images they are copied to.
+    12. previews: str or dict - optional 2x and 4x downsampled previews of the CT and CBCTs, written to
+    images/<patient>/previews with an index.json (see preview_pyramid.py): 'uint8' (soft tissue window), 'int16', or a
+    dict of preview_pyramid options (mode, factors, window). They are computed from each image as it is written.
+    13. output_format: str - 'nifti' (default, .nii.gz) or 'volume_store': the images and the 'nifti'/'labelmap' masks
+    are written as uncompressed, memory-mappable <name>.vol volume stores, whose slices and sub-blocks can be read
+    without loading the whole volume (see volume_store.py).
 
 Output:
     Nifti file for every (1) dcm image dataset and (2) relevant structure from the RTSTRUCT.dcm file exported from RayStation
     Note: no date or name information is stored in the metadata of these nifti files, so they are considered fully anonymized.
     HOWEVER, the nifti filename contains teh study date by default. I recommend changing this manually retrospectively once
     all desired data has been converted to nifti format (e.g. Fraction1.nii.gz).
+    A manifest.json in each output directory records what every nifti was made from. Outputs whose inputs have not
+    changed since the last run are skipped (see output_manifest.py); if nothing needs converting, no image is read and
+    the returned ref CT image is None.
+    Returns the series table, the ref CT sitk image and the paths of the masks written in this run.
 '''
 
 
-def DICOMRawData_to_nifti(ct_directory, save_dir, patient_name, masks_of_interest):
+def DICOMRawData_to_nifti(ct_directory, save_dir, patient_name, masks_of_interest, workers=None, catalog_path=None,
+                          mask_format='nifti', resample_cache_dir=None, resample_cache_bytes=None, queue_depth=1,
+                          tag_filter=None, previews=None, output_format='nifti'):
     study_uids_blacklist = {}
-    floc_el = 0x19100c  # Used to store the file location in read dicoms
 
     # Create 'images' sub-directory.
     im_dir = os.path.join(save_dir, 'images', patient_name)
@@ -52,106 +88,157 @@ def DICOMRawData_to_nifti(ct_directory, save_dir, patient_name, masks_of_interes
     if not CHECK_FOLDER:
         os.makedirs(mask_dir)
 
-    # Load in the ct dicoms and RTSTRUCT dicoms as separate lists
-    ct_dicoms = {}
-    reg_dicoms = []
-
-    for dicom_file in os.listdir(ct_directory):
-        if dicom_file == ".DS_Store":
-            continue
-
-        try:
-            dicom_path = os.path.join(ct_directory, dicom_file)
-            dcm = dicom.read_file(dicom_path, stop_before_pixels=True)
-            series_uid = dcm.SeriesInstanceUID
-            modality = dcm.Modality
-            if dcm.StudyInstanceUID in study_uids_blacklist.keys():
-                break
-
-            # Both CT and CBCT labeled with modality 'CT'
-            if modality == 'CT':
-                if not series_uid in ct_dicoms:
-                    ct_dicoms[series_uid] = []
-                dcm.add_new(floc_el, "ST", dicom_path)
-                ct_dicoms[series_uid].append(dcm)
-
-            if modality == 'RTSTRUCT': #Should only be one RS file in directory.
-                ref_rtstruct = dicom.read_file(dicom_path, stop_before_pixels=True)
-                ref_rtstruct.add_new(floc_el, "ST", dicom_path)
-                ref_rtstruct_uid = ref_rtstruct.SOPInstanceUID
-
-            if modality == 'REG':
-                reg_dcm = dicom.read_file(dicom_path, stop_before_pixels=True)
-                reg_dcm.add_new(floc_el, "ST", dicom_path)
-                reg_dicoms.append(reg_dcm)
-
-        except:
-            raise
-
-    # Now organise files in CT lists by ascending slice location
-    for series_uid in ct_dicoms:
-        slice_locations = [float(dcm.ImagePositionPatient[-1]) for dcm in ct_dicoms[series_uid]]
-        ct_dicoms[series_uid] = np.array(ct_dicoms[series_uid])[np.argsort(slice_locations)].tolist()
+    # Index the headers of every file in the dump once (slices of each series sorted by ascending slice location)
+    with stage('header_scan', patient=patient_name) as s:
+        series_table = load_series_table(ct_directory, patient_name, catalog_path=catalog_path, workers=workers)
+        s.add(files=series_file_count(series_table))
+
+    # Both CT and CBCT labeled with modality 'CT'
+    ct_dicoms = {uid: series for uid, series in series_table['series'].items()
+                 if series['modality'] == 'CT' and series['study_uid'] not in study_uids_blacklist}
+    if catalog_path is not None:
+        # Work list from the catalog queries: the approved RTSTRUCT and the REG files of the CBCTs, oldest first
+        ref_rtstruct_record, reg_dicoms = catalog_work_list(catalog_path, patient_name, ct_directory)
+        if ref_rtstruct_record is None:
+            print("Could not find an RTSTRUCT for patient: %s" % patient_name)
+            return series_table, None, []
+    else:
+        # Should only be one RS file in directory.
+        ref_rtstruct_record = series_table['rtstruct'][-1]
+        reg_dicoms = series_table['reg']
+    reg_dicoms = [reg for reg in reg_dicoms if reg['study_uid'] not in study_uids_blacklist]
+
+    ref_rtstruct_uid = ref_rtstruct_record['sop_uid']
+    ref_rtstruct = read_rtstruct(ref_rtstruct_record['path'])  # contours are only read for the masks written
 
     # Find the CT image corresponding to the RTSTRUCT and save to nifti
-    ref_ct_series_uid = ref_rtstruct[0x3006, 0x10][0][0x3006, 0x12][0][0x3006, 0x14][0][0x20, 0xe].value
-    for series_uid in ct_dicoms:
-        if series_uid == ref_ct_series_uid:
-            ref_ct_study = ct_dicoms[series_uid]
-            study_date = ref_ct_study[0].ContentDate #extract date from first file
-            ref_ct_image = sitk.ReadImage([dcm[floc_el].value for dcm in ref_ct_study])  # sitk object for ref CT
-            copy_dicom_tags(ref_ct_image, ref_ct_study[0], ignore_private=True)
-            ref_ct_image.SetMetaData('0008,0020', study_date)
-            ref_ct_image.SetMetaData('0008,103e', 'CT')
-
-            fname = get_date_name(ref_ct_image)
-
-            # Save CT to images sub-directory in 'nifti dump' folder
-            save_path = os.path.join(im_dir, fname)
-            sitk.WriteImage(ref_ct_image, save_path, True)
-
-            if ref_ct_study is None:
-                print("Could not find a CT series corresponding to RTSTRUCT: %s" % str(ref_rtstruct_uid))
-                continue
-
-    #Find CBCT corresponding to REG files, generated resampled CBCT (to match ref CT), and save as nifti
-    for reg_dicom in reg_dicoms:
-        ref_ID = reg_dicom.ReferencedSeriesSequence[-1].SeriesInstanceUID
-        for series_uid in ct_dicoms:
-            if series_uid == ref_ID:
-                test = ct_dicoms[series_uid]
-                CBCT_image = sitk.ReadImage([dcm[floc_el].value for dcm in test]) #sitk object for CBCT
-                study_date = test[0].ContentDate
-                r, offset = transformation_from_reg_dcm(reg_dicom)
-
-                # Apply transformation and resampling to CBCT image to register to CT image
-                affine = sitk.AffineTransform(3)
-                affine.SetMatrix(r)
-                affine.SetTranslation(offset)
-                CBCT_resample = sitk.Resample(CBCT_image, ref_ct_image, affine, sitk.sitkLinear, -1024, sitk.sitkFloat32)
-                copy_dicom_tags(CBCT_resample, ref_ct_study[0], ignore_private=True)
-                CBCT_resample.SetMetaData('0008,0020', study_date)
-                CBCT_resample.SetMetaData('0008,103e', 'CBCT')
-
-                fname = get_date_name(CBCT_resample)
-
-                # Save CBCTs to images sub-directory in 'nifti dump' folder
-                save_path = os.path.join(im_dir, fname)
-                sitk.WriteImage(CBCT_resample, save_path, True)
-
-    # Generate masks of each structure in RTSTRUCT.
-    rtstruct_images_sub = create_rtstruct_masks(ref_rtstruct, ref_ct_image, masks_of_interest)  # output: list of sitk objects
-
-    for im in rtstruct_images_sub:
-        structure_name = im.GetMetaData("ContourName") + '.nii.gz'
-        fpath_structure = os.path.join(mask_dir, structure_name)
-        sitk.WriteImage(im, fpath_structure, True)
-
-    return ct_dicoms, ref_ct_image, rtstruct_images_sub
-
-masks_of_interest = ['Bladder', 'PTV45_1', 'PTV45_2', 'PTV45_3', 'PTV45_Robust', 'Rectum', 'CTV-E', 'CTV-T HRinit', 'CTV-T LRinit_1_Full']
-patient_name = 'g02'
-ct_directory = '/Users/sblackledge/Documents/GENIUSII_exports/RayStation/g02/RayStation_CTdump'
-save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump'
-ct_dicoms, ct_example, rtstruct_sitk = DICOMRawData_to_nifti(ct_directory, save_dir, patient_name, masks_of_interest)
+    ref_ct_series_uid = ref_rtstruct_record['ref_series_uid']
+    if ref_ct_series_uid not in ct_dicoms:
+        print("Could not find a CT series corresponding to RTSTRUCT: %s" % str(ref_rtstruct_uid))
+        return series_table, None, []
+
+    ref_ct_study = ct_dicoms[ref_ct_series_uid]
+    study_date = ref_ct_study['content_date'] #extract date from first file
+
+    # Work out which outputs are missing or stale (see output_manifest.py) before reading any image
+    im_manifest = load_manifest(im_dir)
+    mask_manifest = load_manifest(mask_dir)
+
+    ct_fname = output_fname(fname_from_date(study_date, 'CT'), output_format)
+    ct_facts = {'sources': ref_ct_study['sop_uids']}
+    tag_facts = {} if tag_filter is None else {'tag_filter': tag_filter}
+    ct_facts.update(tag_facts)
+    preview_opts = preview_options(previews, 'CT')
 
+    def is_done(fname, facts):
+        # Written from the same inputs, and with its previews if they are asked for
+        if not is_up_to_date(im_manifest, im_dir, fname, facts):
+            return False
+        return preview_opts is None or has_previews(im_dir, fname, **preview_opts)
+
+    write_ct = not is_done(ct_fname, ct_facts)
+
+    cbct_jobs = []
+    for reg_dicom in reg_dicoms:
+        ref_ID = reg_dicom['ref_series_uid']
+        if ref_ID in ct_dicoms:
+            test = ct_dicoms[ref_ID]
+            fname = output_fname(fname_from_date(test['content_date'], 'CBCT'), output_format)
+            facts = {'sources': test['sop_uids'], 'reference': ref_ct_study['sop_uids'],
+                     'reg_matrix': reg_dicom['reg_matrix'], **tag_facts}
+            if not is_done(fname, facts):
+                cbct_jobs.append((test, reg_dicom, facts))
+    # Largest CBCTs first, so a slow series does not start last and stretch the run
+    cbct_jobs.sort(key=lambda job: series_voxels(job[0]), reverse=True)
+
+    structure_names = [roi['name'] for roi in rtstruct_rois(ref_rtstruct)]
+    structure_names = [name for name in structure_names if masks_of_interest is None or name in masks_of_interest]
+    mask_outputs = plan_mask_outputs(structure_names, mask_format,
+                                     dict({'sources': [ref_rtstruct_uid], 'reference': ref_ct_study['sop_uids']},
+                                          **tag_facts), output_format)
+    stale_outputs = [output for output in mask_outputs
+                     if not is_up_to_date(mask_manifest, mask_dir, output[0], output[2])]
+    stale_masks = [name for name in structure_names if any(name in output[1] for output in stale_outputs)]
+
+    ref_ct_image = None
+    mask_paths = []
+    if not (write_ct or cbct_jobs or stale_masks):
+        print("%s: all outputs up to date" % patient_name)
+        return series_table, ref_ct_image, mask_paths
+
+    ref_ct_header = dicom.dcmread(ref_ct_study['files'][0], stop_before_pixels=True)  # first slice, source of the tags
+    with stage('read_series', patient=patient_name, series_uid=ref_ct_series_uid, modality='CT') as s:
+        ref_ct_image = read_series_volume(ref_ct_study, workers=workers)  # sitk object for ref CT
+        s.add(files=len(ref_ct_study['files']), bytes=image_bytes(ref_ct_image))
+    copy_dicom_tags(ref_ct_image, ref_ct_header, ignore_private=True, **(tag_filter or {}))
+    ref_ct_image.SetMetaData('0008,0020', study_date)
+    ref_ct_image.SetMetaData('0008,103e', 'CT')
+
+    # Save the CT, and the CBCTs corresponding to the REG files resampled to match the ref CT, to the images
+    # sub-directory in 'nifti dump' folder. Reading, resampling and writing run as the stages of a pipeline. The CT has
+    # already been read (it is the reference grid), so it only goes through the writer stage (reg_dicom None), ahead of
+    # the CBCTs (largest first).
+    def read_cbct(job):
+        test, reg_dicom, facts = job
+        if reg_dicom is None:
+            return job, ref_ct_image, None
+        # A CBCT already resampled onto this CT with this REG is not read again
+        CBCT_resample = lookup_resample(resample_cache_dir, test['sop_uids'], reg_dicom['reg_matrix'], ref_ct_image)
+        cbct_image = None
+        if CBCT_resample is None:
+            with stage('read_series', patient=patient_name, series_uid=test['series_uid'], modality='CBCT') as s:
+                cbct_image = read_series_volume(test, workers=workers)
+                s.add(files=len(test['files']), bytes=image_bytes(cbct_image))
+        return job, CBCT_resample, cbct_image
+
+    def resample_cbct(read):
+        (test, reg_dicom, facts), CBCT_resample, cbct_image = read
+        if reg_dicom is None:
+            return ref_ct_image, ct_fname, facts
+        study_date = test['content_date']
+
+        # Apply transformation and resampling to CBCT image to register to CT image (and keep it in the cache)
+        if CBCT_resample is None:
+            label = '%s/%s' % (patient_name, fname_from_date(study_date, 'CBCT')[:-len('.nii.gz')])
+            with stage('resample', patient=patient_name, series_uid=test['series_uid']) as s:
+                CBCT_resample = resample_and_store(resample_cache_dir, test['sop_uids'], reg_dicom['reg_matrix'],
+                                                   ref_ct_image, cbct_image, label=label,
+                                                   max_bytes=resample_cache_bytes)
+                s.add(bytes=image_bytes(CBCT_resample))
+        copy_dicom_tags(CBCT_resample, ref_ct_header, ignore_private=True, **(tag_filter or {}))
+        CBCT_resample.SetMetaData('0008,0020', study_date)
+        CBCT_resample.SetMetaData('0008,103e', 'CBCT')
+        return CBCT_resample, output_fname(get_date_name(CBCT_resample), output_format), facts
+
+    def write_image(resampled):
+        image, fname, facts = resampled
+        with stage('write_nifti', patient=patient_name, fname=fname) as s:
+            write_output(image, im_dir, fname, im_manifest, facts)
+            s.add(files=1, bytes=image_bytes(image))
+        if preview_opts is not None:
+            with stage('previews', patient=patient_name, fname=fname) as s:
+                write_previews(image, im_dir, fname, **preview_opts)
+                s.add(files=len(preview_opts['factors']), bytes=image_bytes(image))
+        return fname
+
+    image_jobs = ([(ref_ct_study, None, ct_facts)] if write_ct else []) + cbct_jobs
+    run_pipeline(image_jobs, [read_cbct, resample_cbct, write_image], queue_depth=queue_depth)
+
+    # Generate masks of each (missing or stale) structure in RTSTRUCT, writing each one as soon as it is rasterized.
+    if stale_masks:
+        with stage('masks', patient=patient_name, structures=len(stale_masks), mask_format=mask_format) as s:
+            masks = iter_rtstruct_masks(ref_rtstruct, ref_ct_image, stale_masks, workers=workers,
+                                        tag_filter=tag_filter)
+            mask_paths = write_mask_outputs(masks, stale_outputs, mask_format, mask_dir, mask_manifest,
+                                            info={'masks_of_interest': masks_of_interest})
+            s.add(files=len(mask_paths))
+
+    return series_table, ref_ct_image, mask_paths
+
+
+if __name__ == '__main__':
+    masks_of_interest = ['Bladder', 'PTV45_1', 'PTV45_2', 'PTV45_3', 'PTV45_Robust', 'Rectum', 'CTV-E', 'CTV-T HRinit', 'CTV-T LRinit_1_Full']
+    patient_name = 'g02'
+    ct_directory = '/Users/sblackledge/Documents/GENIUSII_exports/RayStation/g02/RayStation_CTdump'
+    save_dir = '/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump'
+    series_table, ct_example, mask_paths = DICOMRawData_to_nifti(ct_directory, save_dir, patient_name, masks_of_interest)
@@ -0,0 +1,217 @@
+import os
+import json
+import SimpleITK as sitk
+import sys
+sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
+from utils_RayStation import transformation_from_matrix
+from output_manifest import output_key, write_image_atomic, tmp_path_for
+
+'''Content-addressed cache of CBCTs resampled onto a reference (planning CT) grid.
+
+A resampled CBCT only depends on the CBCT slices (SOPInstanceUIDs), the REG matrix, the geometry of the reference grid
+and the interpolation settings. Those facts are hashed into the key of the cache entry, so a re-run, or any other tool
+asking for the same CBCT on the same grid, gets the stored volume back without reading or resampling the CBCT again.
+
+Each entry is a <key>.mha file (uncompressed MetaImage, fast to read) and a
+<key>.json holding its facts and labels (e.g. 'g02/CBCT_Jun29'; see find_by_label). The cache is bounded in size:
+after every store the least recently used entries (by file modification time, refreshed on every hit) are removed
+until the cache fits in max_bytes.
+
+When reading and resampling run as separate stages (see pipeline.py), lookup_resample and resample_and_store are the
+two halves of cached_resample.
+
+Typical use:
+    CBCT_resample = cached_resample(cache_dir, cbct_series['sop_uids'], reg['reg_matrix'], ref_ct_image,
+                                    lambda: read_series_volume(cbct_series), label='g02/CBCT_Jun29',
+                                    max_bytes=20e9)
+'''
+
+CACHE_VERSION = 1
+
+INTERPOLATORS = {'linear': sitk.sitkLinear, 'nearest': sitk.sitkNearestNeighbor, 'bspline': sitk.sitkBSpline}
+
+
+def resample_facts(cbct_sop_uids, reg_matrix, reference, interpolator='linear', default_value=-1024.):
+    """ Everything a resampled CBCT depends on (the cache key is output_key of these facts).
+
+    Args
+    ====
+    cbct_sop_uids : list of str
+        SOPInstanceUIDs of the CBCT slices, in slice order.
+
+    reg_matrix : list of 16 float
+        FrameOfReferenceTransformationMatrix of the REG file.
+
+    reference : SimpleITK.Image or tuple
+        Reference image, or its (size, origin, spacing, direction).
+
+    interpolator : str (default = 'linear')
+        Key of INTERPOLATORS.
+
+    default_value : float (default = -1024.)
+        Value outside the CBCT.
+    """
+    if isinstance(reference, sitk.Image):
+        reference = (reference.GetSize(), reference.GetOrigin(), reference.GetSpacing(), reference.GetDirection())
+    size, origin, spacing, direction = reference
+    return {'version': CACHE_VERSION, 'sources': list(cbct_sop_uids), 'reg_matrix': [float(v) for v in reg_matrix],
+            'size': list(size), 'origin': list(origin), 'spacing': list(spacing), 'direction': list(direction),
+            'interpolator': interpolator, 'default_value': float(default_value), 'pixel_type': 'float32'}
+
+
+def resample_cbct(cbct_image, reference_image, reg_matrix, interpolator='linear', default_value=-1024.):
+    """ Apply the REG transformation to the CBCT and resample it onto the grid of reference_image (float32). """
+    r, offset = transformation_from_matrix(reg_matrix)
+    affine = sitk.AffineTransform(3)
+    affine.SetMatrix(r)
+    affine.SetTranslation(offset)
+    return sitk.Resample(cbct_image, reference_image, affine, INTERPOLATORS[interpolator], default_value,
+                         sitk.sitkFloat32)
+
+
+def _entry_paths(cache_dir, key):
+    return os.path.join(cache_dir, key + '.mha'), os.path.join(cache_dir, key + '.json')
+
+
+def get_resampled(cache_dir, facts):
+    """ The cached image for these facts, or None. A hit marks the entry as recently used. """
+    image_path, info_path = _entry_paths(cache_dir, output_key(facts))
+    if not (os.path.isfile(image_path) and os.path.isfile(info_path)):
+        return None
+    try:
+        image = sitk.ReadImage(image_path)
+    except RuntimeError:
+        return None  # removed by another process while being read
+    os.utime(image_path)
+    return image
+
+
+def put_resampled(cache_dir, facts, image, label=None, max_bytes=None):
+    """ Store image under the key of facts (adding label to its labels), then evict down to max_bytes. """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = output_key(facts)
+    image_path, info_path = _entry_paths(cache_dir, key)
+
+    info = {'facts': facts, 'labels': []}
+    if os.path.isfile(info_path):
+        with open(info_path) as f:
+            info['labels'] = json.load(f).get('labels', [])
+    if label is not None and label not in info['labels']:
+        info['labels'].append(label)
+
+    write_image_atomic(image, image_path, False)
+    tmp_path = tmp_path_for(info_path)
+    with open(tmp_path, 'w') as f:
+        json.dump(info, f, indent=1)
+    os.replace(tmp_path, info_path)
+
+    if max_bytes is not None:
+        evict(cache_dir, max_bytes, keep=key)
+    return key
+
+
+def evict(cache_dir, max_bytes, keep=None):
+    """ Remove least recently used entries until the cache holds at most max_bytes (entry keep is never removed).
+    Returns the keys removed. """
+    entries = []
+    for fl in os.listdir(cache_dir):
+        if fl.endswith('.mha'):
+            stat = os.stat(os.path.join(cache_dir, fl))
+            entries.append((stat.st_mtime, fl[:-len('.mha')], stat.st_size))
+
+    total = sum(size for _, _, size in entries)
+    removed = []
+    for mtime, key, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        for fpath in _entry_paths(cache_dir, key):
+            if os.path.exists(fpath):
+                os.remove(fpath)
+        total -= size
+        removed.append(key)
+    return removed
+
+
+def lookup_resample(cache_dir, cbct_sop_uids, reg_matrix, reference_image, interpolator='linear',
+                    default_value=-1024.):
+    """ The cached CBCT resampled onto the grid of reference_image, or None (also if cache_dir is None). Arguments as
+    for cached_resample. """
+    if cache_dir is None:
+        return None
+    image = get_resampled(cache_dir, resample_facts(cbct_sop_uids, reg_matrix, reference_image, interpolator,
+                                                    default_value))
+    if image is not None:
+        image.CopyInformation(reference_image)  # same grid (part of the key), in full precision
+    return image
+
+
+def resample_and_store(cache_dir, cbct_sop_uids, reg_matrix, reference_image, cbct_image, label=None, max_bytes=None,
+                       interpolator='linear', default_value=-1024.):
+    """ Resample cbct_image onto the grid of reference_image and store it in the cache (unless cache_dir is None).
+    Arguments as for cached_resample. """
+    image = resample_cbct(cbct_image, reference_image, reg_matrix, interpolator, default_value)
+    if cache_dir is not None:
+        facts = resample_facts(cbct_sop_uids, reg_matrix, reference_image, interpolator, default_value)
+        put_resampled(cache_dir, facts, image, label=label, max_bytes=max_bytes)
+    return image
+
+
+def cached_resample(cache_dir, cbct_sop_uids, reg_matrix, reference_image, read_cbct, label=None, max_bytes=None,
+                    interpolator='linear', default_value=-1024.):
+    """ The CBCT resampled onto the grid of reference_image, from the cache if possible.
+
+    Args
+    ====
+    cache_dir : str
+        None resamples without caching.
+
+    cbct_sop_uids, reg_matrix : see resample_facts
+
+    reference_image : SimpleITK.Image
+        Reference (planning CT) image.
+
+    read_cbct : function
+        Called without arguments to read the CBCT (SimpleITK.Image), only if it is not in the cache.
+
+    label : str (default = None)
+        Human readable name recorded with the entry, e.g. 'g02/CBCT_Jun29'.
+
+    max_bytes : int (default = None, unbounded)
+        Size of the cache after storing a new entry.
+
+    interpolator, default_value : see resample_facts
+
+    Returns
+    =======
+    CBCT_resample : SimpleITK.Image (float32) on the grid of reference_image
+    """
+    image = lookup_resample(cache_dir, cbct_sop_uids, reg_matrix, reference_image, interpolator, default_value)
+    if image is not None:
+        return image
+    return resample_and_store(cache_dir, cbct_sop_uids, reg_matrix, reference_image, read_cbct(), label=label,
+                              max_bytes=max_bytes, interpolator=interpolator, default_value=default_value)
+
+
+def find_by_label(cache_dir, label):
+    """ Most recently used cached image with this label (e.g. 'g02/CBCT_Jun29'), or None. Returns (image, facts). """
+    found = []
+    if os.path.isdir(cache_dir):
+        for fl in os.listdir(cache_dir):
+            if not fl.endswith('.json'):
+                continue
+            image_path, info_path = _entry_paths(cache_dir, fl[:-len('.json')])
+            try:
+                with open(info_path) as f:
+                    info = json.load(f)
+                if label in info['labels']:
+                    found.append((os.path.getmtime(image_path), image_path, info['facts']))
+            except (OSError, ValueError):
+                continue
+    if not found:
+        return None, None
+
+    mtime, image_path, facts = max(found)
+    os.utime(image_path)
+    return sitk.ReadImage(image_path), facts
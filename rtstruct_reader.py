@@ -0,0 +1,85 @@
+import numpy as np
+import pydicom as dicom
+from pydicom.tag import Tag
+
+'''Reads the contours of selected structures of an RTSTRUCT without decoding the others.
+
+A RayStation RTSTRUCT holds dozens of ROIs (external, couch, helper structures...) with hundreds of thousands of
+vertices in the ContourData of the ROIContourSequence. pydicom turns each ContourData into a list of python DSfloat
+objects as soon as it is accessed. Here:
+    1. the file is read with defer_size (read_rtstruct), so large top-level values are left on disk until used (pydicom
+    does not defer sequences: the items of ROIContourSequence are parsed when it is first accessed, their ContourData
+    being kept as raw bytes);
+    2. the ROIs are indexed by number and name from StructureSetROISequence (rtstruct_rois);
+    3. only the ContourData of the requested ROIs is decoded, straight from the raw bytes of the element into a numpy
+    float array (roi_contours, decode_contour_data). The contours of other ROIs are never converted to numbers.
+
+Typical use:
+    rtstruct = read_rtstruct(ref_rtstruct_record['path'])
+    names = [roi['name'] for roi in rtstruct_rois(rtstruct)]
+    for name, contours in roi_contours(rtstruct, ['Bladder', 'Rectum']):
+        ...  # contours: list of (n_points, 3) float arrays (x, y, z in mm), one per contour
+'''
+
+# Elements larger than this are read from the file only when accessed
+DEFER_SIZE = 4096
+
+CONTOUR_DATA = Tag(0x3006, 0x0050)
+
+
+def read_rtstruct(fpath, defer_size=DEFER_SIZE):
+    """ pydicom dataset of an RTSTRUCT read with defer_size (the file must stay in place while it is used). """
+    return dicom.dcmread(fpath, stop_before_pixels=True, defer_size=defer_size)
+
+
+def rtstruct_rois(rtstruct):
+    """ The ROIs of an RTSTRUCT that have contours, in ROIContourSequence order.
+
+    Returns
+    =======
+    rois : list of dict
+        'number' (ROINumber), 'name' (ROIName) and 'item' (index of the ROI in ROIContourSequence).
+    """
+    names = {int(d.ROINumber): d.ROIName for d in rtstruct.StructureSetROISequence}
+    return [{'number': int(item.ReferencedROINumber), 'name': names[int(item.ReferencedROINumber)], 'item': i}
+            for i, item in enumerate(rtstruct.ROIContourSequence)]
+
+
+def decode_contour_data(contour):
+    """ ContourData of one ContourSequence item as an (n_points, 3) float array, decoded from the raw element bytes. """
+    element = contour.get_item(CONTOUR_DATA)
+    value = element.value
+    if isinstance(value, (bytes, bytearray)):
+        # Decimal strings separated by backslashes (padded with a space to an even length)
+        value = bytes(value).strip()
+        xyz = np.array(value.split(b'\\') if value else [], dtype=np.float64)
+    else:
+        # Already converted by pydicom (e.g. a dataset built in memory)
+        xyz = np.asarray(value, dtype=np.float64)
+    return xyz.reshape(-1, 3)
+
+
+def roi_contours(rtstruct, names=None):
+    """ Decoded contours of the requested ROIs.
+
+    Args
+    ====
+    rtstruct : pydicom.Dataset
+        From read_rtstruct (or dicom.dcmread).
+
+    names : list of str (default = None, every ROI)
+        ROIs to decode; the contours of the others are not decoded.
+
+    Returns
+    =======
+    rois : list of (name, contours)
+        In ROIContourSequence order; contours is a list of (n_points, 3) float arrays, one per ContourSequence item.
+    """
+    rois = []
+    sequence = rtstruct.ROIContourSequence
+    for roi in rtstruct_rois(rtstruct):
+        if names is not None and roi['name'] not in names:
+            continue
+        item = sequence[roi['item']]
+        rois.append((roi['name'], [decode_contour_data(contour) for contour in item.get('ContourSequence', [])]))
+    return rois
@@ -1,15 +1,17 @@
 import numpy as np
 import pydicom as dicom
-import SimpleITK as sitk
 import os
+import sys
+sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
+from volume_reader import read_volume
 
 
 def sitk_im_create_simple(im_str, dcm_dir):
     files = np.array([os.path.join(dcm_dir, fl) for fl in os.listdir(dcm_dir) if "dcm" in fl and im_str in fl])
-    dicoms = np.array([dicom.read_file(fl, stop_before_pixels = True) for fl in files])
+    dicoms = np.array([dicom.dcmread(fl, stop_before_pixels = True) for fl in files])
     locations = np.array([float(dcm.ImagePositionPatient[-1]) for dcm in dicoms])
-    files = files[np.argsort(locations)]
-    sitk_im = sitk.ReadImage(files)
+    order = np.argsort(locations)
+    sitk_im = read_volume(files[order], headers=dicoms[order])  # geometry from the headers read above
 
     return sitk_im
 
@@ -0,0 +1,276 @@
+import os
+import datetime
+import numpy as np
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+
+'''Writes synthetic RayStation / Clarity style dicom dumps so every stage of the pipeline can be run and timed without
+real patient exports.
+
+A RayStation dump (write_raystation_export) contains a planning CT series, n_cbct CBCT series each with a REG file
+holding a known matrix, and an RTSTRUCT with n_rois ROIs (n_contours contours per slice) defined on the planning CT.
+write_clarity_export adds the RTPLAN used by the Clarity converter to pick the approved RTSTRUCT, and write_us_export
+writes a single US series to its own folder (US_MonDD), in the layout expected by raystationUSdcm_to_nifti.
+
+CT_IMAGE_STORAGE etc. are the SOP class uids of the written objects.
+'''
+
+CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2'
+REG_STORAGE = '1.2.840.10008.5.1.4.1.1.66.1'
+RTSTRUCT_STORAGE = '1.2.840.10008.5.1.4.1.1.481.3'
+RTPLAN_STORAGE = '1.2.840.10008.5.1.4.1.1.481.5'
+
+
+def _new_dataset(fpath, sop_class_uid, modality, study_uid, series_uid, patient_name, date):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = sop_class_uid
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = FileDataset(fpath, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    ds.SOPClassUID = sop_class_uid
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.Modality = modality
+    ds.PatientName = patient_name
+    ds.PatientID = 'GENIUSII'
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.StudyDate = date
+    ds.SeriesDate = date
+    ds.ContentDate = date
+    ds.FrameOfReferenceUID = generate_uid(entropy_srcs=[study_uid])
+    return ds
+
+
+def _save(ds):
+    # pydicom >= 3 takes the encoding from the transfer syntax; older versions need the flags set on the dataset
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.save_as(ds.filename)
+
+
+def phantom_volume(size, seed=0):
+    """ CT-like int16 test volume (z, y, x): air, a water cylinder and a few dense inserts. """
+    szX, szY, szZ = size
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:szY, 0:szX]
+    body = ((xx - szX / 2) ** 2 / (0.4 * szX) ** 2 + (yy - szY / 2) ** 2 / (0.3 * szY) ** 2) <= 1
+    vol = np.full((szZ, szY, szX), -1000, dtype=np.int16)
+    vol[:, body] = 0
+    insert = ((xx - szX / 2) ** 2 + (yy - szY / 2) ** 2) <= (0.05 * szX) ** 2
+    vol[:, insert] = 700
+    vol += rng.normal(0, 10, vol.shape).astype(np.int16)
+    return vol
+
+
+def write_image_series(out_dir, volume, origin, spacing, patient_name, date, study_uid, series_description='',
+                       prefix='CT', modality='CT', bits_stored=16):
+    """ Write a (z, y, x) int16 volume as one dicom file per slice (unsigned, stored as value + 1024 in bits_stored
+    bits). Returns the series uid. """
+    series_uid = generate_uid()
+    szZ, szY, szX = volume.shape
+    for k in range(szZ):
+        fpath = os.path.join(out_dir, '%s%s.%d.dcm' % (prefix, series_uid, k))
+        ds = _new_dataset(fpath, CT_IMAGE_STORAGE, modality, study_uid, series_uid, patient_name, date)
+        ds.SeriesDescription = series_description
+        ds.ImagePositionPatient = [float(origin[0]), float(origin[1]), float(origin[2] + k * spacing[2])]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [float(spacing[1]), float(spacing[0])]
+        ds.SliceThickness = float(spacing[2])
+        ds.InstanceNumber = k + 1
+        ds.Rows = szY
+        ds.Columns = szX
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = bits_stored
+        ds.HighBit = bits_stored - 1
+        ds.PixelRepresentation = 0
+        ds.RescaleSlope = 1
+        ds.RescaleIntercept = -1024
+        ds.PixelData = (volume[k].astype(np.int32) + 1024).clip(0, 2 ** bits_stored - 1).astype(np.uint16).tobytes()
+        _save(ds)
+    return series_uid
+
+
+def write_reg(out_dir, matrix, ct_series_uid, cbct_series_uid, patient_name, date, study_uid):
+    """ Write a RayStation style REG file. matrix is the 4x4 FrameOfReferenceTransformationMatrix of the CBCT item. """
+    series_uid = generate_uid()
+    fpath = os.path.join(out_dir, 'REG%s.dcm' % series_uid)
+    ds = _new_dataset(fpath, REG_STORAGE, 'REG', study_uid, series_uid, patient_name, date)
+
+    items = []
+    for T in (np.eye(4), matrix):
+        matrix_item = Dataset()
+        matrix_item.FrameOfReferenceTransformationMatrix = [float(v) for v in np.ravel(T)]
+        matrix_item.FrameOfReferenceTransformationMatrixType = 'RIGID'
+        matrix_reg = Dataset()
+        matrix_reg.MatrixSequence = Sequence([matrix_item])
+        reg_item = Dataset()
+        reg_item.MatrixRegistrationSequence = Sequence([matrix_reg])
+        items.append(reg_item)
+    ds.RegistrationSequence = Sequence(items)
+
+    referenced = []
+    for uid in (ct_series_uid, cbct_series_uid):
+        item = Dataset()
+        item.SeriesInstanceUID = uid
+        referenced.append(item)
+    ds.ReferencedSeriesSequence = Sequence(referenced)
+    _save(ds)
+    return ds.SOPInstanceUID
+
+
+def roi_contours(size, origin, spacing, n_contours, roi_idx, n_points=64, z_range=None):
+    """ Circular contours (list of (n_points*3,) arrays in mm) for one synthetic ROI. """
+    szX, szY, szZ = size
+    z0, z1 = z_range if z_range is not None else (szZ // 4, 3 * szZ // 4)
+    t = np.linspace(0, 2 * np.pi, n_points, endpoint=False)
+    contours = []
+    for k in range(z0, z1):
+        for c in range(n_contours):
+            cx = origin[0] + spacing[0] * (szX * (0.3 + 0.4 * ((roi_idx * 7 + c * 3) % 10) / 10))
+            cy = origin[1] + spacing[1] * (szY * (0.3 + 0.4 * ((roi_idx * 3 + c * 7) % 10) / 10))
+            radius = spacing[0] * szX * (0.04 + 0.01 * ((roi_idx + c) % 4))
+            xyz = np.empty((n_points, 3))
+            xyz[:, 0] = cx + radius * np.cos(t)
+            xyz[:, 1] = cy + radius * np.sin(t)
+            xyz[:, 2] = origin[2] + k * spacing[2]
+            contours.append(xyz.ravel())
+    return contours
+
+
+def write_rtstruct(out_dir, roi_names, size, origin, spacing, ct_series_uid, patient_name, date, study_uid,
+                   n_contours=1, n_points=64):
+    """ Write an RTSTRUCT with one ROI per name in roi_names, defined on the CT series ct_series_uid. """
+    series_uid = generate_uid()
+    fpath = os.path.join(out_dir, 'RS%s.dcm' % series_uid)
+    ds = _new_dataset(fpath, RTSTRUCT_STORAGE, 'RTSTRUCT', study_uid, series_uid, patient_name, date)
+    ds.StructureSetLabel = 'RS'
+    ds.ApprovalStatus = 'APPROVED'
+
+    rt_series = Dataset()
+    rt_series.SeriesInstanceUID = ct_series_uid
+    rt_study = Dataset()
+    rt_study.RTReferencedSeriesSequence = Sequence([rt_series])
+    frame = Dataset()
+    frame.FrameOfReferenceUID = generate_uid(entropy_srcs=[study_uid])
+    frame.RTReferencedStudySequence = Sequence([rt_study])
+    ds.ReferencedFrameOfReferenceSequence = Sequence([frame])
+
+    structure_set_rois = []
+    roi_contour_items = []
+    for i, name in enumerate(roi_names):
+        roi = Dataset()
+        roi.ROINumber = i + 1
+        roi.ROIName = name
+        structure_set_rois.append(roi)
+
+        contour_items = []
+        for xyz in roi_contours(size, origin, spacing, n_contours, i, n_points=n_points):
+            contour = Dataset()
+            contour.ContourGeometricType = 'CLOSED_PLANAR'
+            contour.NumberOfContourPoints = len(xyz) // 3
+            contour.ContourData = [round(float(v), 4) for v in xyz]
+            contour_items.append(contour)
+        roi_contour = Dataset()
+        roi_contour.ReferencedROINumber = i + 1
+        roi_contour.ContourSequence = Sequence(contour_items)
+        roi_contour_items.append(roi_contour)
+
+    ds.StructureSetROISequence = Sequence(structure_set_rois)
+    ds.ROIContourSequence = Sequence(roi_contour_items)
+    _save(ds)
+    return ds.SOPInstanceUID
+
+
+def write_rtplan(out_dir, rtstruct_sop_uid, patient_name, date, study_uid):
+    """ Write a minimal RTPLAN referencing the (approved) RTSTRUCT, as found in Clarity DICOMRawData dumps. """
+    series_uid = generate_uid()
+    fpath = os.path.join(out_dir, 'RP%s.dcm' % series_uid)
+    ds = _new_dataset(fpath, RTPLAN_STORAGE, 'RTPLAN', study_uid, series_uid, patient_name, date)
+    ref = Dataset()
+    ref.ReferencedSOPClassUID = RTSTRUCT_STORAGE
+    ref.ReferencedSOPInstanceUID = rtstruct_sop_uid
+    ds.ReferencedStructureSetSequence = Sequence([ref])
+    _save(ds)
+    return ds.SOPInstanceUID
+
+
+def known_matrix(i):
+    """ The rigid REG matrix used for CBCT i: a small rotation about z plus a translation (mm). """
+    angle = np.deg2rad(1.0 + i)
+    T = np.eye(4)
+    T[0, 0], T[0, 1], T[1, 0], T[1, 1] = np.cos(angle), -np.sin(angle), np.sin(angle), np.cos(angle)
+    T[0:3, 3] = [2.0 + i, -1.5, 0.5 * i]
+    return T
+
+
+def write_raystation_export(out_dir, patient_name='g99', ct_size=(128, 128, 40), ct_spacing=(2.0, 2.0, 3.0),
+                            cbct_size=(96, 96, 30), cbct_spacing=(2.5, 2.5, 3.0), n_cbct=2, n_rois=4, n_contours=1,
+                            roi_names=None, clarity=False):
+    """ Write a synthetic RayStation dump to out_dir.
+
+    Args
+    ====
+    out_dir : str
+        Directory that will hold the dump (created if needed).
+
+    ct_size, cbct_size : tuple (x, y, z) in voxels
+
+    n_cbct : int
+        Number of CBCT series, each with a REG file holding known_matrix(i).
+
+    n_rois, n_contours : int
+        ROIs in the RTSTRUCT and contours per slice of each ROI.
+
+    clarity : bool (default = False)
+        Also write the RTPLAN used by Clarity_dcmDump_to_nifti to find the approved RTSTRUCT.
+
+    Returns
+    =======
+    info : dict
+        Series uids, REG matrices and ROI names of the written dump.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    study_uid = generate_uid()
+    ct_date = '20210615'
+    ct_origin = (-ct_size[0] * ct_spacing[0] / 2, -ct_size[1] * ct_spacing[1] / 2, -ct_size[2] * ct_spacing[2] / 2)
+    ct_series_uid = write_image_series(out_dir, phantom_volume(ct_size), ct_origin, ct_spacing, patient_name, ct_date,
+                                       study_uid, series_description='CT')
+
+    if roi_names is None:
+        roi_names = ['ROI_%d' % i for i in range(n_rois)]
+    rtstruct_uid = write_rtstruct(out_dir, roi_names, ct_size, ct_origin, ct_spacing, ct_series_uid, patient_name,
+                                  ct_date, study_uid, n_contours=n_contours)
+    info = {'ct_series_uid': ct_series_uid, 'rtstruct_uid': rtstruct_uid, 'roi_names': roi_names, 'cbct': []}
+
+    if clarity:
+        info['rtplan_uid'] = write_rtplan(out_dir, rtstruct_uid, patient_name, ct_date, study_uid)
+
+    cbct_origin = (-cbct_size[0] * cbct_spacing[0] / 2, -cbct_size[1] * cbct_spacing[1] / 2,
+                   -cbct_size[2] * cbct_spacing[2] / 2)
+    first = datetime.date(2021, 6, 29)
+    for i in range(n_cbct):
+        date = (first + datetime.timedelta(days=i)).strftime('%Y%m%d')
+        cbct_series_uid = write_image_series(out_dir, phantom_volume(cbct_size, seed=i + 1), cbct_origin,
+                                             cbct_spacing, patient_name, date, study_uid, series_description='CBCT')
+        T = known_matrix(i)
+        write_reg(out_dir, T, ct_series_uid, cbct_series_uid, patient_name, date, study_uid)
+        info['cbct'].append({'series_uid': cbct_series_uid, 'date': date, 'matrix': T.tolist()})
+
+    return info
+
+
+def write_us_export(parent_dir, patient_name='g99', size=(96, 96, 48), spacing=(0.8, 0.8, 0.8), name='US_Jun29',
+                    origin=None, seed=0):
+    """ Write one synthetic US series to parent_dir/name (files carry the CT prefix, as RayStation exports do). """
+    us_dir = os.path.join(parent_dir, name)
+    os.makedirs(us_dir, exist_ok=True)
+    if origin is None:
+        origin = (-size[0] * spacing[0] / 2, -size[1] * spacing[1] / 2, -size[2] * spacing[2] / 2)
+    rng = np.random.default_rng(seed)
+    vol = rng.integers(0, 255, size=(size[2], size[1], size[0])).astype(np.int16)
+    write_image_series(us_dir, vol, origin, spacing, patient_name, '', generate_uid(), series_description='US')
+    return us_dir
@@ -0,0 +1,31 @@
+import os
+import sys
+import numpy as np
+import pytest
+import SimpleITK as sitk
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from synthetic_export import phantom_volume, write_image_series
+from volume_reader import read_volume
+
+
+def _series_files(out_dir):
+    # Slices in write (ascending z) order
+    files = [os.path.join(out_dir, fl) for fl in os.listdir(out_dir)]
+    return sorted(files, key=lambda fpath: int(fpath.split('.')[-2]))
+
+
+@pytest.mark.parametrize('bits_stored', [12, 16])
+def test_read_volume_matches_sitk(tmp_path, bits_stored):
+    volume = phantom_volume((32, 24, 6))
+    write_image_series(str(tmp_path), volume, (0., 0., 0.), (1., 1., 2.), 'g99', '20210615', '1.2.3',
+                       bits_stored=bits_stored)
+    files = _series_files(str(tmp_path))
+
+    image = read_volume(files, workers=2)
+    expected = sitk.ReadImage(files)
+
+    assert image.GetPixelID() == expected.GetPixelID()
+    np.testing.assert_array_equal(sitk.GetArrayViewFromImage(image), sitk.GetArrayViewFromImage(expected))
+    np.testing.assert_allclose(image.GetOrigin(), expected.GetOrigin())
+    np.testing.assert_allclose(image.GetSpacing(), expected.GetSpacing())
+    np.testing.assert_allclose(image.GetDirection(), expected.GetDirection())
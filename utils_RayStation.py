@@ -19,7 +19,14 @@ def transformation_from_reg_dcm(reg_dicom):
     MatrixSequence = Item_1_1.MatrixSequence
     Item_1_2 = MatrixSequence[0]
     T = Item_1_2.FrameOfReferenceTransformationMatrix
-    T = np.asarray(T)
+    return transformation_from_matrix(T)
+
+
+''' Splits a 16 element FrameOfReferenceTransformationMatrix (as stored in REG.dcm files, or in the series table built
+by dicom_indexer) into the 3x3 rotation sub-matrix (unraveled) and 3x1 offset that map CBCT onto CT.'''
+
+def transformation_from_matrix(T):
+    T = np.asarray(T, dtype=float)
     TM = np.reshape(T, (4, 4))
     TM = linalg.inv(TM)
 
@@ -36,9 +43,16 @@ def transformation_from_reg_dcm(reg_dicom):
 def get_date_name(ct_image):
     # Get date and series description from metadata - to be used in filename of nifti file
     study_date = ct_image.GetMetaData('0008,0020')  # Date
+    series_description = ct_image.GetMetaData('0008,103e')
+    return fname_from_date(study_date, series_description)
+
+
+''' Filename (e.g. 'CBCT_Jun29.nii.gz') of a nifti from its study date (YYYYMMDD) and series description. Lets the
+converters know the output name before the image itself is read.'''
+
+def fname_from_date(study_date, series_description):
     month = str(study_date[4:6])
     day = str(study_date[-2:])
-    series_description = ct_image.GetMetaData('0008,103e')
 
     month_dict = {
         "01": "Jan",
@@ -63,4 +77,3 @@ def get_date_name(ct_image):
         fname = 'CT' + '_' + date_name
 
     return fname
-
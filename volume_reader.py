@@ -0,0 +1,294 @@
+import os
+import threading
+import numpy as np
+import pydicom as dicom
+import SimpleITK as sitk
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+'''Reads a DICOM image series (CT, CBCT, US) into a SimpleITK image without going through sitk.ReadImage.
+
+The pixel data of every slice is decoded by a pool of threads (the file reads and array copies overlap) straight into
+its place in a preallocated (slices, rows, columns) array. RescaleSlope and
+RescaleIntercept are then applied to the whole volume in one vectorized step. The geometry is not read from the pixel
+files again: origin, spacing and direction are derived from the ImagePositionPatient, ImageOrientationPatient and
+PixelSpacing of the headers the caller already has (the series table of dicom_indexer, or the datasets it read itself),
+in the same way ITK/GDCM does:
+
+    origin    = ImagePositionPatient of the first slice
+    spacing   = (PixelSpacing[1], PixelSpacing[0], distance between the first two slices along the slice normal)
+    direction = row cosines, column cosines and their cross product (as columns of the direction matrix)
+
+Values are returned as int16 when rescaling keeps them integral and within the int16 range (int32 if they only fit
+that), float32 otherwise. As in GDCM, the range is that of the stored values (BitsStored and PixelRepresentation),
+so a 12-bit CT with RescaleIntercept -1024 is int16, as sitk.ReadImage returns it.
+
+SeriesVolumeCache keeps the volumes read in a run within a byte budget, so a series used by several steps (e.g. the CT
+written as a nifti and the grid of the masks) is decoded once.
+
+Typical use:
+    ct_image = read_series_volume(ct_series)  # a series from dicom_indexer.build_series_table
+    ct_image = read_volume(files, headers)  # files and pydicom headers in slice order
+'''
+
+
+def volume_geometry(positions, orientation, pixel_spacing):
+    """ Origin, spacing and direction of a series from the headers of its slices.
+
+    Args
+    ====
+    positions : list of 3 floats
+        ImagePositionPatient of each slice, in slice order.
+
+    orientation : list of 6 floats
+        ImageOrientationPatient (row cosines, then column cosines). None for identity.
+
+    pixel_spacing : list of 2 floats
+        PixelSpacing (row spacing, column spacing). None for 1 mm.
+
+    Returns
+    =======
+    origin, spacing, direction : tuples as used by SimpleITK
+    """
+    if orientation is None:
+        orientation = [1., 0., 0., 0., 1., 0.]
+    if pixel_spacing is None:
+        pixel_spacing = [1., 1.]
+    row = np.asarray(orientation[:3], dtype=float)
+    col = np.asarray(orientation[3:6], dtype=float)
+    normal = np.cross(row, col)
+
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    slice_spacing = 1.
+    if len(positions) > 1:
+        slice_spacing = abs(float(np.dot(positions[1] - positions[0], normal))) or 1.
+
+    direction = np.stack([row, col, normal], axis=1)
+    spacing = (float(pixel_spacing[1]), float(pixel_spacing[0]), slice_spacing)
+    return tuple(float(v) for v in positions[0]), spacing, tuple(float(v) for v in direction.ravel())
+
+
+def header_geometry(headers):
+    """ volume_geometry from pydicom datasets (in slice order). """
+    first = headers[0]
+    orientation = [float(v) for v in first.ImageOrientationPatient] if 'ImageOrientationPatient' in first else None
+    pixel_spacing = [float(v) for v in first.PixelSpacing] if 'PixelSpacing' in first else None
+    positions = [[float(v) for v in dcm.ImagePositionPatient] for dcm in headers[:2]]
+    return volume_geometry(positions, orientation, pixel_spacing)
+
+
+def _decode_slice(fpath, volume, index):
+    # Decode one slice into its place in the volume; return its rescale parameters
+    dcm = dicom.dcmread(fpath)
+    volume[index] = dcm.pixel_array
+    return float(dcm.get('RescaleSlope', 1.) or 1.), float(dcm.get('RescaleIntercept', 0.) or 0.)
+
+
+def stored_range(dcm, stored_dtype):
+    """ (min, max) of the stored pixel values of a slice, from BitsStored and PixelRepresentation (the full range of
+    stored_dtype, the dtype of its pixel_array, if BitsStored is missing). """
+    info = np.iinfo(stored_dtype)
+    bits = dcm.get('BitsStored')
+    if not bits or int(bits) > info.bits:
+        return info.min, info.max
+    bits = int(bits)
+    if int(dcm.get('PixelRepresentation', 0) or 0) == 1:
+        return -2 ** (bits - 1), 2 ** (bits - 1) - 1
+    return 0, 2 ** bits - 1
+
+
+def _output_dtype(value_range, slopes, intercepts):
+    # int16 (or int32) if rescaled values stay integral and fit, float32 otherwise
+    if not (np.all(slopes == np.round(slopes)) and np.all(intercepts == np.round(intercepts))):
+        return np.dtype(np.float32)
+    low, high = value_range
+    lows = np.minimum(low * slopes, high * slopes) + intercepts
+    highs = np.maximum(low * slopes, high * slopes) + intercepts
+    for dtype in (np.int16, np.int32):
+        if lows.min() >= np.iinfo(dtype).min and highs.max() <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.float32)
+
+
+def read_volume(files, headers=None, workers=None, geometry=None):
+    """ Read a DICOM image series into a SimpleITK image.
+
+    Args
+    ====
+    files : list of str
+        Paths of the slices, in slice order (ascending position along the slice normal).
+
+    headers : list of pydicom.Dataset (default = None)
+        Headers of (at least the first two) slices, in the same order, used for the geometry. None reads the first two
+        headers from files.
+
+    workers : int (default = None)
+        Number of decoding threads (None: one per CPU, at most 32).
+
+    geometry : tuple (default = None)
+        (origin, spacing, direction), e.g. from volume_geometry; overrides headers.
+
+    Returns
+    =======
+    image : SimpleITK.Image
+        int16 (int32) or float32, see module docstring.
+    """
+    files = list(files)
+    if not files:
+        raise ValueError('No files to read')
+    if geometry is None:
+        if headers is None:
+            headers = [dicom.dcmread(fpath, stop_before_pixels=True) for fpath in files[:2]]
+        geometry = header_geometry(headers)
+
+    first = dicom.dcmread(files[0])
+    first_array = first.pixel_array
+    if first_array.ndim != 2:
+        raise ValueError('%s is not a single-frame image' % files[0])
+    volume = np.empty((len(files),) + first_array.shape, dtype=first_array.dtype)
+    volume[0] = first_array
+    del first_array
+    slopes = np.ones(len(files))
+    intercepts = np.zeros(len(files))
+    slopes[0], intercepts[0] = float(first.get('RescaleSlope', 1.) or 1.), float(first.get('RescaleIntercept', 0.) or 0.)
+
+    if workers is None:
+        workers = min(32, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(_decode_slice, fpath, volume, i) for i, fpath in enumerate(files) if i > 0]
+        for i, future in enumerate(futures, 1):
+            slopes[i], intercepts[i] = future.result()
+
+    dtype = _output_dtype(stored_range(first, volume.dtype), slopes, intercepts)
+    identity = np.all(slopes == 1) and np.all(intercepts == 0)
+    if identity and volume.dtype == dtype:
+        array = volume
+    else:
+        array = volume.astype(dtype)
+        del volume
+        if np.all(slopes == slopes[0]) and np.all(intercepts == intercepts[0]):
+            if slopes[0] != 1:
+                array *= dtype.type(slopes[0])
+            if intercepts[0] != 0:
+                array += dtype.type(intercepts[0])
+        else:
+            array *= slopes.astype(dtype)[:, None, None]
+            array += intercepts.astype(dtype)[:, None, None]
+
+    image = sitk.GetImageFromArray(array)
+    del array
+    origin, spacing, direction = geometry
+    image.SetOrigin(origin)
+    image.SetSpacing(spacing)
+    image.SetDirection(direction)
+    return image
+
+
+def read_series_volume(series, workers=None):
+    """ read_volume of a series of dicom_indexer.build_series_table, using the headers recorded in the index. """
+    if series.get('ipp') is None:
+        return read_volume(series['files'], workers=workers)
+    geometry = volume_geometry(series['ipp'][:2], series.get('iop'), series.get('pixel_spacing'))
+    return read_volume(series['files'], workers=workers, geometry=geometry)
+
+
+# Default byte budget of a SeriesVolumeCache
+SERIES_CACHE_BYTES = 1 << 30
+
+
+def _volume_bytes(image):
+    return image.GetNumberOfPixels() * image.GetNumberOfComponentsPerPixel() * image.GetSizeOfPixelComponent()
+
+
+class SeriesVolumeCache:
+    """ Volumes of the series read in a run, keyed by SeriesInstanceUID and prepare_key, so each series is decoded
+    at most once per preparation.
+
+    Volumes are kept while their total size stays within max_bytes, the least recently used ones being dropped first
+    (a volume larger than max_bytes is returned but not kept). Safe to use from several threads: a series requested
+    while another thread is decoding it waits for that decode instead of starting a second one.
+
+    The same image is returned to every caller, so it must not be modified (even SetMetaData makes SimpleITK copy the
+    whole pixel buffer); changes every user needs, such as the dicom tags, are made once by prepare. Callers sharing a
+    cache but preparing the volumes differently (e.g. copying the tags with another tag_filter) must pass different
+    prepare_keys, otherwise one gets the volume prepared by the other.
+
+    Args
+    ====
+    max_bytes : int (default = SERIES_CACHE_BYTES)
+
+    Typical use:
+        cache = SeriesVolumeCache(max_bytes=2 << 30)
+        ct_image = cache.get(ct_series, prepare=lambda image: copy_dicom_tags(image, ct_header), prepare_key='tags')
+    """
+
+    def __init__(self, max_bytes=SERIES_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._volumes = OrderedDict()
+        self._bytes = 0
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, series, workers=None, prepare=None, prepare_key=None):
+        """ Volume of a series of dicom_indexer.build_series_table (read_series_volume, then prepare(image)).
+        prepare_key (hashable) identifies what prepare does to the volume. """
+        uid = (series['series_uid'], prepare_key)
+        with self._lock:
+            if uid in self._volumes:
+                self._volumes.move_to_end(uid)
+                self.hits += 1
+                return self._volumes[uid]
+            loading = self._loading.get(uid)
+            if loading is None:
+                loading = self._loading[uid] = Future()
+                self.misses += 1
+                owner = True
+            else:
+                owner = False
+                self.hits += 1
+        if not owner:
+            return loading.result()
+
+        try:
+            image = read_series_volume(series, workers=workers)
+            if prepare is not None:
+                prepare(image)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[uid]
+            loading.set_exception(e)
+            raise
+        with self._lock:
+            del self._loading[uid]
+            self._store(uid, image)
+        loading.set_result(image)
+        return image
+
+    def _store(self, uid, image):
+        size = _volume_bytes(image)
+        if size > self.max_bytes:
+            return
+        self._volumes[uid] = image
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            old_uid, old = self._volumes.popitem(last=False)
+            self._bytes -= _volume_bytes(old)
+
+    def discard(self, series_uid, prepare_key=None):
+        """ Drop a series (e.g. once nothing else will use it). """
+        with self._lock:
+            image = self._volumes.pop((series_uid, prepare_key), None)
+            if image is not None:
+                self._bytes -= _volume_bytes(image)
+
+    def clear(self):
+        with self._lock:
+            self._volumes.clear()
+            self._bytes = 0
+
+    @property
+    def nbytes(self):
+        """ Bytes of the volumes kept. """
+        return self._bytes
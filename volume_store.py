@@ -0,0 +1,252 @@
+import os
+import json
+import shutil
+import numpy as np
+import SimpleITK as sitk
+from contextlib import contextmanager
+import sys
+sys.path.append('/Users/sblackledge/PycharmProjects/pythonProject/GENIUSII')
+from output_manifest import tmp_path_for
+from nifti_stream import image_geometry
+
+'''Volume store: an uncompressed, memory-mappable alternative to .nii.gz for the outputs of the pipeline.
+
+A .nii.gz has to be decompressed from its start to reach any voxel, so reading one slice or a small region of a CT
+costs as much as reading the whole volume. A volume store is a directory <name>.vol holding:
+    geometry.json           size (x, y, z), origin, spacing, direction, dtype, slab_size, and the metadata of the
+                            image (the dicom tags copied by the converters, ContourName of a mask...)
+    slab_00000.npy, ...     the voxels, slab_size slices per file, as (slices, rows, columns) .npy arrays
+VolumeStore opens the slabs with np.load(mmap_mode='r') as they are needed, so a slice or a block of voxels is read
+from disk without loading (or decompressing) the rest of the volume:
+    store = VolumeStore('/Users/sblackledge/Documents/GENIUSII_exports/nifti_dump/images/g02/CT_Jun15.vol')
+    axial = store[60]                          # (rows, columns) array of slice 60
+    block = store[40:80, 200:300, 150:350]     # (z, y, x) sub-block, as sitk.GetArrayFromImage would index it
+    roi = store.read_block((150, 200, 40), (200, 100, 40))  # the same block as a sitk image, geometry included
+    image = store.to_image()                   # the whole volume, as sitk.ReadImage would return it
+
+Output paths ending in VOLUME_SUFFIX are written as volume stores by the writer of nifti_writer.py, so every output
+(converter images and masks, label maps, compounds) can be switched to this backend by its file name; the converters
+and batch_convert.py take output_format='volume_store' (output_fname), compound_create a compound name ending in .vol.
+A store is written in a temporary directory renamed into place once complete, like the niftis.
+'''
+
+VOLUME_SUFFIX = '.vol'
+GEOMETRY_NAME = 'geometry.json'
+SLAB_NAME = 'slab_%05d.npy'
+OUTPUT_FORMATS = ('nifti', 'volume_store')
+
+# Slices per .npy file: large enough to keep the number of files low, small enough that a slab is cheap to map
+DEFAULT_SLAB_SIZE = 16
+
+
+def is_volume_store(fpath):
+    return fpath.rstrip(os.sep).endswith(VOLUME_SUFFIX)
+
+
+def output_fname(fname, output_format='nifti'):
+    """ File name of an output in output_format: <name>.nii.gz as is, or <name>.vol for a volume store. """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output_format '%s' (expected one of %s)" % (output_format, ', '.join(OUTPUT_FORMATS)))
+    if output_format == 'nifti':
+        return fname
+    stem = fname[:-len('.nii.gz')] if fname.endswith('.nii.gz') else os.path.splitext(fname)[0]
+    return stem + VOLUME_SUFFIX
+
+
+def _replace_dir(tmp_dir, save_path):
+    # Rename the finished store into place; a store already there is moved aside first and then removed
+    old_path = None
+    if os.path.lexists(save_path):
+        old_path = tmp_path_for(save_path) + '.old'
+        os.rename(save_path, old_path)
+    os.rename(tmp_dir, save_path)
+    if old_path is not None:
+        if os.path.isdir(old_path):
+            shutil.rmtree(old_path)
+        else:
+            os.remove(old_path)
+
+
+@contextmanager
+def volume_slab_writer(save_path, geometry, dtype=np.float32, slab_size=DEFAULT_SLAB_SIZE, metadata=None):
+    """ Context manager giving a function that appends slabs of slices to the volume store at save_path (the same
+    interface as nifti_stream.nifti_slab_writer).
+
+    Args
+    ====
+    save_path : str
+        <name>.vol directory. Written to a temporary directory renamed into place once every slice has been written.
+
+    geometry : tuple
+        (size, origin, spacing, direction) of the volume, e.g. nifti_stream.image_geometry(template).
+
+    dtype : numpy dtype (default = np.float32)
+
+    slab_size : int (default = DEFAULT_SLAB_SIZE)
+        Slices per .npy file, whatever the number of slices passed to each write_slab call.
+
+    metadata : dict (default = None)
+        Metadata of the image (str keys and values), restored by VolumeStore.to_image.
+
+    Yields
+    ======
+    write_slab : function
+        write_slab(array) with array of shape (slices, rows, columns) appends those slices, in increasing z.
+    """
+    size, origin, spacing, direction = geometry
+    nx, ny, nz = size
+    dtype = np.dtype(dtype)
+    tmp_dir = tmp_path_for(save_path)
+    state = {'written': 0, 'slabs': 0, 'pending': None}
+
+    def save_slab(array):
+        np.save(os.path.join(tmp_dir, SLAB_NAME % state['slabs']), np.ascontiguousarray(array, dtype=dtype))
+        state['slabs'] += 1
+
+    def write_slab(array):
+        if array.shape[1:] != (ny, nx) or state['written'] + array.shape[0] > nz:
+            raise ValueError('Slab of shape %s does not fit a volume of size %s at slice %d'
+                             % (array.shape, (nx, ny, nz), state['written']))
+        state['written'] += array.shape[0]
+        if state['pending'] is not None:
+            array = np.concatenate([state['pending'], array])
+        start = 0
+        while array.shape[0] - start >= slab_size:
+            save_slab(array[start:start + slab_size])
+            start += slab_size
+        state['pending'] = np.array(array[start:], dtype=dtype) if start < array.shape[0] else None
+
+    os.makedirs(tmp_dir)
+    try:
+        yield write_slab
+        if state['written'] != nz:
+            raise ValueError('Only %d of %d slices were written to %s' % (state['written'], nz, save_path))
+        if state['pending'] is not None:
+            save_slab(state['pending'])
+        header = {'format': 'volume_store', 'size': list(size), 'origin': list(origin), 'spacing': list(spacing),
+                  'direction': list(direction), 'dtype': dtype.str, 'slab_size': slab_size,
+                  'n_slabs': state['slabs'], 'metadata': dict(metadata or {})}
+        with open(os.path.join(tmp_dir, GEOMETRY_NAME), 'w') as f:
+            json.dump(header, f, indent=1)
+        _replace_dir(tmp_dir, save_path)
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+
+def write_volume_store(image, save_path, slab_size=DEFAULT_SLAB_SIZE):
+    """ Write a 3D scalar SimpleITK image, with its metadata, as a volume store (see volume_slab_writer). """
+    if image.GetDimension() != 3 or image.GetNumberOfComponentsPerPixel() != 1:
+        raise ValueError('Only 3D scalar images can be written as a volume store')
+    array = sitk.GetArrayViewFromImage(image)
+    metadata = {key: image.GetMetaData(key) for key in image.GetMetaDataKeys()}
+    with volume_slab_writer(save_path, image_geometry(image), array.dtype, slab_size, metadata) as write_slab:
+        for z0 in range(0, array.shape[0], slab_size):
+            write_slab(array[z0:z0 + slab_size])
+
+
+def _index_range(key, n):
+    # Indices selected by an int or slice along an axis of length n, and whether the axis is kept
+    if isinstance(key, slice):
+        return range(*key.indices(n)), True
+    index = int(key)
+    if not -n <= index < n:
+        raise IndexError('Index %d out of range for an axis of length %d' % (index, n))
+    return range(index % n, index % n + 1), False
+
+
+class VolumeStore:
+    """ Read access to a volume store, slab files being memory-mapped as they are needed.
+
+    Args
+    ====
+    fpath : str
+        <name>.vol directory.
+
+    Attributes
+    ==========
+    size, origin, spacing, direction : tuple
+        Geometry of the volume, as for a SimpleITK image (size in (x, y, z) order).
+
+    shape : tuple
+        (z, y, x), the shape of sitk.GetArrayFromImage of the volume.
+
+    dtype : numpy dtype
+
+    metadata : dict
+        Metadata of the image written (dicom tags...).
+    """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        with open(os.path.join(fpath, GEOMETRY_NAME)) as f:
+            header = json.load(f)
+        self.size = tuple(header['size'])
+        self.origin = tuple(header['origin'])
+        self.spacing = tuple(header['spacing'])
+        self.direction = tuple(header['direction'])
+        self.dtype = np.dtype(header['dtype'])
+        self.slab_size = header['slab_size']
+        self.metadata = header['metadata']
+        self.shape = self.size[::-1]
+        self._slabs = {}
+
+    def slab(self, i):
+        """ Memory-mapped (slices, rows, columns) array of slab file i (slices i * slab_size onwards). """
+        if i not in self._slabs:
+            self._slabs[i] = np.load(os.path.join(self.fpath, SLAB_NAME % i), mmap_mode='r')
+        return self._slabs[i]
+
+    def __getitem__(self, key):
+        """ Voxels as a numpy array, indexed as the (z, y, x) array of the volume with ints and slices. Only the slabs
+        holding the selected slices are read. """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3:
+            raise IndexError('A volume store has 3 dimensions')
+        key = key + (slice(None),) * (3 - len(key))
+        zs, keep_z = _index_range(key[0], self.shape[0])
+        yx = tuple(key[1:])
+
+        parts = []
+        zs = np.asarray(zs, dtype=np.intp)
+        for i in dict.fromkeys(zs // self.slab_size):  # slabs in the order of the slices
+            local = zs[zs // self.slab_size == i] - i * self.slab_size
+            # Rows and columns first (a view of the memory map), so only the selected voxels are read
+            parts.append(self.slab(int(i))[(slice(None),) + yx][local])
+        if parts:
+            array = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        else:
+            array = np.empty((0,) + np.empty(self.shape[1:], dtype=np.bool_)[yx].shape, dtype=self.dtype)
+        return array if keep_z else array[0]
+
+    def read_slice(self, z):
+        """ (rows, columns) array of slice z. """
+        return self[z]
+
+    def read_block(self, index, size):
+        """ Block of size (x, y, z) voxels starting at index (x, y, z) as a SimpleITK image with its geometry and
+        metadata, as sitk.RegionOfInterest would return it from the whole image. """
+        (x0, y0, z0), (nx, ny, nz) = index, size
+        if any(i < 0 or i + n > s for i, n, s in zip(index, size, self.size)):
+            raise IndexError('Block %s + %s outside a volume of size %s' % (tuple(index), tuple(size), self.size))
+        image = sitk.GetImageFromArray(self[z0:z0 + nz, y0:y0 + ny, x0:x0 + nx])
+        image.SetSpacing(self.spacing)
+        image.SetDirection(self.direction)
+        offset = np.reshape(self.direction, (3, 3)) @ (np.asarray(index, dtype=float) * np.asarray(self.spacing))
+        image.SetOrigin(tuple((np.asarray(self.origin) + offset).tolist()))
+        for key, value in self.metadata.items():
+            image.SetMetaData(key, value)
+        return image
+
+    def to_image(self):
+        """ The whole volume as a SimpleITK image. """
+        return self.read_block((0, 0, 0), self.size)
+
+
+def read_image(fpath):
+    """ sitk.ReadImage, or VolumeStore(fpath).to_image() for a volume store. """
+    if is_volume_store(fpath):
+        return VolumeStore(fpath).to_image()
+    return sitk.ReadImage(fpath)
+